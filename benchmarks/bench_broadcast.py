@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+Benchmark: broadcast throughput against a fake Bot API that enforces flood limits.
+
+Compares the old serial loop (one send at a time plus a 0.1 s sleep) with
+BroadcastEngine at the configured rate and deliberately over the limit, where
+RetryAfter has to pull the rate back down.
+
+    python benchmarks/bench_broadcast.py [--users 900] [--limit 30]
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_telegram import FakeBot  # noqa: E402
+from utils.broadcast_engine import BroadcastEngine  # noqa: E402
+
+
+async def serial(bot: FakeBot, users: int):
+    start = time.monotonic()
+    for chat_id in range(1, users + 1):
+        try:
+            await bot.send_message(chat_id=chat_id, text="hello")
+            await asyncio.sleep(0.1)
+        except Exception:
+            pass
+    return bot.delivered, time.monotonic() - start, 0
+
+
+async def engine(bot: FakeBot, users: int, rate: float, concurrency: int):
+    engine = BroadcastEngine(lambda chat_id: bot.send_message(chat_id=chat_id, text="hello"),
+                             rate=rate, concurrency=concurrency)
+    stats = await engine.run(range(1, users + 1))
+    return stats.sent, stats.elapsed, stats.flood_waits
+
+
+def report(name: str, limit: int, sent: int, elapsed: float, floods: int):
+    rate = sent / elapsed
+    print(f"{name:<28}{sent:>7}{elapsed:>9.1f}{rate:>9.1f}{rate / limit:>9.0%}{floods:>8}"
+          f"{100000 / rate / 3600:>12.2f}")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=900)
+    parser.add_argument("--serial-users", type=int, default=100)
+    parser.add_argument("--limit", type=int, default=30, help="fake Bot API global limit, msg/s")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--latency-ms", type=float, default=60)
+    args = parser.parse_args()
+
+    def fake():
+        return FakeBot(global_limit=args.limit, latency_ms=args.latency_ms)
+
+    print(f"{'sender':<28}{'sent':>7}{'secs':>9}{'msg/s':>9}{'of limit':>9}{'floods':>8}{'100k hours':>12}")
+    report("serial loop", args.limit, *await serial(fake(), args.serial_users))
+    report(f"engine @ {args.limit} msg/s", args.limit,
+           *await engine(fake(), args.users, args.limit, args.concurrency))
+    overdrive = args.limit * 1.5
+    report(f"engine @ {overdrive:.0f} msg/s (over limit)", args.limit,
+           *await engine(fake(), args.users, overdrive, args.concurrency))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
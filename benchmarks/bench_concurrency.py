@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+"""
+Benchmark: a burst of mixed updates through the Application, processed three ways.
+
+`--users` users each send their updates at once: most send /start and
+/wallet, and `--payers` of them make a deposit and a top-up instead
+(/wallet_deposit, /topup and then the amount as a text message). The bot's
+own handlers run against a throwaway JSON database, a fake Xendit with
+`--xendit-ms` latency and benchmarks/fake_telegram.FakeBotAPI:
+
+  sequential  the Application's default, one update at a time
+  unordered   concurrent_updates(--concurrency): parallel, but a user's
+              updates can overtake each other
+  per-user    PerUserUpdateProcessor(--concurrency) as main.py builds it
+
+Latency is from the moment an update is queued to the moment its handler
+has finished. "broken" counts top-up amounts that arrived before their
+/topup had set the conversation flag, and so were echoed instead of
+creating an invoice; "errors" counts handlers that raised.
+
+    python benchmarks/bench_concurrency.py [--users 100] [--payers 0.2] [--concurrency 16]
+        [--xendit-ms 300] [--telegram-ms 40]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_telegram import FakeBotAPI  # noqa: E402
+from benchmarks.fake_xendit import FakeXendit  # noqa: E402
+
+
+def percentile(values, fraction: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+def message_update(update_id: int, user_id: int, text: str) -> dict:
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private', 'first_name': f"User{user_id}"},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}", 'username': f"user{user_id}",
+                 'language_code': 'en'},
+        'text': text
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'update_id': update_id, 'message': message}
+
+
+def workload(args, amount: int):
+    """(kind, user_id, text) for every update: each user's in order, users randomly interleaved"""
+    payers = int(args.users * args.payers)
+    scripts = []
+    for i in range(args.users):
+        user_id = 200000 + i
+        if i < payers:
+            scripts.append([("deposit", user_id, f"/wallet_deposit {amount}"), ("topup", user_id, "/topup"),
+                            ("amount", user_id, str(amount + 50))])
+        else:
+            scripts.append([("start", user_id, "/start"), ("wallet", user_id, "/wallet")])
+    steps, interleave = [], random.Random(1)
+    while scripts:
+        script = interleave.choice(scripts)
+        steps.append(script.pop(0))
+        if not script:
+            scripts.remove(script)
+    return steps
+
+
+async def run_mode(name: str, processor, args, amount: int, first_update_id: int, fake: FakeXendit):
+    from telegram import Update
+    from telegram.ext import Application, CommandHandler, MessageHandler as TgMessageHandler, TypeHandler, filters
+    from handlers.message_handler import MessageHandler
+    from handlers.wallet_handler import WalletHandler
+    from utils.ingestion import UpdateQueue
+
+    queue = UpdateQueue(10 ** 6, shed_at=1.0)
+    api = FakeBotAPI(args.telegram_ms, args.telegram_ms / 4)
+    application = (Application.builder().token("123456:bench").request(api).get_updates_request(FakeBotAPI())
+                   .updater(None).update_queue(queue).concurrent_updates(processor).build())
+    application.add_handler(CommandHandler("start", MessageHandler.handle_start))
+    application.add_handler(CommandHandler("wallet", WalletHandler.handle_wallet_balance))
+    application.add_handler(CommandHandler("wallet_deposit", WalletHandler.handle_wallet_deposit))
+    application.add_handler(CommandHandler("topup", MessageHandler.handle_topup))
+    application.add_handler(TgMessageHandler(filters.TEXT & ~filters.COMMAND, MessageHandler.handle_text_message))
+
+    queued_at, kinds, latencies, errors = {}, {}, defaultdict(list), []
+
+    async def finished(update: Update, context):
+        latencies[kinds[update.update_id]].append((time.perf_counter() - queued_at[update.update_id]) * 1000)
+
+    async def failed(update, context):
+        errors.append(context.error)
+
+    # Group 1 runs after the bot's handler for the same update has returned
+    application.add_handler(TypeHandler(Update, finished), group=1)
+    application.add_error_handler(failed)
+
+    await application.initialize()
+    await application.start()
+    invoices_before = fake.counters['invoices']
+    start = time.perf_counter()
+    for offset, (kind, user_id, text) in enumerate(workload(args, amount)):
+        update_id = first_update_id + offset
+        kinds[update_id] = kind
+        queued_at[update_id] = time.perf_counter()
+        queue.put_nowait(Update.de_json(message_update(update_id, user_id, text), application.bot))
+    await queue.join()
+    elapsed = time.perf_counter() - start
+    await application.stop()
+    await application.shutdown()
+
+    payers = int(args.users * args.payers)
+    broken = 2 * payers - (fake.counters['invoices'] - invoices_before)
+    total = sum(len(values) for values in latencies.values())
+    columns = ""
+    for kind in ("start", "deposit", "amount"):
+        values = sorted(latencies[kind])
+        columns += f"{percentile(values, 0.5):>9.0f}{percentile(values, 0.99):>9.0f}"
+    print(f"{name:<12}{total:>8}{total / elapsed:>9.1f}{elapsed:>8.1f}{columns}{broken:>8}{len(errors):>8}")
+
+
+async def run(args):
+    fake = FakeXendit(args.xendit_ms, args.xendit_ms / 5, seed=1)
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    os.environ.update(XENDIT_BASE_URL=fake.start(), XENDIT_SECRET_KEY="xnd_development_bench",
+                      JSON_DB_FILE=os.path.join(workdir, "users.json"))
+
+    # Imported only now: configuration and the shared database are read at import time
+    from database import get_database
+    from utils.update_processor import PerUserUpdateProcessor
+    from utils.xendit_api import get_xendit_client
+
+    db = get_database()
+    await db.start()
+    client = get_xendit_client()
+    await client.start()
+
+    print(f"{args.users} users ({args.payers:.0%} paying), concurrency {args.concurrency}, "
+          f"Xendit {args.xendit_ms:g} ms, Telegram {args.telegram_ms:g} ms")
+    print(f"{'':<12}{'':>8}{'':>9}{'':>8}{'/start':>18}{'deposit':>18}{'top-up amount':>18}")
+    print(f"{'mode':<12}{'updates':>8}{'upd/s':>9}{'secs':>8}" + f"{'p50 ms':>9}{'p99 ms':>9}" * 3 + f"{'broken':>8}{'errors':>8}")
+    modes = [("sequential", 1),
+             ("unordered", args.concurrency),
+             ("per-user", PerUserUpdateProcessor(args.concurrency))]
+    for index, (name, processor) in enumerate(modes):
+        # A different amount per mode, so no mode reuses another's open invoices
+        await run_mode(name, processor, args, 100 + index * 1000, 1 + index * 100000, fake)
+
+    await client.close()
+    await db.stop()
+    fake.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--payers", type=float, default=0.2, help="share of users who deposit and top up")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--xendit-ms", type=float, default=300, help="fake Xendit latency")
+    parser.add_argument("--telegram-ms", type=float, default=40, help="fake Bot API latency")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Benchmark: webhook ingestion under overload, with and without admission control.
+
+A load process posts Telegram updates to WebhookApp at `--rate` per second;
+`--command-share` of them are commands, the rest plain chat messages. The
+Application side handles one update at a time and each takes
+`--handler-ms`, so the offered load is well above what it can process:
+
+  unbounded   an UpdateQueue too deep to ever fill: every update is
+              accepted and waits behind all the others
+  bounded     UpdateQueue(--depth, --shed-at) as main.py builds it: past the
+              shedding mark chat messages are refused with 503 (Telegram
+              would redeliver them), and commands use the remaining room
+
+Latency is measured from the moment an update is sent to the moment its
+handler finishes, separately for commands and chat messages.
+
+    python benchmarks/bench_ingestion.py [--requests 5000] [--rate 500] [--concurrency 50]
+        [--handler-ms 5] [--command-share 0.05] [--depth 200] [--shed-at 0.5]
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+from collections import Counter, defaultdict
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram.ext import Application  # noqa: E402
+
+from benchmarks.bench_webhook import SECRET_TOKEN, _read_response, percentile, serve_asgi  # noqa: E402
+from utils.ingestion import UpdateQueue  # noqa: E402
+
+
+def sample_update(update_id: int, command: bool) -> bytes:
+    # The send time travels in the text so the handler can tell how long the update took end to end
+    text = f"/start {time.time():.6f}" if command else f"hello {time.time():.6f}"
+    return json.dumps({
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': 1000 + update_id % 500, 'type': 'private', 'first_name': 'Bench'},
+            'from': {'id': 1000 + update_id % 500, 'is_bot': False, 'first_name': 'Bench', 'language_code': 'en'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}] if command else []
+        }
+    }).encode()
+
+
+async def _load(url: str, requests: int, rate: float, concurrency: int, command_share: float):
+    url = httpx.URL(url)
+    head = (f"POST {url.raw_path.decode()} HTTP/1.1\r\nHost: {url.host}:{url.port}\r\n"
+            f"Content-Type: application/json\r\nX-Telegram-Bot-Api-Secret-Token: {SECRET_TOKEN}\r\n")
+    kinds = random.Random(1)
+    statuses = defaultdict(Counter)
+    next_request = iter(range(requests))
+
+    async def worker():
+        reader, writer = await asyncio.open_connection(url.host, url.port)
+        for i in next_request:
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            kind = "command" if kinds.random() < command_share else "chat"
+            body = sample_update(i, kind == "command")
+            writer.write(f"{head}Content-Length: {len(body)}\r\n\r\n".encode() + body)
+            status, _ = await _read_response(reader)
+            statuses[kind][status] += 1
+        writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return time.perf_counter() - start, {kind: dict(counts) for kind, counts in statuses.items()}
+
+
+def load_process(url: str, requests: int, rate: float, concurrency: int, command_share: float, results):
+    results.put(asyncio.run(_load(url, requests, rate, concurrency, command_share)))
+
+
+async def drive(url: str, args):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=load_process,
+                              args=(url, args.requests, args.rate, args.concurrency, args.command_share, results))
+    process.start()
+    result = await asyncio.to_thread(results.get)
+    await asyncio.to_thread(process.join)
+    return result
+
+
+async def handle_updates(application: Application, handler_ms: float, latencies):
+    """Take updates off the queue one at a time, like the Application does by default"""
+    while True:
+        update = await application.update_queue.get()
+        await asyncio.sleep(handler_ms / 1000)
+        kind = "command" if update.message.text.startswith('/') else "chat"
+        latencies[kind].append((time.time() - float(update.message.text.split()[-1])) * 1000)
+        application.update_queue.task_done()
+
+
+async def run(args):
+    print(f"{args.requests} updates at {args.rate:g}/s ({args.command_share:.0%} commands), "
+          f"handler {args.handler_ms:g} ms (at most {1000 / args.handler_ms:.0f} updates/s)")
+    print(f"{'queue':<11}{'kind':<9}{'sent':>6}{'handled':>9}{'refused':>9}{'p50 ms':>9}{'p99 ms':>9}"
+          f"{'max ms':>9}")
+    setups = [("unbounded", UpdateQueue(10 ** 7, shed_at=1.0)),
+              ("bounded", UpdateQueue(args.depth, shed_at=args.shed_at))]
+    for name, queue in setups:
+        application = Application.builder().token("123456:bench").updater(None).update_queue(queue).build()
+        latencies = defaultdict(list)
+        handler = asyncio.create_task(handle_updates(application, args.handler_ms, latencies))
+        url, stop = await serve_asgi(application)
+        elapsed, statuses = await drive(url, args)
+        await stop()
+        # Let the handler work off what was accepted
+        await queue.join()
+        handler.cancel()
+        for kind in ("command", "chat"):
+            values = sorted(latencies[kind])
+            sent = sum(statuses.get(kind, {}).values())
+            refused = sent - statuses.get(kind, {}).get(200, 0)
+            print(f"{name:<11}{kind:<9}{sent:>6}{len(values):>9}{refused:>9}{percentile(values, 0.5):>9.0f}"
+                  f"{percentile(values, 0.99):>9.0f}{values[-1] if values else 0:>9.0f}")
+        stats = queue.stats()
+        print(f"{'':<11}queue peak {stats['peak_depth']}, queue wait p99 {stats['wait_p99_ms']:.0f} ms, "
+              f"offered {args.requests / elapsed:.0f} req/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--rate", type=float, default=500, help="updates sent per second")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--handler-ms", type=float, default=5, help="time each update takes to handle")
+    parser.add_argument("--command-share", type=float, default=0.05)
+    parser.add_argument("--depth", type=int, default=200, help="bounded queue depth")
+    parser.add_argument("--shed-at", type=float, default=0.5, help="share of the depth chat messages may fill")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Benchmark: per-mutation write cost of UserDatabase as the user count grows.
+
+Compares the journal engine (one appended record per mutation) with the old
+behaviour of rewriting the whole users.json on every call.
+
+    python benchmarks/bench_journal.py [--sizes 1000,10000,100000,1000000]
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import UserDatabase  # noqa: E402
+from storage.journal import JournalStore  # noqa: E402
+
+
+def synthetic_users(count: int) -> dict:
+    now = datetime.now().isoformat()
+    return {
+        str(uid): {
+            'user_id': uid,
+            'username': f"user{uid}",
+            'first_name': f"User {uid}",
+            'wallet_balance': 0.0,
+            'wallet_transactions': [],
+            'joined_date': now,
+            'last_active': now
+        }
+        for uid in range(1, count + 1)
+    }
+
+
+def bench_journal(count: int, mutations: int) -> float:
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "users.json")
+        JournalStore(db_file).compact(synthetic_users(count), seq=0)
+        db = UserDatabase(db_file)
+        start = time.perf_counter()
+        for i in range(mutations):
+            uid = (i * 7919) % count + 1
+            if i % 2:
+                db.update_wallet_balance(uid, 1.0, "bench")
+            else:
+                db.add_user(uid, f"user{uid}", f"User {uid}")
+        elapsed = time.perf_counter() - start
+        db.close()
+    return elapsed / mutations
+
+
+def bench_full_rewrite(count: int, mutations: int) -> float:
+    users = synthetic_users(count)
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "users.json")
+        start = time.perf_counter()
+        for _ in range(mutations):
+            with open(db_file, 'w') as f:
+                json.dump(users, f, indent=2, default=str)
+        elapsed = time.perf_counter() - start
+    return elapsed / mutations
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000")
+    parser.add_argument("--mutations", type=int, default=5000)
+    parser.add_argument("--rewrite-limit", type=int, default=100000,
+                        help="skip the full-rewrite baseline above this many users")
+    args = parser.parse_args()
+
+    print(f"{'users':>10} {'journal us/op':>15} {'rewrite us/op':>15}")
+    for count in (int(s) for s in args.sizes.split(",")):
+        journal_cost = bench_journal(count, args.mutations) * 1e6
+        if count <= args.rewrite_limit:
+            rewrite_cost = f"{bench_full_rewrite(count, 5) * 1e6:15.1f}"
+        else:
+            rewrite_cost = f"{'skipped':>15}"
+        print(f"{count:>10} {journal_cost:15.1f} {rewrite_cost}")
+
+
+if __name__ == "__main__":
+    main()
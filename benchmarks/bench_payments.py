@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Benchmark: the payment handlers under N concurrent users against a fake Xendit.
+
+benchmarks/fake_xendit.py serves invoices and disbursements with the given
+latency and faults and pays every invoice `--pay-after` seconds later by
+calling the bot's /xendit/callback route, served on the benchmark's event
+loop the way main.py serves it. Each simulated user then goes through, `--rounds` times:
+
+  deposit   WalletHandler.handle_wallet_deposit  (/wallet_deposit <amount>)
+  topup     MessageHandler.handle_topup, then the amount as a text message
+            (alternating payment link and QRPH)
+  withdraw  WalletHandler.handle_wallet_withdraw (/wallet_withdraw <amount> ...);
+            the registered handler debits the wallet and does not call Xendit
+
+The bot's own modules run unchanged on a throwaway JSON database, so the
+Xendit client's budgets, retries, breaker and in-flight limit (XENDIT_*
+environment variables) and the invoice registry all take part. Handler
+throughput and latency percentiles are reported per step; a step fails
+when the user is shown an error.
+
+    python benchmarks/bench_payments.py [--users 50] [--rounds 3] [--latency-ms 150]
+        [--error-rate 0.02] [--throttle-rate 0.02] [--rate-limit 0] [--pay-after 0.5]
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import secrets
+import tempfile
+import time
+from collections import Counter, defaultdict
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_telegram import FakeBot  # noqa: E402
+from benchmarks.fake_xendit import FakeXendit  # noqa: E402
+
+CALLBACK_TOKEN = "bench-callback-token"
+OPENING_BALANCE = 1000.0
+
+
+class FakeMessage:
+    def __init__(self, text: str):
+        self.text = text
+        self.replies = []
+
+    async def reply_text(self, text: str, **kwargs):
+        self.replies.append(text)
+
+
+class FakeSession:
+    """One simulated user: the Update and CallbackContext attributes the handlers read"""
+
+    def __init__(self, user_id: int, bot):
+        from telegram import User
+        self.user = User(id=user_id, first_name=f"User{user_id}", is_bot=False, username=f"user{user_id}",
+                         language_code="en")
+        self.bot = bot
+        self.user_data = {}
+        self.failed = False
+
+    async def send(self, handler, text: str, args=None):
+        message = FakeMessage(text)
+        update = SimpleNamespace(effective_user=self.user, message=message)
+        context = SimpleNamespace(args=args or [], user_data=self.user_data, bot=self.bot, bot_data={})
+        await handler(update, context)
+        if any(reply.startswith("❌") or "Failed" in reply for reply in message.replies):
+            self.failed = True
+
+
+def percentile(values, fraction: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+
+async def serve_callbacks(settler):
+    """Serve the bot's webhook app (and its /xendit/callback route) on this event loop, as main.py does"""
+    import uvicorn
+    from utils.webhook import CALLBACK_PATH, WebhookApp
+    application = SimpleNamespace(bot=None, bot_data={'payments': settler})
+    server = uvicorn.Server(uvicorn.Config(WebhookApp(application, secrets.token_urlsafe()), host='127.0.0.1',
+                                           port=0, lifespan='off', log_level='error'))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return f"http://127.0.0.1:{port}{CALLBACK_PATH}", server, task
+
+
+async def run(args):
+    fake = FakeXendit(args.latency_ms, args.jitter_ms, args.error_rate, args.throttle_rate, args.rate_limit,
+                      callback_token=CALLBACK_TOKEN, pay_after=args.pay_after, seed=1)
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    os.environ.update(XENDIT_BASE_URL=fake.start(), XENDIT_SECRET_KEY="xnd_development_bench",
+                      XENDIT_CALLBACK_TOKEN=CALLBACK_TOKEN, JSON_DB_FILE=os.path.join(workdir, "users.json"))
+
+    # Imported only now: configuration and the shared database are read at import time
+    from database import get_database
+    from handlers.message_handler import MessageHandler
+    from handlers.wallet_handler import WalletHandler
+    from utils.invoices import get_invoice_registry
+    from utils.payments import InvoiceSettler
+    from utils.xendit_api import get_xendit_client
+
+    settled = Counter()
+
+    class CountingSettler(InvoiceSettler):
+        async def handle_invoice(self, payload):
+            status = await super().handle_invoice(payload)
+            settled[status] += 1
+            return status
+
+    db = get_database()
+    await db.start()
+    bot = FakeBot(global_limit=10 ** 6, per_chat_interval=0, latency_ms=args.telegram_latency_ms, jitter_ms=0)
+    settler = CountingSettler(db, bot, get_invoice_registry())
+    fake.callback_url, callback_server, serving = await serve_callbacks(settler)
+    client = get_xendit_client()
+    await client.start()
+
+    sessions = [FakeSession(100000 + i, bot) for i in range(args.users)]
+    for session in sessions:
+        db.add_user(session.user.id, session.user.username, session.user.first_name, "en")
+        db.update_wallet_balance(session.user.id, OPENING_BALANCE, "bench", "Opening balance")
+    await db.commit()
+
+    latencies = defaultdict(list)
+    failures = Counter()
+
+    async def step(name: str, session: FakeSession, *messages):
+        session.failed = False
+        start = time.perf_counter()
+        for handler, text, handler_args in messages:
+            await session.send(handler, text, handler_args)
+        latencies[name].append((time.perf_counter() - start) * 1000)
+        failures[name] += session.failed
+
+    async def user(session: FakeSession):
+        for round_no in range(args.rounds):
+            amount = 100 + round_no
+            await step("deposit", session,
+                       (WalletHandler.handle_wallet_deposit, f"/wallet_deposit {amount}", [str(amount)]))
+            if round_no % 2:
+                session.user_data['topup_method'] = 'qrph'
+            await step("topup", session,
+                       (MessageHandler.handle_topup, "/topup", None),
+                       (MessageHandler.handle_text_message, str(amount + 100), None))
+            await step("withdraw", session,
+                       (WalletHandler.handle_wallet_withdraw, "/wallet_withdraw 10 BCA 1234567890 Bench User",
+                        ["10", "BCA", "1234567890", "Bench", "User"]))
+
+    print(f"{args.users} users x {args.rounds} rounds, fake Xendit latency {args.latency_ms:g} ms, "
+          f"errors {args.error_rate:.0%}, 429s {args.throttle_rate:.0%}"
+          + (f", rate limit {args.rate_limit}/s" if args.rate_limit else ""))
+    start = time.perf_counter()
+    await asyncio.gather(*(user(session) for session in sessions))
+    elapsed = time.perf_counter() - start
+    # Let the last invoices get paid and their callbacks settle
+    await asyncio.sleep((args.pay_after or 0) + args.latency_ms / 1000 + 1)
+
+    print(f"\n{'step':<10}{'calls':>7}{'failed':>8}{'calls/s':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}")
+    for name, values in latencies.items():
+        values.sort()
+        print(f"{name:<10}{len(values):>7}{failures[name]:>8}{len(values) / elapsed:>9.1f}"
+              f"{percentile(values, 0.5):>9.1f}{percentile(values, 0.95):>9.1f}{percentile(values, 0.99):>9.1f}"
+              f"{values[-1]:>9.1f}")
+    total = sum(len(values) for values in latencies.values())
+    print(f"{'all':<10}{total:>7}{sum(failures.values()):>8}{total / elapsed:>9.1f}   in {elapsed:.1f} s")
+
+    print(f"\nfake Xendit: {dict(sorted(fake.counters.items()))}")
+    print(f"callbacks settled: {dict(settled)}")
+    print(f"invoice registry: {get_invoice_registry().stats()}")
+    print(f"xendit client: {client.stats()}")
+
+    await client.close()
+    await db.stop()
+    callback_server.should_exit = True
+    await serving
+    fake.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--latency-ms", type=float, default=150, help="fake Xendit latency")
+    parser.add_argument("--jitter-ms", type=float, default=50)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of Xendit calls failing with 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of Xendit calls failing with 429")
+    parser.add_argument("--rate-limit", type=int, default=0, help="Xendit requests per second before 429")
+    parser.add_argument("--pay-after", type=float, default=0.5, help="seconds until an invoice is paid")
+    parser.add_argument("--telegram-latency-ms", type=float, default=40, help="fake Bot API latency")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Benchmark: startup memory of one UserDatabase per handler module versus the
+single shared instance returned by get_database().
+
+    python benchmarks/bench_shared_db.py [--users 100000]
+"""
+
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+from storage.journal import JournalStore  # noqa: E402
+from benchmarks.bench_journal import synthetic_users  # noqa: E402
+
+HANDLER_MODULES = 4
+
+
+def measure(label: str, factory):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    instances = [factory() for _ in range(HANDLER_MODULES)]
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    distinct = len({id(db) for db in instances})
+    print(f"{label:<28} {distinct:>9} {current / 2**20:10.1f} MiB {elapsed:8.2f} s")
+    for db in instances:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "users.json")
+        JournalStore(db_file).compact(synthetic_users(args.users), seq=0)
+        os.chdir(tmp)
+
+        print(f"{'setup':<28} {'instances':>9} {'memory':>14} {'load':>10}")
+        measure("one per handler (before)", lambda: database.UserDatabase(db_file))
+        database._shared_db = None
+        measure("get_database() (after)", database.get_database)
+
+
+if __name__ == "__main__":
+    main()
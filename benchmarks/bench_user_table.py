@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Benchmark: memory held by the in-memory user map, dict-of-dicts vs UserTable.
+
+Builds the same synthetic users both ways under tracemalloc and reports the
+traced size plus the cost of a get_user()-style lookup on each.
+
+    python benchmarks/bench_user_table.py [--users 1000000]
+"""
+
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage.user_table import UserTable  # noqa: E402
+
+# A realistic share of users without a username, and repeated first names
+FIRST_NAMES = ["Alex", "Maria", "John", "Ana", "Jose", "Mark", "Anna", "Chris"]
+
+
+def synthetic_rows(count: int):
+    base = datetime(2025, 1, 1)
+    for uid in range(1, count + 1):
+        joined = base + timedelta(seconds=uid, microseconds=uid % 999983)
+        username = f"user{uid}" if uid % 4 else None
+        yield (100000000 + uid, username, FIRST_NAMES[uid % len(FIRST_NAMES)], (uid % 5000) / 4,
+               joined.isoformat(), (joined + timedelta(days=uid % 90)).isoformat())
+
+
+def build_dicts(count: int) -> dict:
+    # The representation UserDatabase used to hold: str(user_id) -> dict
+    users = {}
+    for user_id, username, first_name, balance, joined, last_active in synthetic_rows(count):
+        users[str(user_id)] = {
+            'user_id': user_id,
+            'username': username,
+            # json.load gives every record its own string objects
+            'first_name': "".join(first_name),
+            'wallet_balance': balance,
+            'joined_date': joined,
+            'last_active': last_active
+        }
+    return users
+
+
+def build_table(count: int) -> UserTable:
+    table = UserTable()
+    for row in synthetic_rows(count):
+        table.add(*row)
+    return table
+
+
+def measure(build, count: int):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    users = build(count)
+    elapsed = time.perf_counter() - start
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return users, current, elapsed
+
+
+def lookup_us(get, ids) -> float:
+    start = time.perf_counter()
+    for user_id in ids:
+        get(user_id)['wallet_balance']
+    return (time.perf_counter() - start) / len(ids) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=1000000)
+    parser.add_argument("--lookups", type=int, default=200000)
+    args = parser.parse_args()
+
+    ids = [100000000 + (i * 7919) % args.users + 1 for i in range(args.lookups)]
+    print(f"{'representation':<16}{'traced MiB':>12}{'bytes/user':>12}{'build s':>10}{'lookup µs':>11}")
+
+    users, size, elapsed = measure(build_dicts, args.users)
+    lookup = lookup_us(lambda user_id: users.get(str(user_id)), ids)
+    print(f"{'dict of dicts':<16}{size / 2**20:>12.1f}{size / args.users:>12.0f}{elapsed:>10.2f}{lookup:>11.2f}")
+    del users
+
+    table, size, elapsed = measure(build_table, args.users)
+    lookup = lookup_us(table.get, ids)
+    print(f"{'UserTable':<16}{size / 2**20:>12.1f}{size / args.users:>12.0f}{elapsed:>10.2f}{lookup:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
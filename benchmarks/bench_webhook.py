@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Benchmark: webhook ingestion through Flask in a WSGI thread vs WebhookApp on the bot's loop.
+
+Both servers receive the same Telegram update JSON and put it on the
+Application's update_queue, where a consumer on the event loop counts it:
+
+  flask thread hop  the old /telegram/webhook route, served by a threaded
+                    WSGI server the way a gunicorn gthread worker serves it.
+                    The old route called update_queue.put() from the worker
+                    thread without awaiting it, so no update ever reached the
+                    queue; here it hands the update to the loop with
+                    run_coroutine_threadsafe and waits, which is the working
+                    version of that design. Skipped when Flask is not installed.
+  asgi in-loop      utils.webhook.WebhookApp under uvicorn on the same event
+                    loop as the queue, checking the secret-token header.
+
+Load comes from a separate process with --concurrency keep-alive
+connections, so the client does not compete with the servers for the GIL.
+
+    python benchmarks/bench_webhook.py [--requests 5000] [--concurrency 50]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Update  # noqa: E402
+from telegram.ext import Application  # noqa: E402
+
+from utils.webhook import WEBHOOK_PATH, WebhookApp  # noqa: E402
+
+SECRET_TOKEN = "bench-secret-token"
+
+
+def sample_update(update_id: int) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': 1000 + update_id % 500, 'type': 'private', 'first_name': 'Bench'},
+            'from': {'id': 1000 + update_id % 500, 'is_bot': False, 'first_name': 'Bench', 'language_code': 'en'},
+            'text': f"hello {update_id}"
+        }
+    }
+
+
+def percentile(values, fraction: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def _read_response(reader: asyncio.StreamReader):
+    """Status code of one HTTP/1.1 response and whether the server keeps the connection open"""
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode('latin-1').split("\r\n")
+    headers = dict(line.lower().split(": ", 1) for line in lines[1:] if ": " in line)
+    await reader.readexactly(int(headers.get('content-length', 0)))
+    return int(lines[0].split()[1]), headers.get('connection') != 'close' and not lines[0].startswith("HTTP/1.0")
+
+
+async def _load(url: str, requests: int, concurrency: int):
+    # A bare keep-alive HTTP/1.1 client: on a shared CPU a full client library
+    # would cost more than the servers being measured
+    url = httpx.URL(url)
+    requests_bytes = []
+    for i in range(requests):
+        body = json.dumps(sample_update(i)).encode()
+        requests_bytes.append(
+            f"POST {url.raw_path.decode()} HTTP/1.1\r\nHost: {url.host}:{url.port}\r\n"
+            f"Content-Type: application/json\r\nX-Telegram-Bot-Api-Secret-Token: {SECRET_TOKEN}\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+    latencies, statuses = [], {}
+    next_request = iter(range(requests))
+
+    async def worker():
+        reader = writer = None
+        for i in next_request:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(url.host, url.port)
+            start = time.perf_counter()
+            writer.write(requests_bytes[i])
+            status, keep_alive = await _read_response(reader)
+            latencies.append((time.perf_counter() - start) * 1000)
+            statuses[status] = statuses.get(status, 0) + 1
+            if not keep_alive:
+                writer.close()
+                writer = None
+        if writer is not None:
+            writer.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return latencies, elapsed, statuses
+
+
+def load_process(url: str, requests: int, concurrency: int, results):
+    results.put(asyncio.run(_load(url, requests, concurrency)))
+
+
+async def drive(url: str, requests: int, concurrency: int):
+    """Run the load generator in a child process without blocking this loop"""
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(target=load_process, args=(url, requests, concurrency, results))
+    process.start()
+    result = await asyncio.to_thread(results.get)
+    await asyncio.to_thread(process.join)
+    return result
+
+
+async def consume(application: Application, counter: SimpleNamespace):
+    while True:
+        await application.update_queue.get()
+        counter.received += 1
+
+
+def flask_app(application: Application, loop: asyncio.AbstractEventLoop):
+    from flask import Flask, jsonify, request
+    app = Flask(__name__)
+
+    @app.route(WEBHOOK_PATH, methods=['POST'])
+    def telegram_webhook():
+        update = Update.de_json(request.get_json(force=True), application.bot)
+        asyncio.run_coroutine_threadsafe(application.update_queue.put(update), loop).result()
+        return jsonify({'status': 'received'}), 200
+
+    return app
+
+
+async def serve_flask(application: Application):
+    from werkzeug.serving import make_server
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, flask_app(application, asyncio.get_running_loop()), threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}{WEBHOOK_PATH}", server.shutdown
+
+
+async def serve_asgi(application: Application):
+    import uvicorn
+    server = uvicorn.Server(uvicorn.Config(WebhookApp(application, SECRET_TOKEN), host='127.0.0.1', port=0,
+                                           lifespan='off', log_level='error'))
+    task = asyncio.create_task(server.serve())
+    while not server.started:
+        await asyncio.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+
+    async def stop():
+        server.should_exit = True
+        await task
+
+    return f"http://127.0.0.1:{port}{WEBHOOK_PATH}", stop
+
+
+async def run(args):
+    print(f"{args.requests} updates, concurrency {args.concurrency}")
+    print(f"{'server':<20}{'req/s':>9}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}{'queued':>9}  statuses")
+    setups = [("flask thread hop", serve_flask), ("asgi in-loop", serve_asgi)]
+    for name, serve in setups:
+        if serve is serve_flask:
+            try:
+                import flask  # noqa: F401
+            except ImportError:
+                print(f"{name:<20} skipped, Flask is not installed")
+                continue
+        application = Application.builder().token("123456:bench").updater(None).build()
+        counter = SimpleNamespace(received=0)
+        consumer = asyncio.create_task(consume(application, counter))
+        url, stop = await serve(application)
+        latencies, elapsed, statuses = await drive(url, args.requests, args.concurrency)
+        await asyncio.sleep(0.1)
+        result = stop()
+        if asyncio.iscoroutine(result):
+            await result
+        consumer.cancel()
+        print(f"{name:<20}{args.requests / elapsed:>9.0f}{percentile(latencies, 0.5):>9.2f}"
+              f"{percentile(latencies, 0.99):>9.2f}{latencies[-1]:>9.2f}{counter.received:>9}  {statuses}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
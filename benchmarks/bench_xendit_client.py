@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Benchmark: latency of Xendit calls with a client per call vs the pooled XenditClient.
+
+A local mock of POST /v2/invoices runs in a background thread (over TLS with
+a throwaway self-signed certificate when the openssl CLI is available). The
+same invoices are then created the way create_invoice used to (a new
+httpx.AsyncClient and auth header per call) and through one XenditClient,
+and p50/p99 latencies are reported for each.
+
+    python benchmarks/bench_xendit_client.py [--requests 300] [--concurrency 1] [--latency-ms 5] [--no-tls]
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import certifi
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.xendit_api import XenditClient  # noqa: E402
+
+SECRET_KEY = "xnd_development_benchmark"
+
+
+class MockXendit(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; without this, Nagle and delayed ACKs add ~40 ms
+    disable_nagle_algorithm = True
+    latency = 0.0
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(self.latency)
+        payload = json.dumps({
+            'id': f"inv_{body['external_id']}",
+            'external_id': body['external_id'],
+            'amount': body['amount'],
+            'status': 'PENDING',
+            'invoice_url': f"https://checkout.xendit.co/web/{body['external_id']}"
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def self_signed_cert(directory: str):
+    cert, key = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                    '-subj', '/CN=localhost', '-addext', 'subjectAltName=IP:127.0.0.1',
+                    '-keyout', key, '-out', cert], check=True, capture_output=True)
+    return cert, key
+
+
+def start_server(latency_ms: float, tls_dir: str = None):
+    MockXendit.latency = latency_ms / 1000
+    server = ThreadingHTTPServer(('127.0.0.1', 0), MockXendit)
+    server.daemon_threads = True
+    scheme, cafile = 'http', None
+    if tls_dir:
+        cafile, key = self_signed_cert(tls_dir)
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(cafile, key)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+        scheme = 'https'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"{scheme}://127.0.0.1:{server.server_address[1]}", cafile
+
+
+def verify_context(cafile: str = None) -> ssl.SSLContext:
+    """httpx's default trust store (certifi), plus the mock server's certificate"""
+    context = ssl.create_default_context(cafile=certifi.where())
+    if cafile:
+        context.load_verify_locations(cafile)
+    return context
+
+
+async def per_call_invoice(base_url: str, cafile: str, amount: int, user_id: int):
+    # What utils.xendit_api.create_invoice used to do on every call, including
+    # loading the CA bundle for a fresh AsyncClient
+    encoded = base64.b64encode(f"{os.environ['XENDIT_SECRET_KEY']}:".encode()).decode()
+    headers = {"Authorization": f"Basic {encoded}", "Content-Type": "application/json"}
+    data = {"external_id": f"telegram_{user_id}_{amount}", "amount": amount,
+            "description": f"Top up for Telegram user {user_id}"}
+    async with httpx.AsyncClient(verify=verify_context(cafile)) as client:
+        response = await client.post(f"{base_url}/v2/invoices", json=data, headers=headers)
+        response.raise_for_status()
+        return response.json()
+
+
+async def measure(call, requests: int, concurrency: int):
+    latencies = []
+    queue = asyncio.Queue()
+    for i in range(requests):
+        queue.put_nowait(i)
+
+    async def worker():
+        while not queue.empty():
+            i = queue.get_nowait()
+            start = time.perf_counter()
+            result = await call(100 + i, 1000 + i)
+            latencies.append((time.perf_counter() - start) * 1000)
+            assert 'invoice_url' in result, result
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return latencies, requests / elapsed
+
+
+def percentile(values, fraction: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run(args):
+    os.environ['XENDIT_SECRET_KEY'] = SECRET_KEY
+    tls_dir = tempfile.mkdtemp() if args.tls else None
+    try:
+        server, base_url, cafile = start_server(args.latency_ms, tls_dir)
+        print(f"mock server {base_url}, {args.requests} requests, concurrency {args.concurrency}, "
+              f"server latency {args.latency_ms} ms")
+        print(f"{'client':<22}{'p50 ms':>9}{'p99 ms':>9}{'max ms':>9}{'req/s':>9}")
+
+        async def before(amount, user_id):
+            return await per_call_invoice(base_url, cafile, amount, user_id)
+
+        client = XenditClient(SECRET_KEY, base_url=base_url, verify=verify_context(cafile))
+        await client.start()
+        for name, call in (("client per call", before), ("pooled XenditClient", client.create_invoice)):
+            await call(1, 1)  # warm-up
+            latencies, throughput = await measure(call, args.requests, args.concurrency)
+            print(f"{name:<22}{percentile(latencies, 0.5):>9.2f}{percentile(latencies, 0.99):>9.2f}"
+                  f"{latencies[-1]:>9.2f}{throughput:>9.1f}")
+        await client.close()
+        server.shutdown()
+    finally:
+        if tls_dir:
+            shutil.rmtree(tls_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--latency-ms", type=float, default=5.0)
+    parser.add_argument("--no-tls", dest="tls", action="store_false",
+                        help="plain HTTP (TLS is used when the openssl CLI is available)")
+    args = parser.parse_args()
+    if args.tls and shutil.which('openssl') is None:
+        print("openssl not found, benchmarking over plain HTTP")
+        args.tls = False
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
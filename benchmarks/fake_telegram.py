@@ -0,0 +1,95 @@
+"""
+Local stand-ins for the Telegram Bot API used by the benchmarks.
+
+FakeBot implements the send methods the bot uses with a simulated network
+latency and enforces the Bot API flood limits the way Telegram reports
+them: a request over the global or per-chat limit fails with RetryAfter.
+
+FakeBotAPI sits one level lower, as the request object of a real Bot, so
+a whole Application can be initialized and run without a network: getMe
+answers locally and every other method succeeds after the latency.
+"""
+
+import asyncio
+import json
+import random
+import time
+from collections import Counter, deque
+from typing import Dict, Iterable
+
+from telegram.error import Forbidden, RetryAfter
+from telegram.request import BaseRequest
+
+
+class FakeBot:
+    def __init__(self, global_limit: int = 30, per_chat_interval: float = 1.0, latency_ms: float = 60,
+                 jitter_ms: float = 30, retry_after: int = 1, blocked: Iterable[int] = ()):
+        self.global_limit = global_limit
+        self.per_chat_interval = per_chat_interval
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.retry_after = retry_after
+        self.blocked = set(blocked)
+        self.delivered = 0
+        self.flood_errors = 0
+        self._window: deque = deque()
+        self._last_per_chat: Dict[int, float] = {}
+
+    async def _request(self, chat_id: int):
+        # Half the latency on the way in, half on the way out
+        await asyncio.sleep((self.latency + random.uniform(-self.jitter, self.jitter)) / 2)
+        now = time.monotonic()
+        while self._window and now - self._window[0] >= 1.0:
+            self._window.popleft()
+        last = self._last_per_chat.get(chat_id)
+        if len(self._window) >= self.global_limit or (last is not None and now - last < self.per_chat_interval):
+            self.flood_errors += 1
+            raise RetryAfter(self.retry_after)
+        self._window.append(now)
+        self._last_per_chat[chat_id] = now
+        if chat_id in self.blocked:
+            raise Forbidden("Forbidden: bot was blocked by the user")
+        self.delivered += 1
+        await asyncio.sleep((self.latency + random.uniform(-self.jitter, self.jitter)) / 2)
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        await self._request(chat_id)
+
+    async def send_photo(self, chat_id: int, photo, **kwargs):
+        await self._request(chat_id)
+
+
+class FakeBotAPI(BaseRequest):
+    def __init__(self, latency_ms: float = 40, jitter_ms: float = 10):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.calls = Counter()
+        self._message_id = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url: str, method: str, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] += 1
+        if endpoint == 'getMe':
+            result = {'id': 123456, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        else:
+            await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+            parameters = request_data.parameters if request_data else {}
+            if endpoint.startswith('send'):
+                self._message_id += 1
+                result = {'message_id': self._message_id, 'date': int(time.time()),
+                          'chat': {'id': parameters.get('chat_id', 0), 'type': 'private'},
+                          'text': parameters.get('text') or parameters.get('caption') or ''}
+            else:
+                result = True
+        return 200, json.dumps({'ok': True, 'result': result}).encode()
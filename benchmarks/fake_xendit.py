@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Xendit API used by the payment benchmarks.
+
+FakeXendit serves the endpoints the bot calls (invoices, QR codes and
+disbursements) from a thread, with a simulated latency and optional fault
+injection: a share of requests fails with 500, a share is throttled with
+429 and Retry-After, and requests over a per-second limit are throttled
+the way Xendit's rate limiter does. Invoices are paid after `pay_after`
+seconds (or on POST /simulate/invoices/<id>/pay) and disbursements
+complete after the same delay; each sends the callback Xendit would, with
+the X-CALLBACK-TOKEN header, to the configured URL.
+
+Run it on its own to point a bot at it without Xendit credentials:
+
+    python benchmarks/fake_xendit.py --port 8900 --latency-ms 150 --error-rate 0.02 \\
+        --callback-url http://127.0.0.1:8080/xendit/callback --callback-token secret
+    XENDIT_BASE_URL=http://127.0.0.1:8900 XENDIT_SECRET_KEY=xnd_development_fake \\
+        XENDIT_CALLBACK_TOKEN=secret python main.py
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import urllib.request
+import uuid
+from collections import Counter, deque
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+
+def _now() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+def _iso(moment: datetime) -> str:
+    return moment.isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+
+
+class FakeXendit:
+    def __init__(self, latency_ms: float = 100, jitter_ms: float = 30, error_rate: float = 0.0,
+                 throttle_rate: float = 0.0, rate_limit: int = 0, retry_after: int = 1,
+                 callback_url: Optional[str] = None, disbursement_callback_url: Optional[str] = None,
+                 callback_token: str = "", pay_after: Optional[float] = None, seed: Optional[int] = None):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.callback_url = callback_url
+        self.disbursement_callback_url = disbursement_callback_url
+        self.callback_token = callback_token
+        self.pay_after = pay_after
+        self.invoices: Dict[str, Dict] = {}
+        self.qr_codes: Dict[str, Dict] = {}
+        self.disbursements: Dict[str, Dict] = {}
+        self.counters = Counter()
+        self._idempotency: Dict[str, str] = {}
+        self._window: deque = deque()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._count_lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        """Serve from a background thread and return the base URL"""
+        handler = type('FakeXenditHandler', (_Handler,), {'fake': self})
+        self._server = ThreadingHTTPServer((host, port), handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return f"http://{host}:{self._server.server_address[1]}"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def count(self, name: str):
+        with self._count_lock:
+            self.counters[name] += 1
+
+    # --- fault injection ---
+
+    def fault(self) -> Optional[int]:
+        """The status a request should fail with, or None to serve it"""
+        with self._lock:
+            now = time.monotonic()
+            while self._window and now - self._window[0] >= 1.0:
+                self._window.popleft()
+            if self.rate_limit and len(self._window) >= self.rate_limit:
+                return 429
+            self._window.append(now)
+            roll = self._random.random()
+        if roll < self.throttle_rate:
+            return 429
+        if roll < self.throttle_rate + self.error_rate:
+            return 500
+        return None
+
+    def delay(self):
+        time.sleep(max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter)))
+
+    # --- resources ---
+
+    def create_invoice(self, body: Dict, base_url: str) -> Dict:
+        invoice_id = uuid.uuid4().hex[:24]
+        created = _now()
+        invoice = {
+            'id': invoice_id,
+            'external_id': body['external_id'],
+            'user_id': 'fake-business',
+            'status': 'PENDING',
+            'merchant_name': 'Fake Xendit',
+            'amount': body['amount'],
+            'description': body.get('description'),
+            'currency': 'PHP',
+            'created': _iso(created),
+            'expiry_date': _iso(created + timedelta(seconds=body.get('invoice_duration', 86400))),
+            'invoice_url': f"{base_url}/web/{invoice_id}",
+            # What the bot shows for QRPH top-ups
+            'qr_code_url': f"{base_url}/qr/{invoice_id}.png"
+        }
+        with self._lock:
+            self.invoices[invoice_id] = invoice
+        self._schedule(self.pay, invoice_id)
+        return dict(invoice)
+
+    def create_qr_code(self, body: Dict) -> Dict:
+        qr_id = f"qr_{uuid.uuid4()}"
+        created = _iso(_now())
+        qr = {
+            'id': qr_id,
+            'external_id': body.get('external_id') or body.get('reference_id'),
+            'amount': body.get('amount'),
+            'qr_string': f"00020101021226{uuid.uuid4().hex}5303608",
+            'callback_url': body.get('callback_url'),
+            'type': body.get('type', 'DYNAMIC'),
+            'status': 'ACTIVE',
+            'created': created,
+            'updated': created
+        }
+        with self._lock:
+            self.qr_codes[qr_id] = qr
+        return qr
+
+    def create_disbursement(self, body: Dict, idempotency_key: Optional[str]) -> Dict:
+        with self._lock:
+            # A repeated idempotency key gets the disbursement it created the first time
+            if idempotency_key and idempotency_key in self._idempotency:
+                self.count('idempotent_replays')
+                return dict(self.disbursements[self._idempotency[idempotency_key]])
+            disbursement_id = uuid.uuid4().hex[:24]
+            disbursement = {
+                'id': disbursement_id,
+                'user_id': 'fake-business',
+                'external_id': body['external_id'],
+                'amount': body['amount'],
+                'bank_code': body.get('bank_code'),
+                'account_holder_name': body.get('account_holder_name'),
+                'disbursement_description': body.get('description'),
+                'status': 'PENDING'
+            }
+            self.disbursements[disbursement_id] = disbursement
+            if idempotency_key:
+                self._idempotency[idempotency_key] = disbursement_id
+        self._schedule(self.complete_disbursement, disbursement_id)
+        return dict(disbursement)
+
+    def pay(self, invoice_id: str) -> Optional[Dict]:
+        """Mark an invoice paid and send its callback"""
+        with self._lock:
+            invoice = self.invoices.get(invoice_id)
+            if invoice is None or invoice['status'] != 'PENDING':
+                return dict(invoice) if invoice else None
+            invoice.update(status='PAID', paid_amount=invoice['amount'], paid_at=_iso(_now()),
+                           payment_method='QR_CODE', payment_channel='QRPH')
+            payload = dict(invoice)
+        self._callback(self.callback_url, payload, 'invoice_callbacks')
+        return payload
+
+    def complete_disbursement(self, disbursement_id: str):
+        with self._lock:
+            disbursement = self.disbursements[disbursement_id]
+            disbursement['status'] = 'COMPLETED'
+            payload = dict(disbursement, is_instant=True, updated=_iso(_now()))
+        self._callback(self.disbursement_callback_url, payload, 'disbursement_callbacks')
+
+    def _schedule(self, action, resource_id: str):
+        if self.pay_after is not None:
+            timer = threading.Timer(self.pay_after, action, (resource_id,))
+            timer.daemon = True
+            timer.start()
+
+    def _callback(self, url: Optional[str], payload: Dict, counter: str):
+        if not url:
+            return
+        request = urllib.request.Request(url, data=json.dumps(payload).encode(), method='POST', headers={
+            'Content-Type': 'application/json', 'X-CALLBACK-TOKEN': self.callback_token})
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                response.read()
+            self.count(counter)
+        except Exception:
+            # Xendit retries failed callbacks; the fake only counts them
+            self.count(f'{counter}_failed')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    fake: FakeXendit
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        path = self.path.rstrip('/')
+
+        if path.startswith('/simulate/invoices/') and path.endswith('/pay'):
+            invoice = self.fake.pay(path.split('/')[3])
+            return self._send(200, invoice) if invoice else self._error(404, 'INVOICE_NOT_FOUND_ERROR')
+        if not self.headers.get('Authorization', '').startswith('Basic '):
+            return self._error(401, 'INVALID_API_KEY')
+        if path not in ('/v2/invoices', '/qr_codes', '/disbursements'):
+            return self._error(404, 'NOT_FOUND')
+
+        self.fake.delay()
+        self.fake.count('requests')
+        status = self.fake.fault()
+        if status == 429:
+            self.fake.count('throttled')
+            return self._error(429, 'RATE_LIMIT_EXCEEDED', {'Retry-After': str(self.fake.retry_after)})
+        if status == 500:
+            self.fake.count('server_errors')
+            return self._error(500, 'SERVER_ERROR')
+        if path == '/v2/invoices':
+            self.fake.count('invoices')
+            host = self.headers.get('Host', f"127.0.0.1:{self.server.server_address[1]}")
+            return self._send(200, self.fake.create_invoice(body, f"http://{host}"))
+        if path == '/qr_codes':
+            self.fake.count('qr_codes')
+            return self._send(201, self.fake.create_qr_code(body))
+        self.fake.count('disbursements')
+        return self._send(200, self.fake.create_disbursement(body, self.headers.get('X-IDEMPOTENCY-KEY')))
+
+    def do_GET(self):
+        path = self.path.rstrip('/')
+        if path.startswith('/v2/invoices/'):
+            invoice = self.fake.invoices.get(path.split('/')[3])
+            return self._send(200, invoice) if invoice else self._error(404, 'INVOICE_NOT_FOUND_ERROR')
+        return self._error(404, 'NOT_FOUND')
+
+    def _error(self, status: int, code: str, headers: Optional[Dict] = None):
+        self._send(status, {'error_code': code, 'message': code.replace('_', ' ').capitalize()}, headers)
+
+    def _send(self, status: int, payload: Dict, headers: Optional[Dict] = None):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency-ms", type=float, default=100)
+    parser.add_argument("--jitter-ms", type=float, default=30)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--rate-limit", type=int, default=0, help="requests per second before 429 (0: none)")
+    parser.add_argument("--callback-url", help="where invoice callbacks are sent")
+    parser.add_argument("--disbursement-callback-url", help="where disbursement callbacks are sent")
+    parser.add_argument("--callback-token", default="")
+    parser.add_argument("--pay-after", type=float, default=5.0,
+                        help="seconds until invoices are paid and disbursements complete (negative: never)")
+    args = parser.parse_args()
+
+    fake = FakeXendit(args.latency_ms, args.jitter_ms, args.error_rate, args.throttle_rate, args.rate_limit,
+                      callback_url=args.callback_url, disbursement_callback_url=args.disbursement_callback_url,
+                      callback_token=args.callback_token, pay_after=args.pay_after if args.pay_after >= 0 else None)
+    print(f"fake Xendit on {fake.start(args.host, args.port)}, Ctrl-C to stop")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        fake.stop()
+        print(dict(fake.counters))
+
+
+if __name__ == "__main__":
+    main()
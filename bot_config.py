@@ -1,5 +1,17 @@
 import os
-from typing import List
+from typing import List, Optional
+
+
+def shard_file(path: str, shard: Optional[int]) -> str:
+    """A shard's own copy of a data file or directory: users.json -> users.shard2.json"""
+    if shard is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard}{ext}"
+
+
+# Set by the sharding dispatcher on each worker process it starts
+_SHARD_INDEX = int(os.environ["SHARD_INDEX"]) if os.environ.get("SHARD_INDEX") else None
 
 class BotConfig:
     """Configuration class for the Telegram bot"""
@@ -7,8 +19,58 @@ class BotConfig:
     # Bot token - loaded from environment variable
     BOT_TOKEN = os.environ.get("BOT_TOKEN")
 
+    # Webhook: public URL of /telegram/webhook (polling when unset), listen address, and the secret
+    # Telegram echoes in X-Telegram-Bot-Api-Secret-Token (random per start when unset)
+    WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+    WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+    PORT = int(os.environ.get("PORT", "5000"))
+    WEBHOOK_SECRET_TOKEN = os.environ.get("WEBHOOK_SECRET_TOKEN")
+    # Bearer token Prometheus must send to read /metrics; unset leaves the endpoint open
+    METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+    # Update queue: depth, share of it low-priority updates may fill, and whether the excess is
+    # dropped ("drop") or refused with 503 so Telegram redelivers it ("defer")
+    UPDATE_QUEUE_SIZE = int(os.environ.get("UPDATE_QUEUE_SIZE", "1000"))
+    UPDATE_QUEUE_SHED_AT = float(os.environ.get("UPDATE_QUEUE_SHED_AT", "0.8"))
+    UPDATE_QUEUE_SHED_POLICY = os.environ.get("UPDATE_QUEUE_SHED_POLICY", "defer").lower()
+    # Webhook redeliveries: how many recent update_ids are remembered to drop duplicates, and the
+    # file keeping the highest one across restarts ("" to not keep it)
+    UPDATE_DEDUP_WINDOW = int(os.environ.get("UPDATE_DEDUP_WINDOW", "10000"))
+    UPDATE_DEDUP_FILE = os.environ.get("UPDATE_DEDUP_FILE", "update_ids.json")
+    # Updates handled at the same time; each user's updates still run one after another
+    UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", "16"))
+    # Multi-process mode (`python -m utils.sharding`): SHARDS workers, each owning the users with
+    # user_id % SHARDS == SHARD_INDEX and its own data files, talking over Unix sockets in SHARD_SOCKET_DIR
+    SHARDS = int(os.environ.get("SHARDS", "1"))
+    SHARD_INDEX = _SHARD_INDEX
+    SHARD_SOCKET_DIR = os.environ.get("SHARD_SOCKET_DIR", "shards")
+    # Seconds to wait for another shard to answer
+    SHARD_CALL_TIMEOUT = float(os.environ.get("SHARD_CALL_TIMEOUT", "10"))
+
     # Xendit API key - loaded from environment variable
     XENDIT_API_KEY = os.environ.get("XENDIT_API_KEY")
+    # Xendit HTTP client: one keep-alive pool for the bot's lifetime (HTTP/2 needs the h2 package)
+    XENDIT_BASE_URL = os.environ.get("XENDIT_BASE_URL", "https://api.xendit.co")
+    XENDIT_HTTP2 = os.environ.get("XENDIT_HTTP2", "false").lower() == "true"
+    XENDIT_CONNECT_TIMEOUT = float(os.environ.get("XENDIT_CONNECT_TIMEOUT", "5"))
+    XENDIT_READ_TIMEOUT = float(os.environ.get("XENDIT_READ_TIMEOUT", "20"))
+    XENDIT_MAX_CONNECTIONS = int(os.environ.get("XENDIT_MAX_CONNECTIONS", "20"))
+    # Latency budget per call (seconds, retries included), retries for idempotent calls and calls in flight
+    XENDIT_INVOICE_TIMEOUT = float(os.environ.get("XENDIT_INVOICE_TIMEOUT", "10"))
+    XENDIT_DISBURSEMENT_TIMEOUT = float(os.environ.get("XENDIT_DISBURSEMENT_TIMEOUT", "20"))
+    XENDIT_MAX_RETRIES = int(os.environ.get("XENDIT_MAX_RETRIES", "2"))
+    XENDIT_MAX_IN_FLIGHT = int(os.environ.get("XENDIT_MAX_IN_FLIGHT", "10"))
+    # Circuit breaker: open at this failure rate over recent calls, probe again after the cooldown
+    XENDIT_BREAKER_THRESHOLD = float(os.environ.get("XENDIT_BREAKER_THRESHOLD", "0.5"))
+    XENDIT_BREAKER_COOLDOWN = float(os.environ.get("XENDIT_BREAKER_COOLDOWN", "30"))
+    # Token Xendit sends in the X-CALLBACK-TOKEN header of invoice callbacks
+    XENDIT_CALLBACK_TOKEN = os.environ.get("XENDIT_CALLBACK_TOKEN")
+    # Open invoices are reused for repeat top-ups until they expire (seconds), and swept every N seconds
+    INVOICE_TTL = int(os.environ.get("INVOICE_TTL", "3600"))
+    INVOICE_SWEEP_INTERVAL = int(os.environ.get("INVOICE_SWEEP_INTERVAL", "300"))
+    # Days a settled invoice id is remembered; callbacks for invoices created earlier are not credited
+    SETTLED_INVOICE_RETENTION_DAYS = int(os.environ.get("SETTLED_INVOICE_RETENTION_DAYS", "90"))
+    # Share of each top-up and withdrawal kept as a fee
+    FEE_PERCENT = float(os.environ.get("FEE_PERCENT", "0.02"))
     
     # Admin user IDs - replace with actual admin user IDs
     ADMIN_USER_IDS: List[int] = [8209675920]
@@ -19,6 +81,35 @@ class BotConfig:
     ENABLE_LOGGING = True
     LOG_LEVEL = "INFO"
     
+    # Database settings - "json" (users.json + journal) or "sqlite"; each shard has its own files
+    DB_BACKEND = os.environ.get("DB_BACKEND", "json")
+    JSON_DB_FILE = shard_file(os.environ.get("JSON_DB_FILE", "users.json"), _SHARD_INDEX)
+    SQLITE_DB_FILE = shard_file(os.environ.get("SQLITE_DB_FILE", "users.db"), _SHARD_INDEX)
+    
+    # Write-behind: flush pending changes every N ms or every M changes
+    DB_FLUSH_INTERVAL_MS = int(os.environ.get("DB_FLUSH_INTERVAL_MS", "200"))
+    DB_FLUSH_MAX_BATCH = int(os.environ.get("DB_FLUSH_MAX_BATCH", "500"))
+    # Wait for wallet changes to reach disk before confirming them to the user
+    DB_DURABLE_WALLET = os.environ.get("DB_DURABLE_WALLET", "true").lower() == "true"
+    # Seconds between bulk writes of users' last_active times
+    ACTIVITY_FLUSH_INTERVAL = int(os.environ.get("ACTIVITY_FLUSH_INTERVAL", "60"))
+    
+    # Broadcast engine: Telegram allows ~30 messages/s per bot and ~1/s per chat
+    BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "30"))
+    BROADCAST_CONCURRENCY = int(os.environ.get("BROADCAST_CONCURRENCY", "16"))
+    BROADCAST_PER_CHAT_INTERVAL = float(os.environ.get("BROADCAST_PER_CHAT_INTERVAL", "1.0"))
+    BROADCAST_MAX_RETRIES = int(os.environ.get("BROADCAST_MAX_RETRIES", "3"))
+    # Broadcast jobs: where their state lives and how often progress is checkpointed
+    BROADCAST_JOBS_FILE = shard_file(os.environ.get("BROADCAST_JOBS_FILE", "broadcast_jobs.json"), _SHARD_INDEX)
+    BROADCAST_CHECKPOINT_INTERVAL = float(os.environ.get("BROADCAST_CHECKPOINT_INTERVAL", "2"))
+    BROADCAST_PAGE_SIZE = int(os.environ.get("BROADCAST_PAGE_SIZE", "500"))
+    # Seconds between status message edits, and where per-recipient results are written
+    BROADCAST_PROGRESS_INTERVAL = float(os.environ.get("BROADCAST_PROGRESS_INTERVAL", "5"))
+    BROADCAST_RESULTS_DIR = shard_file(os.environ.get("BROADCAST_RESULTS_DIR", "broadcast_results"), _SHARD_INDEX)
+    # Re-probing users marked unreachable: probe rate (msg/s) and default staleness in days
+    REPROBE_RATE = float(os.environ.get("REPROBE_RATE", "3"))
+    REPROBE_AFTER_DAYS = float(os.environ.get("REPROBE_AFTER_DAYS", "7"))
+    
     @classmethod
     def is_admin(cls, user_id: int) -> bool:
         """Check if user is an admin"""
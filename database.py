@@ -1,69 +1,301 @@
-import json
+import asyncio
 import os
-from typing import Dict, List, Optional
+import logging
+import time
+from typing import Callable, Dict, List, Mapping, Optional, Tuple
 from datetime import datetime
+from bot_config import BotConfig
+from storage.activity import ActivityTracker
+from storage.aggregates import WalletAggregates, bucket_labels
+from storage.audience import Audience
+from storage.journal import JournalStore
+from storage.ledger import WalletLedger
+from storage.reachability import REACHABLE, STATE_NAMES
+from storage.settled_invoices import SettledInvoices
+from storage.user_table import UserTable
+from storage.write_behind import WriteBehindQueue
+from utils.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
 
 class UserDatabase:
-    """Simple JSON-based user database for storing user data and wallets"""
+    """JSON-based user database for storing user data and wallets.
+
+    users.json is a periodic snapshot; every mutation in between is appended
+    to a journal (users.json.journal) and replayed on startup. Wallet
+    transactions live in a separate ledger (users_ledger/), and settled
+    Xendit invoice ids in users_invoices.log, so user records only carry
+    the current balance. In memory users are held in a columnar
+    UserTable keyed by integer id; get_user() returns dict-compatible views.
+    """
     
-    def __init__(self, db_file: str = "users.json"):
+    def __init__(self, db_file: str = "users.json", journal_file: str = None, ledger_dir: str = None):
         self.db_file = db_file
+        self.journal = JournalStore(db_file, journal_file)
+        self.ledger = WalletLedger(ledger_dir or f"{os.path.splitext(db_file)[0]}_ledger")
+        self.aggregates: Optional[WalletAggregates] = None
+        # Xendit invoices already credited, so each invoice pays out once
+        self.settled_invoices = SettledInvoices(f"{os.path.splitext(db_file)[0]}_invoices.log",
+                                                BotConfig.SETTLED_INVOICE_RETENTION_DAYS)
         self.users = self._load_database()
+        self.writer = WriteBehindQueue(
+            self.journal, self._snapshot, lambda: len(self.users),
+            flush_interval_ms=BotConfig.DB_FLUSH_INTERVAL_MS,
+            max_batch=BotConfig.DB_FLUSH_MAX_BATCH,
+            before_write=self.ledger.flush
+        )
+        self._write_behind = False
+        self.activity = ActivityTracker()
+        self._activity_task: Optional[asyncio.Task] = None
+    
+    def _load_database(self) -> UserTable:
+        """Stream the snapshot into a user table and replay the journal on top of it"""
+        users = UserTable()
+        # Transactions embedded in user records by older versions, by user id
+        legacy: Dict[int, List[Dict]] = {}
+        try:
+            for _, user in self.journal.stream_snapshot():
+                users.add(user['user_id'], user.get('username'), user.get('first_name'),
+                          user.get('wallet_balance', 0.0), user['joined_date'], user['last_active'],
+                          user.get('reachability', 'reachable'), user.get('reachability_checked'),
+                          user.get('language_code'))
+                if 'wallet_transactions' in user:
+                    legacy[user['user_id']] = user['wallet_transactions']
+        except ValueError:
+            logger.error(f"Snapshot {self.db_file} is unreadable, starting empty")
+            users, legacy = UserTable(), {}
+        checkpoint = self.journal.meta.get('aggregates')
+        if checkpoint:
+            self.aggregates = WalletAggregates.from_dict(checkpoint)
+        rewrite = self.settled_invoices.load(self.journal.meta.get('settled_invoices_size', 0))
+        # Kept in the snapshot metadata by older versions
+        for invoice_id, settled_at in self.journal.meta.get('settled_invoices', {}).items():
+            self.settled_invoices.add(invoice_id, settled_at)
+        for record in self.journal.replay():
+            self._apply_record(users, record, legacy)
+        if self.aggregates is None:
+            self.aggregates = WalletAggregates.recompute(users.balance_values())
+        
+        # Move transactions embedded by older versions into the ledger
+        for user_id, transactions in legacy.items():
+            if self.ledger.count(user_id) == 0:
+                for transaction in transactions:
+                    self.ledger.append(user_id, transaction)
+        if legacy:
+            self.ledger.flush()
+        if rewrite:
+            self.settled_invoices.rewrite()
+        if legacy or rewrite or 'settled_invoices' in self.journal.meta:
+            self.journal.compact(users, meta=self._meta())
+        return users
+    
+    def _apply_record(self, users: UserTable, record: Dict, legacy: Dict[int, List[Dict]]):
+        """Apply one journal record to the in-memory user table"""
+        user = users.get(record.get('user_id'))
+        if record['op'] == 'user':
+            if user is None:
+                users.add(record['user_id'], record['username'], record['first_name'], 0.0,
+                          record['joined_date'], record['last_active'],
+                          language_code=record.get('language_code'))
+                if self.aggregates is not None:
+                    self.aggregates.add_user(0.0)
+                return
+            for key in ('username', 'first_name', 'joined_date', 'last_active'):
+                user[key] = record[key]
+            user['language_code'] = record.get('language_code')
+        elif record['op'] == 'active':
+            for user_id, timestamp in record['ts']:
+                if user_id in users:
+                    users.set_last_active(user_id, timestamp)
+        elif record['op'] == 'reach':
+            for user_id, state, timestamp in record['items']:
+                if user_id in users:
+                    users.set_reachability(user_id, state, timestamp)
+        elif record['op'] in ('balance', 'tx') and user is not None:
+            if record['op'] == 'balance':
+                new_balance = record['balance']
+            else:
+                # Written by versions that kept transactions inside users.json
+                new_balance = record['tx']['new_balance']
+                legacy.setdefault(record['user_id'], []).append(record['tx'])
+            if self.aggregates is not None:
+                self.aggregates.update_balance(user['wallet_balance'], new_balance)
+            user['wallet_balance'] = new_balance
+            if 'invoice' in record:
+                self.settled_invoices.add(record['invoice'], record['ts'])
     
-    def _load_database(self) -> Dict:
-        """Load database from JSON file"""
-        if os.path.exists(self.db_file):
-            try:
-                with open(self.db_file, 'r') as f:
-                    return json.load(f)
-            except (json.JSONDecodeError, FileNotFoundError):
-                return {}
-        return {}
+    def _append(self, record: Dict):
+        """Persist one mutation record.
+
+        With write-behind running the record is queued for the next group
+        commit; otherwise it is appended right away.
+        """
+        record['seq'] = self.journal.next_seq()
+        if self._write_behind:
+            self.writer.submit(record)
+            return
+        self.journal.append(record)
+        if self.journal.needs_compaction(len(self.users)):
+            self._save_database()
     
     def _save_database(self):
-        """Save database to JSON file"""
-        with open(self.db_file, 'w') as f:
-            json.dump(self.users, f, indent=2, default=str)
+        """Write a full snapshot to the JSON file and truncate the journal"""
+        start = time.perf_counter()
+        self.journal.compact(self.users, meta=self._meta())
+        get_metrics().db_snapshot_latency.observe(time.perf_counter() - start)
+    
+    def _meta(self) -> Dict:
+        """Metadata checkpointed alongside each snapshot"""
+        return {'aggregates': self.aggregates.as_dict(), 'settled_invoices_size': self.settled_invoices.checkpoint()}
+    
+    def _snapshot(self) -> Tuple[UserTable, Callable[[], Dict]]:
+        """Copy the user table and metadata so they can be serialized off the event loop"""
+        aggregates = self.aggregates.as_dict()
+        self.settled_invoices.prepare()
+        # The invoices file is appended to in the worker thread, right before the snapshot is written
+        return self.users.copy(), lambda: {'aggregates': aggregates,
+                                           'settled_invoices_size': self.settled_invoices.write()}
+    
+    def _user_record(self, user: Mapping) -> Dict:
+        return {
+            'op': 'user',
+            'user_id': user['user_id'],
+            'username': user['username'],
+            'first_name': user['first_name'],
+            'joined_date': user['joined_date'],
+            'last_active': user['last_active'],
+            'language_code': user['language_code']
+        }
     
-    def add_user(self, user_id: int, username: str = None, first_name: str = None):
+    async def run(self, func, *args, **kwargs):
+        """Run a database method; the JSON store works in memory, so it is called directly"""
+        return func(*args, **kwargs)
+    
+    def flush_activity(self):
+        """Persist every last_active change collected by the activity tracker in one record"""
+        seen = self.activity.drain()
+        if not seen:
+            return
+        for user_id, timestamp in seen.items():
+            self.users.set_last_active(user_id, timestamp)
+        self._append({'op': 'active', 'ts': list(seen.items())})
+    
+    async def _flush_activity_periodically(self):
+        while True:
+            await asyncio.sleep(BotConfig.ACTIVITY_FLUSH_INTERVAL)
+            self.flush_activity()
+    
+    async def start(self):
+        """Switch to write-behind persistence with background flush tasks"""
+        self.writer.start()
+        self._write_behind = True
+        if self._activity_task is None:
+            self._activity_task = asyncio.create_task(self._flush_activity_periodically())
+    
+    async def stop(self):
+        """Drain pending writes and go back to synchronous persistence"""
+        if self._activity_task is not None:
+            self._activity_task.cancel()
+            self._activity_task = None
+        self.flush_activity()
+        await self.writer.stop()
+        self._write_behind = False
+    
+    async def commit(self):
+        """Wait until every mutation made so far has been flushed to disk"""
+        await self.writer.wait_flushed()
+    
+    def get_flush_stats(self) -> Dict:
+        """Get write-behind flush latency and batch size counters"""
+        return dict(self.writer.stats.as_dict(), pending=self.writer.pending)
+    
+    def close(self):
+        """Flush activity and close the underlying journal and ledger"""
+        self.flush_activity()
+        self.journal.close()
+        self.ledger.close()
+    
+    def add_user(self, user_id: int, username: str = None, first_name: str = None, language_code: str = None):
         """Add or update user in database"""
-        user_id_str = str(user_id)
-        if user_id_str not in self.users:
-            self.users[user_id_str] = {
-                'user_id': user_id,
-                'username': username,
-                'first_name': first_name,
-                'wallet_balance': 0.0,
-                'wallet_transactions': [],
-                'joined_date': datetime.now().isoformat(),
-                'last_active': datetime.now().isoformat()
-            }
+        user = self.users.get(user_id)
+        if user is None:
+            now = datetime.now().isoformat()
+            user = self.users.add(user_id, username, first_name, 0.0, now, now, language_code=language_code)
+            self.aggregates.add_user(0.0)
         else:
-            # Update user info
-            self.users[user_id_str]['username'] = username
-            self.users[user_id_str]['first_name'] = first_name
-            self.users[user_id_str]['last_active'] = datetime.now().isoformat()
+            self.activity.touch(user_id)
+            if (user['username'], user['first_name'], user['language_code']) == (username, first_name, language_code):
+                # Nothing but activity changed; the tracker persists that in bulk
+                return
+            user['username'] = username
+            user['first_name'] = first_name
+            user['language_code'] = language_code
         
-        self._save_database()
+        self._append(self._user_record(user))
     
-    def get_user(self, user_id: int) -> Optional[Dict]:
+    def get_user(self, user_id: int) -> Optional[Mapping]:
         """Get user data"""
-        return self.users.get(str(user_id))
+        return self.users.get(user_id)
     
-    def get_all_users(self) -> List[Dict]:
+    def get_all_users(self) -> List[Mapping]:
         """Get all users"""
-        return list(self.users.values())
+        return list(self.users.rows())
     
-    def get_user_ids(self) -> List[int]:
-        """Get all user IDs for broadcasting"""
-        return [user['user_id'] for user in self.users.values()]
+    def get_user_ids(self, reachable_only: bool = False) -> List[int]:
+        """Get all user IDs for broadcasting, optionally only users the bot can still reach"""
+        if reachable_only:
+            return [user_id for cursor, user_id in self.users.reachable_page(0, len(self.users))]
+        return self.users.ids.tolist()
+    
+    def get_user_id_page(self, after: int = 0, limit: int = 1000, reachable_only: bool = False,
+                         audience: Optional[Audience] = None) -> List[Tuple[int, int]]:
+        """Get up to limit (cursor, user_id) pairs in join order, starting after a cursor.
+
+        The cursor is a row position; pass the last one back to continue.
+        An audience restricts the page to the reachable users it selects.
+        """
+        if audience is not None and not audience.is_everyone:
+            return self.users.segment_page(after, limit, audience)
+        if reachable_only:
+            return self.users.reachable_page(after, limit)
+        ids = self.users.ids[after:after + limit]
+        return list(zip(range(after + 1, after + 1 + len(ids)), ids))
+    
+    def count_audience(self, audience: Audience) -> int:
+        """Get the number of reachable users a broadcast audience selects"""
+        return self.users.segment_count(audience)
+    
+    def set_reachability(self, updates: List[Tuple[int, int, int]]):
+        """Record delivery outcomes as (user_id, state, epoch_seconds) reachability updates"""
+        items = [(user_id, state, timestamp) for user_id, state, timestamp in updates if user_id in self.users]
+        if not items:
+            return
+        for user_id, state, timestamp in items:
+            self.users.set_reachability(user_id, state, timestamp)
+        self._append({'op': 'reach', 'items': items})
+    
+    def get_reachability_stats(self) -> Dict[str, int]:
+        """Get the number of users in each reachability state"""
+        return {STATE_NAMES[state]: count for state, count in enumerate(self.users.reach_counts)}
+    
+    def get_stale_unreachable(self, checked_before: int) -> List[int]:
+        """Get unreachable users whose state was last established before an epoch second"""
+        users = self.users
+        return [users.ids[row] for row, state in enumerate(users.reach)
+                if state != REACHABLE and users.reach_checked[row] < checked_before]
     
     def update_wallet_balance(self, user_id: int, amount: float, transaction_type: str = "manual", description: str = ""):
         """Update user wallet balance"""
-        user_id_str = str(user_id)
-        if user_id_str in self.users:
-            old_balance = self.users[user_id_str]['wallet_balance']
-            self.users[user_id_str]['wallet_balance'] += amount
+        return self._change_balance(user_id, amount, transaction_type, description)
+    
+    def _change_balance(self, user_id: int, amount: float, transaction_type: str, description: str,
+                        invoice_id: str = None) -> bool:
+        user = self.users.get(user_id)
+        if user is not None:
+            old_balance = user['wallet_balance']
+            user['wallet_balance'] = old_balance + amount
+            new_balance = user['wallet_balance']
+            self.aggregates.update_balance(old_balance, new_balance)
             
             # Add transaction record
             transaction = {
@@ -72,25 +304,42 @@ class UserDatabase:
                 'description': description,
                 'timestamp': datetime.now().isoformat(),
                 'old_balance': old_balance,
-                'new_balance': self.users[user_id_str]['wallet_balance']
+                'new_balance': new_balance
             }
-            self.users[user_id_str]['wallet_transactions'].append(transaction)
+            self.ledger.append(user_id, transaction)
+            if not self._write_behind:
+                self.ledger.flush()
             
-            self._save_database()
+            record = {'op': 'balance', 'user_id': user_id, 'balance': new_balance}
+            if invoice_id is not None:
+                # Same record as the balance, so a replay never credits without marking it settled
+                settled_at = int(datetime.now().timestamp())
+                self.settled_invoices.add(invoice_id, settled_at)
+                record.update(invoice=invoice_id, ts=settled_at)
+            self._append(record)
             return True
         return False
     
+    def settle_invoice(self, invoice_id: str, user_id: int, amount: float, description: str = "") -> bool:
+        """Credit a paid invoice once; False if it was already settled or the user is unknown"""
+        if invoice_id in self.settled_invoices:
+            return False
+        return self._change_balance(user_id, amount, "deposit", description, invoice_id)
+    
     def get_wallet_balance(self, user_id: int) -> float:
         """Get user wallet balance"""
         user = self.get_user(user_id)
         return user['wallet_balance'] if user else 0.0
     
-    def get_wallet_transactions(self, user_id: int, limit: int = 10) -> List[Dict]:
-        """Get user wallet transactions"""
-        user = self.get_user(user_id)
-        if user and 'wallet_transactions' in user:
-            return user['wallet_transactions'][-limit:]
-        return []
+    def get_wallet_transactions(self, user_id: int, limit: int = 10, before_id: int = None,
+                                after_id: int = None) -> List[Dict]:
+        """Get a page of user wallet transactions, oldest first (the newest page by default)"""
+        return self.ledger.page(user_id, limit, before_id, after_id)[0]
+    
+    def get_wallet_history_page(self, user_id: int, limit: int = 10, before_id: int = None,
+                                after_id: int = None) -> Tuple[List[Dict], bool, bool]:
+        """Get a page of wallet transactions plus whether older and newer ones exist"""
+        return self.ledger.page(user_id, limit, before_id, after_id)
     
     def get_total_users(self) -> int:
         """Get total number of users"""
@@ -98,4 +347,39 @@ class UserDatabase:
     
     def get_total_wallet_balance(self) -> float:
         """Get total wallet balance across all users"""
-        return sum(user['wallet_balance'] for user in self.users.values())
\ No newline at end of file
+        return self.aggregates.total_balance
+    
+    def get_wallet_stats(self) -> Dict:
+        """Get running wallet aggregates, including the balance histogram"""
+        stats = self.aggregates.as_dict()
+        stats['histogram'] = list(zip(bucket_labels(), stats['histogram']))
+        return stats
+    
+    def verify_aggregates(self) -> bool:
+        """Recompute the aggregates with a full scan, replacing them if they drifted"""
+        recomputed = WalletAggregates.recompute(self.users.balance_values())
+        if recomputed.matches(self.aggregates):
+            return True
+        self.aggregates = recomputed
+        return False
+
+_shared_db: Optional[UserDatabase] = None
+
+def get_database() -> UserDatabase:
+    """Return the process-wide database instance shared by all handlers"""
+    global _shared_db
+    if _shared_db is None:
+        if BotConfig.DB_BACKEND == "sqlite":
+            from storage.sqlite_backend import SQLiteUserDatabase
+            _shared_db = SQLiteUserDatabase(
+                BotConfig.SQLITE_DB_FILE,
+                flush_interval_ms=BotConfig.DB_FLUSH_INTERVAL_MS,
+                max_batch=BotConfig.DB_FLUSH_MAX_BATCH
+            )
+        else:
+            _shared_db = UserDatabase(BotConfig.JSON_DB_FILE)
+        if BotConfig.SHARD_INDEX is not None:
+            from utils.sharding import ShardedDatabase
+            _shared_db = ShardedDatabase(_shared_db, BotConfig.SHARD_INDEX, BotConfig.SHARDS,
+                                         BotConfig.SHARD_SOCKET_DIR, BotConfig.SHARD_CALL_TIMEOUT)
+    return _shared_db
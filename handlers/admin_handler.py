@@ -1,17 +1,22 @@
 from telegram import Update
 from telegram.ext import ContextTypes
-from utils.decorators import admin_required
+from utils.decorators import admin_required, track_metrics
 from bot_config import BotConfig
-from database import UserDatabase
+from database import get_database
+from utils.ingestion import UpdateQueue, get_update_deduplicator
+from utils.invoices import get_invoice_registry
+from utils.update_processor import PerUserUpdateProcessor
+from utils.xendit_api import get_xendit_client
 import logging
 
 logger = logging.getLogger(__name__)
-db = UserDatabase()
+db = get_database()
 
 class AdminHandler:
     """Handle admin-only commands and functions"""
     
     @staticmethod
+    @track_metrics
     @admin_required
     async def handle_admin_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show admin help menu"""
@@ -25,36 +30,85 @@ class AdminHandler:
         help_message += "• `/remove_admin <user_id>` - Remove admin\n"
         help_message += "• `/user_list` - List all users\n\n"
         help_message += "📢 **Broadcasting:**\n"
-        help_message += "• `/broadcast <message>` - Send message to all users\n"
+        help_message += "• `/broadcast [--active-since 7d] [--min-balance 100] [--lang id] <message>` - Send message to all users or a segment\n"
+        help_message += "• Reply `/broadcast [caption]` to a photo, video, document or album to broadcast it\n"
+        help_message += "• `/broadcast_media` - List saved media for `/broadcast --media <id>`\n"
         help_message += "• `/broadcast_confirm` - Confirm pending broadcast\n"
         help_message += "• `/broadcast_cancel` - Cancel pending broadcast\n"
+        help_message += "• `/broadcast_status [id]` - Show broadcast progress\n"
+        help_message += "• `/broadcast_pause [id]` - Pause a running broadcast\n"
+        help_message += "• `/broadcast_resume [id]` - Resume a paused broadcast\n"
+        help_message += "• `/broadcast_reprobe [days]` - Re-check users who blocked the bot\n"
         help_message += "• `/broadcast_test <message>` - Test broadcast to admins\n\n"
         help_message += "💰 **Wallet Management:**\n"
         help_message += "• `/admin_add_funds <user_id> <amount>` - Add funds to user\n"
-        help_message += "• `/wallet_stats` - Show wallet statistics\n\n"
+        help_message += "• `/wallet_stats` - Show wallet statistics\n"
+        help_message += "• `/wallet_verify_stats` - Recount wallets and repair statistics\n\n"
         help_message += "⚠️ **System:**\n"
         help_message += "• `/admin_shutdown` - Shutdown bot (use with caution)"
         
         await update.message.reply_text(help_message, parse_mode='Markdown')
     
     @staticmethod
+    @track_metrics
     @admin_required
     async def handle_admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show bot statistics"""
-        total_users = db.get_total_users()
-        total_wallet_balance = db.get_total_wallet_balance()
+        total_users = await db.run(db.get_total_users)
+        total_wallet_balance = await db.run(db.get_total_wallet_balance)
         
         stats_message = "📊 **Bot Statistics:**\n\n"
         stats_message += f"🔧 Total Admins: {len(BotConfig.ADMIN_USER_IDS)}\n"
         stats_message += f"👥 Total Users: {total_users}\n"
         stats_message += f"💰 Total Wallet Balance: ${total_wallet_balance:.2f}\n"
+        reachability = await db.run(db.get_reachability_stats)
+        stats_message += f"📬 Reachable Users: {reachability['reachable']} "
+        stats_message += f"(blocked {reachability['blocked']}, gone {reachability['gone']})\n"
         stats_message += f"🤖 Bot Token: `{BotConfig.BOT_TOKEN[:10]}...`\n"
         stats_message += f"📝 Logging: {'✅ Enabled' if BotConfig.ENABLE_LOGGING else '❌ Disabled'}\n"
-        stats_message += f"📊 Log Level: {BotConfig.LOG_LEVEL}"
+        stats_message += f"📊 Log Level: {BotConfig.LOG_LEVEL}\n"
+        if BotConfig.SHARD_INDEX is not None:
+            stats_message += f"🧩 Shard: #{BotConfig.SHARD_INDEX} of {BotConfig.SHARDS} "
+            stats_message += "(users and balances above are across all shards, the figures below this one's)\n"
+        
+        flush_stats = db.get_flush_stats()
+        stats_message += f"💾 DB Flushes: {flush_stats['flushes']} "
+        stats_message += f"(last {flush_stats['last_batch_size']} records in {flush_stats['last_latency_ms']} ms, "
+        stats_message += f"avg batch {flush_stats['avg_batch_size']}, pending {flush_stats['pending']})\n"
+        invoice_stats = get_invoice_registry().stats()
+        stats_message += f"🧾 Open Invoices: {invoice_stats['open']} "
+        stats_message += f"(reused {invoice_stats['hits']}, created {invoice_stats['misses']})\n"
+        xendit_stats = get_xendit_client().stats()
+        breaker = xendit_stats['breaker']
+        stats_message += f"💳 Xendit Circuit: {breaker['state'].replace('_', ' ')} "
+        stats_message += f"(failure rate {breaker['failure_rate']:.0%} over {breaker['calls']} calls, "
+        stats_message += f"opened {breaker['opened']}x, fast-failed {breaker['rejected']}"
+        if breaker['state'] == 'open':
+            stats_message += f", probing in {breaker['retry_in_s']:.0f}s"
+        stats_message += f"; in flight {xendit_stats['in_flight']}/{xendit_stats['max_in_flight']}, "
+        stats_message += f"retries {xendit_stats['retries']})\n"
+        update_queue = context.application.update_queue
+        if isinstance(update_queue, UpdateQueue):
+            queue_stats = update_queue.stats()
+            stats_message += f"📥 Update Queue: {queue_stats['depth']}/{queue_stats['capacity']} "
+            stats_message += f"(peak {queue_stats['peak_depth']}, wait p50 {queue_stats['wait_p50_ms']} ms, "
+            stats_message += f"p99 {queue_stats['wait_p99_ms']} ms; shed {queue_stats['shed']}, "
+            stats_message += f"deferred {queue_stats['deferred']}, refused {queue_stats['rejected']})\n"
+        if BotConfig.WEBHOOK_URL and BotConfig.SHARD_INDEX is None:
+            dedup_stats = get_update_deduplicator().stats()
+            stats_message += f"🔁 Duplicate Updates: dropped {dedup_stats['duplicates']} of {dedup_stats['checked']} "
+            stats_message += f"(remembering {dedup_stats['remembered']}/{dedup_stats['window']})\n"
+        update_processor = context.application.update_processor
+        if isinstance(update_processor, PerUserUpdateProcessor):
+            processor_stats = update_processor.stats()
+            stats_message += f"⚙️ Handlers Running: {processor_stats['running']}/{processor_stats['max_running']} "
+            stats_message += f"({processor_stats['held'] - processor_stats['running']} waiting, "
+            stats_message += f"{processor_stats['users']} users busy, wait p99 {processor_stats['wait_p99_ms']} ms)"
         
         await update.message.reply_text(stats_message, parse_mode='Markdown')
     
     @staticmethod
+    @track_metrics
     @admin_required
     async def handle_list_admins(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """List all admin users"""
@@ -64,7 +118,7 @@ class AdminHandler:
         
         admin_list = "👥 **Current Admins:**\n\n"
         for i, admin_id in enumerate(BotConfig.ADMIN_USER_IDS, 1):
-            admin_data = db.get_user(admin_id)
+            admin_data = await db.run(db.get_user, admin_id)
             if admin_data:
                 admin_list += f"{i}. {admin_data['first_name']} (@{admin_data['username'] or 'N/A'}) - `{admin_id}`\n"
             else:
@@ -73,10 +127,11 @@ class AdminHandler:
         await update.message.reply_text(admin_list, parse_mode='Markdown')
     
     @staticmethod
+    @track_metrics
     @admin_required
     async def handle_user_list(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """List all users in database"""
-        users = db.get_all_users()
+        users = await db.run(db.get_all_users)
         
         if not users:
             await update.message.reply_text("👥 No users found in database.")
@@ -95,6 +150,7 @@ class AdminHandler:
         await update.message.reply_text(user_list, parse_mode='Markdown')
     
     @staticmethod
+    @track_metrics
     @admin_required
     async def handle_add_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Add a new admin user"""
@@ -113,6 +169,7 @@ class AdminHandler:
             await update.message.reply_text("❌ Invalid user ID. Please provide a numeric user ID.")
     
     @staticmethod
+    @track_metrics
     @admin_required
     async def handle_remove_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Remove an admin user"""
@@ -135,6 +192,7 @@ class AdminHandler:
             await update.message.reply_text("❌ Invalid user ID. Please provide a numeric user ID.")
     
     @staticmethod
+    @track_metrics
     @admin_required
     async def handle_shutdown(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Shutdown the bot (placeholder)"""
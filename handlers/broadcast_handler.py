@@ -1,15 +1,31 @@
 from telegram import Update
 from telegram.ext import ContextTypes
-from utils.decorators import admin_required
-from database import UserDatabase
-import asyncio
+from utils.decorators import admin_required, track_metrics
+from database import get_database
+from storage.audience import Audience
+from utils.broadcast_jobs import COMPLETED, PAUSED, RUNNING
+from utils.broadcast_media import MAX_CAPTION_LENGTH, describe_media, media_from_message, media_sender
+from bot_config import BotConfig
 import logging
 
 logger = logging.getLogger(__name__)
-db = UserDatabase()
+db = get_database()
+
+def _pop_media_option(args):
+    """Take a --media <asset id> pair out of the leading options, returning (asset id or None, other args)"""
+    args = list(args)
+    i = 0
+    while i + 1 < len(args) and args[i].startswith(('--', '\u2014')):
+        if args[i].lstrip('-\u2014') == 'media':
+            asset_id = args[i + 1]
+            del args[i:i + 2]
+            return asset_id, args
+        i += 2
+    return None, args
 
 class BroadcastHandler:
     @staticmethod
+    @track_metrics
     @admin_required
     async def handle_broadcast_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Cancel a pending broadcast"""
@@ -22,97 +38,202 @@ class BroadcastHandler:
     """Handle broadcast functionality"""
     
     @staticmethod
+    @track_metrics
     @admin_required
     async def handle_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Broadcast a message to all users"""
-        if not context.args:
-            await update.message.reply_text("❌ Usage: /broadcast <message>\nExample: /broadcast Hello everyone! This is an important announcement.")
+        """Broadcast a message, or a replied-to photo, video, document or album, to all users or a segment"""
+        usage = ("❌ Usage: /broadcast [--active-since 7d] [--min-balance 100] [--lang id] [--media m1] <message>\n"
+                 "Example: /broadcast --active-since 7d Hello everyone! This is an important announcement.\n"
+                 "Reply to a photo, video, document or album with /broadcast [caption] to broadcast the media.")
+        asset_id, args = _pop_media_option(context.args or [])
+        try:
+            audience, words = Audience.parse_args(args)
+        except ValueError as e:
+            await update.message.reply_text(f"❌ {e}\n{usage}")
             return
         
-        message = " ".join(context.args)
-        user_ids = db.get_user_ids()
+        broadcasts = context.application.bot_data['broadcasts']
+        media = None
+        if asset_id is not None:
+            media = broadcasts.media.get(asset_id)
+            if media is None:
+                await update.message.reply_text(f"❌ Unknown media {asset_id}. Use /broadcast_media to list saved media.")
+                return
+        elif update.message.reply_to_message:
+            reply = update.message.reply_to_message
+            items = broadcasts.albums.get(reply.media_group_id) if reply.media_group_id else []
+            if not items:
+                item = media_from_message(reply)
+                items = [item] if item else []
+            if items:
+                # Saved by file_id so it can be broadcast again without another upload
+                media = broadcasts.media.add(items)
+                await broadcasts.store.save()
+        
+        if not words and media is None:
+            await update.message.reply_text(usage)
+            return
+        
+        message = " ".join(words)
+        if media is not None and len(message) > MAX_CAPTION_LENGTH:
+            await update.message.reply_text(f"❌ Media captions are limited to {MAX_CAPTION_LENGTH} characters.")
+            return
+        count = await db.run(db.count_audience, audience)
         
-        if not user_ids:
-            await update.message.reply_text("❌ No users found in database to broadcast to.")
+        if not count:
+            await update.message.reply_text(f"❌ No users found to broadcast to ({audience.describe()}).")
             return
         
         # Show confirmation
+        if media is not None:
+            # Sent exactly as recipients will get it, which also checks the file_id still works
+            await media_sender(context.bot, media, message or None)(update.effective_chat.id)
         confirm_msg = f"📢 **Broadcast Preview:**\n\n{message}\n\n"
-        confirm_msg += f"👥 This message will be sent to {len(user_ids)} users.\n"
+        if media is not None:
+            confirm_msg += f"🖼 Media: {describe_media(media)}\n"
+        confirm_msg += f"🎯 Audience: {audience.describe()}\n"
+        confirm_msg += f"👥 This message will be sent to {count} users.\n"
         confirm_msg += "Use /broadcast_confirm to send or /broadcast_cancel to cancel."
         
-        # Store broadcast data in context for confirmation
+        # Store only the criteria; recipients are resolved when the job runs
         context.user_data['pending_broadcast'] = {
             'message': message,
-            'user_ids': user_ids,
+            'audience': audience.as_dict(),
+            'media': media['id'] if media is not None else None,
             'admin_id': update.effective_user.id
         }
         
         await update.message.reply_text(confirm_msg, parse_mode='Markdown')
     
     @staticmethod
+    @track_metrics
     @admin_required
     async def handle_broadcast_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Confirm and send the broadcast"""
+        """Confirm the broadcast and start it as a background job"""
         if 'pending_broadcast' not in context.user_data:
             await update.message.reply_text("❌ No pending broadcast found. Use /broadcast <message> first.")
             return
 
-        broadcast_data = context.user_data['pending_broadcast']
-        message = broadcast_data['message']
-        from bot_config import BotConfig
-        user_ids = set(broadcast_data['user_ids'])
-        # Add admin IDs to broadcast recipients
-        user_ids.update(BotConfig.ADMIN_USER_IDS)
-        user_ids = list(user_ids)
+        broadcast_data = context.user_data.pop('pending_broadcast')
+        broadcasts = context.application.bot_data['broadcasts']
+        # Admins always receive the broadcast, even if they never used the bot
+        extra_ids = [admin_id for admin_id in BotConfig.ADMIN_USER_IDS
+                     if await db.run(db.get_user, admin_id) is None]
+        audience = Audience.from_dict(broadcast_data['audience'])
+        total = await db.run(db.count_audience, audience) + len(extra_ids)
+        media = broadcasts.media.get(broadcast_data['media']) if broadcast_data.get('media') else None
 
-        # Start broadcasting
         status_msg = await update.message.reply_text("📡 Starting broadcast...")
+        job = broadcasts.create(broadcast_data['message'], update.effective_user.id, status_msg.chat_id,
+                                status_msg.message_id, extra_ids, total, audience, media)
+        await broadcasts.start(context.job_queue, job['id'])
 
-        success_count = 0
-        failed_count = 0
-        success_users = []
-        failed_users = []
-
-        # Add broadcast header
-        broadcast_message = f"📢 **Broadcast Message**\n\n{message}\n\n_This is an official broadcast from the bot administrators._"
-
-        for user_id in user_ids:
-            try:
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=broadcast_message,
-                    parse_mode='Markdown'
-                )
-                success_count += 1
-                success_users.append(user_id)
-                # Small delay to avoid rate limiting
-                await asyncio.sleep(0.1)
-            except Exception as e:
-                failed_count += 1
-                failed_users.append((user_id, str(e)))
-                logger.warning(f"Failed to send broadcast to user {user_id}: {e}")
-
-        # Update status
-        final_message = f"✅ **Broadcast Completed!**\n\n"
-        final_message += f"📤 Successfully sent: {success_count}\n"
-        if success_users:
-            final_message += f"Success user IDs: {', '.join(str(uid) for uid in success_users)}\n"
-        final_message += f"❌ Failed to send: {failed_count}\n"
-        if failed_users:
-            final_message += "Failed user IDs and errors:\n"
-            for uid, err in failed_users:
-                final_message += f"- {uid}: {err}\n"
-        final_message += f"📊 Total users: {len(user_ids)}"
-
-        await status_msg.edit_text(final_message, parse_mode='Markdown')
-
-        # Clear pending broadcast
-        del context.user_data['pending_broadcast']
-
-        logger.info(f"Broadcast completed by admin {update.effective_user.id}: {success_count} success, {failed_count} failed")
+        await status_msg.edit_text(
+            f"📡 Broadcast #{job['id']} is running in the background to {total} users.\n"
+            f"Use /broadcast_status to follow it or /broadcast_pause to pause it."
+        )
+        logger.info(f"Broadcast {job['id']} started by admin {update.effective_user.id} for {total} users")
+    
+    @staticmethod
+    @track_metrics
+    @admin_required
+    async def handle_broadcast_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Show the progress of broadcast jobs"""
+        broadcasts = context.application.bot_data['broadcasts']
+        if context.args:
+            job = broadcasts.get(context.args[0])
+            jobs = [job] if job else []
+        else:
+            jobs = broadcasts.jobs()[-5:]
+        if not jobs:
+            await update.message.reply_text("No broadcasts found.")
+            return
+        
+        icons = {RUNNING: "📡", PAUSED: "⏸", COMPLETED: "✅"}
+        status_message = "📢 **Broadcasts:**\n\n"
+        for job in jobs:
+            done = job['sent'] + job['failed']
+            status_message += f"{icons[job['status']]} #{job['id']} {job['status']}: {done}/{job['total']} "
+            status_message += f"({job['sent']} sent, {job['failed']} failed)\n"
+        await update.message.reply_text(status_message, parse_mode='Markdown')
+    
+    @staticmethod
+    @track_metrics
+    @admin_required
+    async def handle_broadcast_pause(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Pause a running broadcast job"""
+        broadcasts = context.application.bot_data['broadcasts']
+        job = broadcasts.get(context.args[0] if context.args else None, status=RUNNING)
+        if job is None or job['status'] != RUNNING:
+            await update.message.reply_text("❌ No running broadcast found. Usage: /broadcast_pause [id]")
+            return
+        
+        await broadcasts.pause(job['id'])
+        await update.message.reply_text(f"⏸ Broadcast #{job['id']} paused. Use /broadcast_resume {job['id']} to continue.")
+        logger.info(f"Broadcast {job['id']} paused by admin {update.effective_user.id}")
+    
+    @staticmethod
+    @track_metrics
+    @admin_required
+    async def handle_broadcast_resume(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Resume a paused broadcast job from its last checkpoint"""
+        broadcasts = context.application.bot_data['broadcasts']
+        job = broadcasts.get(context.args[0] if context.args else None, status=PAUSED)
+        if job is None or job['status'] != PAUSED:
+            await update.message.reply_text("❌ No paused broadcast found. Usage: /broadcast_resume [id]")
+            return
+        if broadcasts.is_active(job['id']):
+            await update.message.reply_text(f"⏳ Broadcast #{job['id']} is still finishing its last sends, try again in a moment.")
+            return
+        
+        await broadcasts.start(context.job_queue, job['id'])
+        await update.message.reply_text(f"▶️ Broadcast #{job['id']} resumed.")
+        logger.info(f"Broadcast {job['id']} resumed by admin {update.effective_user.id}")
+    
+    @staticmethod
+    @track_metrics
+    @admin_required
+    async def handle_broadcast_reprobe(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Re-check, at low priority, users marked unreachable for a while"""
+        try:
+            days = float(context.args[0]) if context.args else BotConfig.REPROBE_AFTER_DAYS
+        except ValueError:
+            await update.message.reply_text("❌ Usage: /broadcast_reprobe [days]")
+            return
+        
+        broadcasts = context.application.bot_data['broadcasts']
+        count = await broadcasts.start_reprobe(context.job_queue, update.effective_chat.id, days * 86400)
+        if count:
+            await update.message.reply_text(f"🔁 Re-probing {count} users unreachable for over {days:g} days. "
+                                            f"You will get a report when it finishes.")
+        else:
+            await update.message.reply_text(f"✅ No users have been unreachable for over {days:g} days.")
+    
+    @staticmethod
+    @track_metrics
+    async def handle_album_item(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Remember the items of albums sent by admins, so /broadcast can reply to an album"""
+        if update.message and update.message.media_group_id and BotConfig.is_admin(update.effective_user.id):
+            context.application.bot_data['broadcasts'].albums.add(update.message)
+    
+    @staticmethod
+    @track_metrics
+    @admin_required
+    async def handle_broadcast_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """List the media saved for rebroadcasting"""
+        assets = list(context.application.bot_data['broadcasts'].media.assets.values())
+        if not assets:
+            await update.message.reply_text("No saved media yet. Reply to a photo, video, document or album with /broadcast.")
+            return
+        
+        media_message = "🖼 Saved broadcast media:\n\n"
+        for asset in assets[-20:]:
+            media_message += f"• {describe_media(asset)}, saved {asset['saved'][:16].replace('T', ' ')}\n"
+        media_message += "\nUse /broadcast --media <id> [caption] to send one again."
+        await update.message.reply_text(media_message)
     
     @staticmethod
+    @track_metrics
     @admin_required
     async def handle_broadcast_test(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Send a test broadcast to admins only"""
@@ -120,7 +241,6 @@ class BroadcastHandler:
             await update.message.reply_text("❌ Usage: /broadcast_test <message>")
             return
         
-        from bot_config import BotConfig
         message = " ".join(context.args)
         admin_ids = BotConfig.ADMIN_USER_IDS
         
@@ -1,15 +1,17 @@
 from telegram import Update
 from telegram.ext import ContextTypes
-from utils.decorators import log_message
-from database import UserDatabase
+from utils.decorators import log_message, track_metrics
+from database import get_database
+from bot_config import BotConfig
 import logging
 
 logger = logging.getLogger(__name__)
-db = UserDatabase()
+db = get_database()
 
 class MessageHandler:
-    FEE_PERCENT = 0.02  # 2% fee
+    FEE_PERCENT = BotConfig.FEE_PERCENT
     @staticmethod
+    @track_metrics
     async def handle_topup(update: Update, context: ContextTypes.DEFAULT_TYPE):
         from telegram import ReplyKeyboardMarkup
         user = update.effective_user
@@ -18,6 +20,7 @@ class MessageHandler:
         await update.message.reply_text("How would you like to pay? Choose QRPH or Payment Link:", reply_markup=reply_markup)
         context.user_data['topup_method_pending'] = True
     @staticmethod
+    @track_metrics
     async def handle_topup(update: Update, context: ContextTypes.DEFAULT_TYPE):
         from utils.xendit_api import create_invoice
         user = update.effective_user
@@ -25,6 +28,7 @@ class MessageHandler:
         context.user_data['topup_pending'] = True
 
     @staticmethod
+    @track_metrics
     async def handle_withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
         await update.message.reply_text("🏧 Please enter the amount to withdraw (minimum 1000P):")
@@ -32,8 +36,11 @@ class MessageHandler:
     """Handle regular user messages"""
     
     @staticmethod
+    @track_metrics
     @log_message
     async def handle_text_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        user = update.effective_user
+        message_text = update.message.text
         # Handle topup method selection
         if context.user_data.get('topup_method_pending'):
             method = message_text.strip().lower()
@@ -57,11 +64,14 @@ class MessageHandler:
                 return
             fee = int(amount * MessageHandler.FEE_PERCENT)
             net_amount = amount - fee
-            from utils.xendit_api import create_invoice
-            invoice = await create_invoice(amount, user.id)
-            method = context.user_data.get('topup_method', 'payment link')
+            from utils.invoices import get_invoice_registry
+            method = context.user_data.get('topup_method') or 'payment link'
+            # Tapping Top Up again for the same amount gets the invoice that is still open
+            invoice = await get_invoice_registry().open_invoice(user.id, amount, method)
             fee_msg = f"A {MessageHandler.FEE_PERCENT*100:.0f}% fee ({fee}P) will be deducted. You will receive {net_amount}P in your wallet after payment."
-            if method == "qrph":
+            if invoice.get('error'):
+                await update.message.reply_text(f"❌ {invoice['error']}")
+            elif method == "qrph":
                 qr_url = invoice.get('qr_code_url') or invoice.get('qr_code')
                 if qr_url:
                     await context.bot.send_photo(
@@ -97,18 +107,17 @@ class MessageHandler:
             context.user_data['withdraw_pending'] = False
             return
         """Handle incoming text messages"""
-        user = update.effective_user
-        message_text = update.message.text
         
         # Add user to database
-        db.add_user(user.id, user.username, user.first_name)
+        await db.run(db.add_user, user.id, user.username, user.first_name, user.language_code)
         
         # Echo the message back with user info
         response = f"👋 Hello {user.first_name}!\n\n"
         response += f"📝 You said: {message_text}\n"
         response += f"🆔 Your ID: {user.id}\n"
         response += f"👤 Username: @{user.username or 'Not set'}\n\n"
-        response += f"💰 Your wallet balance: ${db.get_wallet_balance(user.id):.2f}"
+        balance = await db.run(db.get_wallet_balance, user.id)
+        response += f"💰 Your wallet balance: ${balance:.2f}"
         
         await update.message.reply_text(response)
         
@@ -146,10 +155,12 @@ class MessageHandler:
         response += f"📝 You said: {message_text}\n"
         response += f"🆔 Your ID: {user.id}\n"
         response += f"👤 Username: @{user.username or 'Not set'}\n\n"
-        response += f"💰 Your wallet balance: ${db.get_wallet_balance(user.id):.2f}"
+        balance = await db.run(db.get_wallet_balance, user.id)
+        response += f"💰 Your wallet balance: ${balance:.2f}"
         await update.message.reply_text(response)
     
     @staticmethod
+    @track_metrics
     @log_message
     async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle incoming photos"""
@@ -157,7 +168,7 @@ class MessageHandler:
         photo = update.message.photo[-1]  # Get the largest photo
         
         # Add user to database
-        db.add_user(user.id, user.username, user.first_name)
+        await db.run(db.add_user, user.id, user.username, user.first_name, user.language_code)
         
         response = f"📸 Photo received from {user.first_name}!\n"
         response += f"🆔 File ID: {photo.file_id}\n"
@@ -166,6 +177,7 @@ class MessageHandler:
         await update.message.reply_text(response)
     
     @staticmethod
+    @track_metrics
     @log_message
     async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle incoming documents"""
@@ -173,7 +185,7 @@ class MessageHandler:
         document = update.message.document
         
         # Add user to database
-        db.add_user(user.id, user.username, user.first_name)
+        await db.run(db.add_user, user.id, user.username, user.first_name, user.language_code)
         
         response = f"📄 Document received from {user.first_name}!\n"
         response += f"📝 Filename: {document.file_name}\n"
@@ -183,13 +195,14 @@ class MessageHandler:
         await update.message.reply_text(response)
     
     @staticmethod
+    @track_metrics
     @log_message
     async def handle_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command"""
         user = update.effective_user
         
         # Add user to database
-        db.add_user(user.id, user.username, user.first_name)
+        await db.run(db.add_user, user.id, user.username, user.first_name, user.language_code)
         
         welcome_message = f"🤖 Welcome to the Modular Bot, {user.first_name}!\n\n"
         welcome_message += "📋 **Available commands:**\n"
@@ -214,11 +227,12 @@ class MessageHandler:
         await update.message.reply_text(welcome_message, reply_markup=reply_markup)
     
     @staticmethod
+    @track_metrics
     @log_message
     async def handle_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /help command"""
         user = update.effective_user
-        db.add_user(user.id, user.username, user.first_name)
+        await db.run(db.add_user, user.id, user.username, user.first_name, user.language_code)
         
         help_message = "🆘 **Bot Help**\n\n"
         help_message += "This is a modular Telegram bot that can:\n"
@@ -240,14 +254,15 @@ class MessageHandler:
         await update.message.reply_text(help_message, parse_mode='Markdown')
     
     @staticmethod
+    @track_metrics
     @log_message
     async def handle_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /info command"""
         user = update.effective_user
-        db.add_user(user.id, user.username, user.first_name)
+        await db.run(db.add_user, user.id, user.username, user.first_name, user.language_code)
         
-        user_data = db.get_user(user.id)
-        wallet_balance = db.get_wallet_balance(user.id)
+        user_data = await db.run(db.get_user, user.id)
+        wallet_balance = await db.run(db.get_wallet_balance, user.id)
         
         info_message = f"👤 **Your Information:**\n\n"
         info_message += f"🆔 User ID: `{user.id}`\n"
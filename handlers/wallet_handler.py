@@ -1,23 +1,26 @@
-from telegram import Update
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
-from utils.decorators import log_message, admin_required
-from database import UserDatabase
+from utils.decorators import log_message, admin_required, track_metrics
+from database import get_database
+from bot_config import BotConfig
 import logging
-from utils.xendit_api import create_invoice, create_withdrawal
+from utils.invoices import get_invoice_registry
+from utils.xendit_api import create_withdrawal
 
 logger = logging.getLogger(__name__)
-db = UserDatabase()
+db = get_database()
 
 class WalletHandler:
     """Handle wallet-related commands and functions"""
 
     @staticmethod
+    @track_metrics
     @log_message
     async def handle_wallet_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Show user's wallet balance"""
         user = update.effective_user
-        db.add_user(user.id, user.username, user.first_name)
-        balance = db.get_wallet_balance(user.id)
+        await db.run(db.add_user, user.id, user.username, user.first_name, user.language_code)
+        balance = await db.run(db.get_wallet_balance, user.id)
         message = f"\U0001F4B0 **Your Wallet**\n\n"
         message += f"\U0001F464 User: {user.first_name}\n"
         message += f"\U0001F4B5 Balance: **${balance:.2f}**\n\n"
@@ -28,54 +31,100 @@ class WalletHandler:
         message += "• `/wallet_withdraw <amount>` - Request withdrawal"
         await update.message.reply_text(message, parse_mode='Markdown')
 
+    HISTORY_PAGE_SIZE = 10
+
     @staticmethod
-    @log_message
-    async def handle_wallet_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """Show user's wallet transaction history"""
-        user = update.effective_user
-        db.add_user(user.id, user.username, user.first_name)
-        transactions = db.get_wallet_transactions(user.id, limit=10)
-        if not transactions:
-            await update.message.reply_text("\U0001F4DD No wallet transactions found.")
-            return
-        message = f"\U0001F4CA **Wallet History** (Last 10 transactions)\n\n"
-        for i, tx in enumerate(reversed(transactions), 1):
+    def _format_history_page(page, has_older: bool, has_newer: bool):
+        """Build the history message and its older/newer navigation buttons"""
+        message = f"\U0001F4CA **Wallet History** ({len(page)} transactions)\n\n"
+        for i, tx in enumerate(reversed(page), 1):
             amount_str = f"+${tx['amount']:.2f}" if tx['amount'] > 0 else f"-${abs(tx['amount']):.2f}"
             message += f"{i}. {amount_str} - {tx['type']}\n"
             message += f"   \U0001F4B0 Balance: ${tx['new_balance']:.2f}\n"
             if tx['description']:
                 message += f"   \U0001F4DD {tx['description']}\n"
             message += f"   \U0001F4C5 {tx['timestamp'][:19].replace('T', ' ')}\n\n"
-        await update.message.reply_text(message, parse_mode='Markdown')
+
+        # Buttons carry the keyset cursor, so each page reads only its own rows
+        buttons = []
+        if has_newer:
+            buttons.append(InlineKeyboardButton("\u2B05\uFE0F Newer", callback_data=f"wallet_history:newer:{page[-1]['id']}"))
+        if has_older:
+            buttons.append(InlineKeyboardButton("Older \u27A1\uFE0F", callback_data=f"wallet_history:older:{page[0]['id']}"))
+        reply_markup = InlineKeyboardMarkup([buttons]) if buttons else None
+        return message, reply_markup
+
+    @staticmethod
+    @track_metrics
+    @log_message
+    async def handle_wallet_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Show the newest page of the user's wallet transaction history"""
+        user = update.effective_user
+        await db.run(db.add_user, user.id, user.username, user.first_name, user.language_code)
+        page, has_older, has_newer = await db.run(db.get_wallet_history_page, user.id, WalletHandler.HISTORY_PAGE_SIZE)
+        if not page:
+            await update.message.reply_text("\U0001F4DD No wallet transactions found.")
+            return
+        message, reply_markup = WalletHandler._format_history_page(page, has_older, has_newer)
+        await update.message.reply_text(message, parse_mode='Markdown', reply_markup=reply_markup)
+
+    @staticmethod
+    @track_metrics
+    async def handle_wallet_history_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Switch the history message to the older/newer page selected by an inline button"""
+        query = update.callback_query
+        await query.answer()
+        try:
+            _, direction, cursor = query.data.split(":")
+            cursor = int(cursor)
+        except ValueError:
+            return
+        if direction == "older":
+            result = await db.run(db.get_wallet_history_page, query.from_user.id,
+                                  WalletHandler.HISTORY_PAGE_SIZE, before_id=cursor)
+        else:
+            result = await db.run(db.get_wallet_history_page, query.from_user.id,
+                                  WalletHandler.HISTORY_PAGE_SIZE, after_id=cursor)
+        page, has_older, has_newer = result
+        if not page:
+            return
+        message, reply_markup = WalletHandler._format_history_page(page, has_older, has_newer)
+        await query.edit_message_text(message, parse_mode='Markdown', reply_markup=reply_markup)
 
     @staticmethod
+    @track_metrics
     @log_message
     async def handle_wallet_deposit(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Initiate deposit using Xendit invoice"""
         user = update.effective_user
-        db.add_user(user.id, user.username, user.first_name)
+        await db.run(db.add_user, user.id, user.username, user.first_name, user.language_code)
         args = context.args
         if not args or not args[0].replace('.', '', 1).isdigit():
             await update.message.reply_text("Usage: /wallet_deposit <amount>")
             return
         amount = float(args[0])
-        await update.message.reply_text("Creating payment invoice...")
-        invoice = await create_invoice(amount, user.id)
+        invoices = get_invoice_registry()
+        if invoices.get(user.id, amount, "payment link") is None:
+            await update.message.reply_text("Creating payment invoice...")
+        invoice = await invoices.open_invoice(user.id, amount, "payment link")
         if invoice.get("error"):
-            await update.message.reply_text(f"Error creating invoice: {invoice['error']}")
+            await update.message.reply_text(f"❌ {invoice['error']}")
             return
         pay_url = invoice.get("invoice_url")
-        if pay_url:
+        if pay_url and invoice.get("reused"):
+            await update.message.reply_text(f"You already have an open invoice for this amount. Please pay using this link: {pay_url}")
+        elif pay_url:
             await update.message.reply_text(f"Please pay using this link: {pay_url}")
         else:
             await update.message.reply_text("Failed to get payment link.")
 
     @staticmethod
+    @track_metrics
     @log_message
     async def handle_wallet_withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Initiate withdrawal using Xendit disbursement"""
         user = update.effective_user
-        db.add_user(user.id, user.username, user.first_name)
+        await db.run(db.add_user, user.id, user.username, user.first_name, user.language_code)
         args = context.args
         if len(args) < 4:
             await update.message.reply_text(
@@ -90,12 +139,12 @@ class WalletHandler:
         await update.message.reply_text("Processing withdrawal...")
         result = await create_withdrawal(amount, user.id, bank_code, account_number, account_holder_name)
         if result.get("error"):
-            await update.message.reply_text(f"Error: {result['error']}")
+            await update.message.reply_text(f"❌ {result['error']}")
         else:
             await update.message.reply_text(f"Withdrawal request submitted! Status: {result.get('status', 'unknown')}")
         """Handle wallet deposit request (demo)"""
         user = update.effective_user
-        db.add_user(user.id, user.username, user.first_name)
+        await db.run(db.add_user, user.id, user.username, user.first_name, user.language_code)
         
         if not context.args:
             await update.message.reply_text("❌ Usage: /wallet_deposit <amount>\nExample: /wallet_deposit 50.00")
@@ -109,8 +158,10 @@ class WalletHandler:
             
             # In a real implementation, you would integrate with payment processors
             # For demo purposes, we'll simulate a successful deposit
-            db.update_wallet_balance(user.id, amount, "deposit", f"Demo deposit of ${amount:.2f}")
-            new_balance = db.get_wallet_balance(user.id)
+            await db.run(db.update_wallet_balance, user.id, amount, "deposit", f"Demo deposit of ${amount:.2f}")
+            if BotConfig.DB_DURABLE_WALLET:
+                await db.commit()
+            new_balance = await db.run(db.get_wallet_balance, user.id)
             
             message = f"✅ **Deposit Successful!**\n\n"
             message += f"💵 Amount: +${amount:.2f}\n"
@@ -124,11 +175,12 @@ class WalletHandler:
             await update.message.reply_text("❌ Invalid amount. Please enter a valid number.")
     
     @staticmethod
+    @track_metrics
     @log_message
     async def handle_wallet_withdraw(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle wallet withdrawal request (demo)"""
         user = update.effective_user
-        db.add_user(user.id, user.username, user.first_name)
+        await db.run(db.add_user, user.id, user.username, user.first_name, user.language_code)
         
         if not context.args:
             await update.message.reply_text("❌ Usage: /wallet_withdraw <amount>\nExample: /wallet_withdraw 25.00")
@@ -140,15 +192,17 @@ class WalletHandler:
                 await update.message.reply_text("❌ Amount must be greater than 0.")
                 return
             
-            current_balance = db.get_wallet_balance(user.id)
+            current_balance = await db.run(db.get_wallet_balance, user.id)
             if amount > current_balance:
                 await update.message.reply_text(f"❌ Insufficient funds. Your balance is ${current_balance:.2f}")
                 return
             
             # In a real implementation, you would process the withdrawal
             # For demo purposes, we'll simulate a successful withdrawal
-            db.update_wallet_balance(user.id, -amount, "withdrawal", f"Demo withdrawal of ${amount:.2f}")
-            new_balance = db.get_wallet_balance(user.id)
+            await db.run(db.update_wallet_balance, user.id, -amount, "withdrawal", f"Demo withdrawal of ${amount:.2f}")
+            if BotConfig.DB_DURABLE_WALLET:
+                await db.commit()
+            new_balance = await db.run(db.get_wallet_balance, user.id)
             
             message = f"✅ **Withdrawal Successful!**\n\n"
             message += f"💵 Amount: -${amount:.2f}\n"
@@ -162,6 +216,7 @@ class WalletHandler:
             await update.message.reply_text("❌ Invalid amount. Please enter a valid number.")
     
     @staticmethod
+    @track_metrics
     @admin_required
     async def handle_admin_add_funds(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Admin command to add funds to user wallet"""
@@ -177,13 +232,15 @@ class WalletHandler:
                 await update.message.reply_text("❌ Amount must be greater than 0.")
                 return
             
-            user = db.get_user(target_user_id)
+            user = await db.run(db.get_user, target_user_id)
             if not user:
                 await update.message.reply_text(f"❌ User {target_user_id} not found in database.")
                 return
             
-            db.update_wallet_balance(target_user_id, amount, "admin_credit", f"Admin credit by {update.effective_user.first_name}")
-            new_balance = db.get_wallet_balance(target_user_id)
+            await db.run(db.update_wallet_balance, target_user_id, amount, "admin_credit", f"Admin credit by {update.effective_user.first_name}")
+            if BotConfig.DB_DURABLE_WALLET:
+                await db.commit()
+            new_balance = await db.run(db.get_wallet_balance, target_user_id)
             
             message = f"✅ **Funds Added Successfully!**\n\n"
             message += f"👤 User: {user['first_name']} ({target_user_id})\n"
@@ -197,18 +254,34 @@ class WalletHandler:
             await update.message.reply_text("❌ Invalid user ID or amount. Please check your input.")
     
     @staticmethod
+    @track_metrics
     @admin_required
     async def handle_wallet_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Admin command to show wallet statistics"""
-        total_users = db.get_total_users()
-        total_balance = db.get_total_wallet_balance()
-        
-        users_with_balance = len([u for u in db.get_all_users() if u['wallet_balance'] > 0])
+        stats = await db.run(db.get_wallet_stats)
+        total_users = stats['total_users']
+        total_balance = stats['total_balance']
         
         message = f"📊 **Wallet Statistics**\n\n"
         message += f"👥 Total Users: {total_users}\n"
         message += f"💰 Total Balance: ${total_balance:.2f}\n"
-        message += f"💵 Users with Balance: {users_with_balance}\n"
-        message += f"📈 Average Balance: ${total_balance/total_users if total_users > 0 else 0:.2f}"
+        message += f"💵 Users with Balance: {stats['positive_users']}\n"
+        message += f"📈 Average Balance: ${total_balance/total_users if total_users > 0 else 0:.2f}\n\n"
+        message += "📶 **Balance Distribution:**\n"
+        for label, count in stats['histogram']:
+            if count:
+                message += f"• ${label}: {count}\n"
         
-        await update.message.reply_text(message, parse_mode='Markdown')
\ No newline at end of file
+        await update.message.reply_text(message, parse_mode='Markdown')
+    
+    @staticmethod
+    @track_metrics
+    @admin_required
+    async def handle_wallet_verify_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Admin command to check the running wallet statistics against a full recount"""
+        await update.message.reply_text("🔍 Recounting all wallets...")
+        if await db.run(db.verify_aggregates):
+            await update.message.reply_text("✅ Wallet statistics are consistent.")
+        else:
+            await update.message.reply_text("⚠️ Wallet statistics had drifted and were rebuilt from a full recount.")
+            logger.warning(f"Wallet aggregates drifted; rebuilt by admin {update.effective_user.id}")
\ No newline at end of file
@@ -1,147 +1,28 @@
 #!/usr/bin/env python3
-import logging
-from telegram.ext import Application, CommandHandler, MessageHandler, filters
-from bot_config import BotConfig
-from handlers.message_handler import MessageHandler
-from handlers.admin_handler import AdminHandler
-from handlers.wallet_handler import WalletHandler
-from handlers.broadcast_handler import BroadcastHandler
-
-from flask import Flask, request, jsonify
-import os
-
-from telegram import Update as TgUpdate
-
-
-
-# --- Flask app at module level for Gunicorn ---
-app = Flask(__name__)
-application = None
-
-@app.route('/', methods=['GET'])
-def root_health():
-    return 'OK', 200
-
-@app.route('/health', methods=['GET'])
-def health():
-    return jsonify({'status': 'ok'}), 200
-
-@app.route('/telegram/webhook', methods=['POST'])
-def telegram_webhook():
-    global application
-    update_json = request.get_json(force=True)
-    if application:
-        update = TgUpdate.de_json(update_json, application.bot)
-        application.update_queue.put(update)
-        return jsonify({'status': 'received'}), 200
-    else:
-        return jsonify({'status': 'bot not initialized'}), 500
-
-def setup_logging():
-    """Setup logging configuration"""
-    if BotConfig.ENABLE_LOGGING:
-        logging.basicConfig(
-            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-            level=getattr(logging, BotConfig.LOG_LEVEL, logging.INFO)
-        )
-        logger = logging.getLogger(__name__)
-        logger.info("Logging configured successfully")
-
-def main():
-    """Main function to run the bot"""
-    setup_logging()
-    logger = logging.getLogger(__name__)
-
-    # Create application
-    global application
-    logger.info("Initializing Telegram Bot...")
-    application = Application.builder().token(BotConfig.BOT_TOKEN).build()
-
-    # Add message handlers
-    logger.info("Adding message handlers...")
-    application.add_handler(CommandHandler("start", MessageHandler.handle_start))
-    application.add_handler(CommandHandler("help", MessageHandler.handle_help))
-    application.add_handler(CommandHandler("info", MessageHandler.handle_info))
-
-    # Add wallet handlers
-    logger.info("Adding wallet handlers...")
-    application.add_handler(CommandHandler("wallet", WalletHandler.handle_wallet_balance))
-    application.add_handler(CommandHandler("wallet_history", WalletHandler.handle_wallet_history))
-    application.add_handler(CommandHandler("wallet_deposit", WalletHandler.handle_wallet_deposit))
-    application.add_handler(CommandHandler("wallet_withdraw", WalletHandler.handle_wallet_withdraw))
-
-    # Add admin handlers
-    logger.info("Adding admin handlers...")
-    application.add_handler(CommandHandler("admin_help", AdminHandler.handle_admin_help))
-    application.add_handler(CommandHandler("admin_stats", AdminHandler.handle_admin_stats))
-    application.add_handler(CommandHandler("admin_list", AdminHandler.handle_list_admins))
-    application.add_handler(CommandHandler("user_list", AdminHandler.handle_user_list))
-    application.add_handler(CommandHandler("add_admin", AdminHandler.handle_add_admin))
-    application.add_handler(CommandHandler("remove_admin", AdminHandler.handle_remove_admin))
-    application.add_handler(CommandHandler("admin_shutdown", AdminHandler.handle_shutdown))
-
-    # Add admin wallet handlers
-    application.add_handler(CommandHandler("admin_add_funds", WalletHandler.handle_admin_add_funds))
-    application.add_handler(CommandHandler("wallet_stats", WalletHandler.handle_wallet_stats))
-
-    # Add broadcast handlers
-    logger.info("Adding broadcast handlers...")
-    application.add_handler(CommandHandler("broadcast", BroadcastHandler.handle_broadcast))
-    application.add_handler(CommandHandler("broadcast_confirm", BroadcastHandler.handle_broadcast_confirm))
-    application.add_handler(CommandHandler("broadcast_cancel", BroadcastHandler.handle_broadcast_cancel))
-    application.add_handler(CommandHandler("broadcast_test", BroadcastHandler.handle_broadcast_test))
-
-    # Add content handlers
-    logger.info("Adding content handlers...")
-    from telegram.ext import MessageHandler as TgMessageHandler, filters
-    from handlers.message_handler import MessageHandler as CustomMessageHandler
-    application.add_handler(TgMessageHandler(filters.TEXT & ~filters.COMMAND, CustomMessageHandler.handle_text_message))
-    # If you have handle_photo and handle_document methods, add them similarly:
-    # application.add_handler(TgMessageHandler(filters.PHOTO, CustomMessageHandler.handle_photo))
-    # application.add_handler(TgMessageHandler(filters.DOCUMENT, CustomMessageHandler.handle_document))
-
-
-
-    # Set webhook for Telegram
-    webhook_url = os.environ.get('WEBHOOK_URL')
-    if webhook_url:
-        application.bot.set_webhook(webhook_url)
-        logger.info(f"Webhook set to {webhook_url}")
-    else:
-        logger.warning("WEBHOOK_URL not set. Bot will not receive updates via webhook.")
-
-    logger.info("Bot initialized and ready for webhook updates.")
-
-import threading
-
-def run_bot():
-    if application:
-        application.run_polling()
-
-if __name__ == '__main__':
-    try:
-        main()
-        # Start the bot in a background thread
-        bot_thread = threading.Thread(target=run_bot, daemon=True)
-        bot_thread.start()
-    except KeyboardInterrupt:
-        print("\n🛑 Bot stopped by user")
-    except Exception as e:
-        print(f"❌ Error starting bot: {e}")
-        logging.error(f"Bot startup error: {e}")
-#!/usr/bin/env python3
 """
 Modular Telegram Bot
 A feature-rich Telegram bot with message handling, wallet functionality, and admin functions.
 """
 
+import asyncio
 import logging
-from telegram.ext import Application, CommandHandler, MessageHandler, filters
+from telegram import Update as TgUpdate
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, filters
 from bot_config import BotConfig
 from handlers.message_handler import MessageHandler
 from handlers.admin_handler import AdminHandler
 from handlers.wallet_handler import WalletHandler
 from handlers.broadcast_handler import BroadcastHandler
+from database import get_database
+from utils.broadcast_jobs import BroadcastManager
+from utils.ingestion import UpdateQueue
+from utils.invoices import get_invoice_registry, sweep_expired_invoices
+from utils.metrics import MeteredRequest
+from utils.payments import InvoiceSettler
+from utils.sharding import serve_shard
+from utils.update_processor import PerUserUpdateProcessor
+from utils.webhook import serve_webhook
+from utils.xendit_api import get_xendit_client
 
 # Configure logging
 def setup_logging():
@@ -154,6 +35,33 @@ def setup_logging():
         logger = logging.getLogger(__name__)
         logger.info("Logging configured successfully")
 
+async def post_init(application: Application):
+    """Start background services once the bot's event loop is running"""
+    await application.bot_data['db'].start()
+    await application.bot_data['xendit'].start()
+    await application.bot_data['broadcasts'].resume_unfinished(application)
+
+async def post_shutdown(application: Application):
+    """Checkpoint running broadcasts, close the Xendit pool and drain pending database writes before the process exits"""
+    await application.bot_data['broadcasts'].shutdown()
+    await application.bot_data['xendit'].close()
+    await application.bot_data['db'].stop()
+
+def run_application(application: Application):
+    """Serve the webhook from the Application's own event loop when WEBHOOK_URL is set, otherwise poll.
+
+    A worker started by the multi-process dispatcher (SHARD_INDEX set)
+    takes its updates from the dispatcher instead.
+    """
+    if BotConfig.SHARD_INDEX is not None:
+        asyncio.run(serve_shard(application, BotConfig.SHARD_INDEX, BotConfig.SHARD_SOCKET_DIR))
+    elif BotConfig.WEBHOOK_URL:
+        asyncio.run(serve_webhook(application, BotConfig.WEBHOOK_URL, BotConfig.WEBHOOK_HOST, BotConfig.PORT,
+                                  BotConfig.WEBHOOK_SECRET_TOKEN))
+    else:
+        logging.getLogger(__name__).warning("WEBHOOK_URL not set, polling for updates instead.")
+        application.run_polling(allowed_updates=TgUpdate.ALL_TYPES)
+
 def main():
     """Main function to run the bot"""
     # Setup logging
@@ -162,7 +70,27 @@ def main():
     
     # Create application
     logger.info("Initializing Telegram Bot...")
-    application = Application.builder().token(BotConfig.BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BotConfig.BOT_TOKEN)
+        .request(MeteredRequest(connection_pool_size=256))
+        .update_queue(UpdateQueue(BotConfig.UPDATE_QUEUE_SIZE, BotConfig.UPDATE_QUEUE_SHED_AT,
+                                  BotConfig.UPDATE_QUEUE_SHED_POLICY))
+        .concurrent_updates(PerUserUpdateProcessor(BotConfig.UPDATE_CONCURRENCY, BotConfig.UPDATE_QUEUE_SIZE))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+
+    # Every handler module reads and writes this single store
+    application.bot_data['db'] = get_database()
+    application.bot_data['broadcasts'] = BroadcastManager(application.bot_data['db'], BotConfig.BROADCAST_JOBS_FILE)
+    application.bot_data['xendit'] = get_xendit_client()
+    application.bot_data['invoices'] = get_invoice_registry()
+    application.bot_data['payments'] = InvoiceSettler(application.bot_data['db'], application.bot,
+                                                      application.bot_data['invoices'])
+    application.job_queue.run_repeating(sweep_expired_invoices, interval=BotConfig.INVOICE_SWEEP_INTERVAL,
+                                        first=BotConfig.INVOICE_SWEEP_INTERVAL)
     
     # Add message handlers
     logger.info("Adding message handlers...")
@@ -174,6 +102,7 @@ def main():
     logger.info("Adding wallet handlers...")
     application.add_handler(CommandHandler("wallet", WalletHandler.handle_wallet_balance))
     application.add_handler(CommandHandler("wallet_history", WalletHandler.handle_wallet_history))
+    application.add_handler(CallbackQueryHandler(WalletHandler.handle_wallet_history_page, pattern=r"^wallet_history:"))
     application.add_handler(CommandHandler("wallet_deposit", WalletHandler.handle_wallet_deposit))
     application.add_handler(CommandHandler("wallet_withdraw", WalletHandler.handle_wallet_withdraw))
     
@@ -190,19 +119,27 @@ def main():
     # Add admin wallet handlers
     application.add_handler(CommandHandler("admin_add_funds", WalletHandler.handle_admin_add_funds))
     application.add_handler(CommandHandler("wallet_stats", WalletHandler.handle_wallet_stats))
+    application.add_handler(CommandHandler("wallet_verify_stats", WalletHandler.handle_wallet_verify_stats))
     
     # Add broadcast handlers
     logger.info("Adding broadcast handlers...")
     application.add_handler(CommandHandler("broadcast", BroadcastHandler.handle_broadcast))
     application.add_handler(CommandHandler("broadcast_confirm", BroadcastHandler.handle_broadcast_confirm))
     application.add_handler(CommandHandler("broadcast_cancel", BroadcastHandler.handle_broadcast_cancel))
+    application.add_handler(CommandHandler("broadcast_status", BroadcastHandler.handle_broadcast_status))
+    application.add_handler(CommandHandler("broadcast_pause", BroadcastHandler.handle_broadcast_pause))
+    application.add_handler(CommandHandler("broadcast_resume", BroadcastHandler.handle_broadcast_resume))
+    application.add_handler(CommandHandler("broadcast_reprobe", BroadcastHandler.handle_broadcast_reprobe))
     application.add_handler(CommandHandler("broadcast_test", BroadcastHandler.handle_broadcast_test))
+    application.add_handler(CommandHandler("broadcast_media", BroadcastHandler.handle_broadcast_media))
     
     # Add content handlers
     logger.info("Adding content handlers...")
     from telegram.ext import MessageHandler as TgMessageHandler, filters
     from handlers.message_handler import MessageHandler as CustomMessageHandler
     application.add_handler(TgMessageHandler(filters.TEXT & ~filters.COMMAND, CustomMessageHandler.handle_text_message))
+    # Album items sent by admins, collected for /broadcast replies
+    application.add_handler(TgMessageHandler(filters.PHOTO | filters.VIDEO | filters.Document.ALL, BroadcastHandler.handle_album_item))
     # If you have handle_photo and handle_document methods, add them similarly:
     # application.add_handler(TgMessageHandler(filters.PHOTO, CustomMessageHandler.handle_photo))
     # application.add_handler(TgMessageHandler(filters.DOCUMENT, CustomMessageHandler.handle_document))
@@ -219,63 +156,8 @@ def main():
     print("⏹️  Press Ctrl+C to stop the bot")
     
 
-    from flask import Flask, request, jsonify
-    import os
-
-    # Flask app at module level for Gunicorn
-    app = Flask(__name__)
-
-    # Telegram bot Application will be initialized in main()
-    application = None
-
-    @app.route('/', methods=['GET'])
-    def root_health():
-        return 'OK', 200
-
-    @app.route('/health', methods=['GET'])
-    def health():
-        return jsonify({'status': 'ok'}), 200
-
-    @app.route('/telegram/webhook', methods=['POST'])
-    def telegram_webhook():
-        global application
-        update = request.get_json(force=True)
-        if application:
-            application.update_queue.put(update)
-            return jsonify({'status': 'received'}), 200
-        else:
-            return jsonify({'status': 'bot not initialized'}), 500
-    # Set up Flask app for webhook and health check
-    from flask import Flask, request, jsonify
-    import os
-
-    app = Flask(__name__)
-
-
-    @app.route('/', methods=['GET'])
-    def root_health():
-        return 'OK', 200
-
-    @app.route('/health', methods=['GET'])
-    def health():
-        return jsonify({'status': 'ok'}), 200
-
-    @app.route('/telegram/webhook', methods=['POST'])
-    def telegram_webhook():
-        update = request.get_json(force=True)
-        application.update_queue.put(update)
-        return jsonify({'status': 'received'}), 200
-
-    # Set webhook for Telegram
-    webhook_url = os.environ.get('WEBHOOK_URL')
-    if webhook_url:
-        application.bot.set_webhook(webhook_url)
-        logger.info(f"Webhook set to {webhook_url}")
-    else:
-        logger.warning("WEBHOOK_URL not set. Bot will not receive updates via webhook.")
-
-    # Run Flask app
-    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)))
+    # Webhook server and bot share one event loop
+    run_application(application)
 
 if __name__ == '__main__':
     try:
@@ -0,0 +1,29 @@
+import time
+from typing import Dict, Optional
+
+
+class ActivityTracker:
+    """In-memory last-seen times for users, kept as epoch seconds.
+
+    Touching a user only updates a dict entry; the store drains the tracker
+    on a timer and persists all changed timestamps in one bulk write.
+    """
+
+    def __init__(self):
+        self._seen: Dict[int, int] = {}
+
+    def touch(self, user_id: int, timestamp: int = None):
+        """Record that a user was active now (or at the given epoch second)"""
+        self._seen[user_id] = int(time.time()) if timestamp is None else timestamp
+
+    def get(self, user_id: int) -> Optional[int]:
+        """Get the unflushed last-seen time for a user, if any"""
+        return self._seen.get(user_id)
+
+    def drain(self) -> Dict[int, int]:
+        """Take every timestamp recorded since the last drain"""
+        seen, self._seen = self._seen, {}
+        return seen
+
+    def __len__(self) -> int:
+        return len(self._seen)
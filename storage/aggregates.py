@@ -0,0 +1,84 @@
+from bisect import bisect_left
+from typing import Dict, Iterable, List
+
+# Upper bounds of the positive balance buckets; anything above the last
+# bound falls into a final open-ended bucket
+POSITIVE_BOUNDS = (1, 10, 100, 1000, 10000, 100000)
+
+
+def balance_bucket(balance: float) -> int:
+    """Map a balance to its histogram bucket: negative, zero, then POSITIVE_BOUNDS"""
+    if balance < 0:
+        return 0
+    if balance == 0:
+        return 1
+    return 2 + bisect_left(POSITIVE_BOUNDS, balance)
+
+
+def bucket_labels() -> List[str]:
+    """Human-readable labels for every histogram bucket"""
+    labels = ["< 0", "0"]
+    lower = 0
+    for bound in POSITIVE_BOUNDS:
+        labels.append(f"{lower}-{bound}")
+        lower = bound
+    labels.append(f"> {lower}")
+    return labels
+
+
+BUCKET_COUNT = len(POSITIVE_BOUNDS) + 3
+
+
+class WalletAggregates:
+    """Running user and wallet totals, updated on every user insert and balance change"""
+
+    def __init__(self):
+        self.total_users = 0
+        self.total_balance = 0.0
+        self.positive_users = 0
+        self.histogram = [0] * BUCKET_COUNT
+
+    def add_user(self, balance: float = 0.0):
+        self.total_users += 1
+        self.total_balance += balance
+        self.positive_users += balance > 0
+        self.histogram[balance_bucket(balance)] += 1
+
+    def update_balance(self, old_balance: float, new_balance: float):
+        self.total_balance += new_balance - old_balance
+        self.positive_users += (new_balance > 0) - (old_balance > 0)
+        self.histogram[balance_bucket(old_balance)] -= 1
+        self.histogram[balance_bucket(new_balance)] += 1
+
+    @classmethod
+    def recompute(cls, balances: Iterable[float]) -> "WalletAggregates":
+        """Build the aggregates from scratch with a full pass over all balances"""
+        aggregates = cls()
+        for balance in balances:
+            aggregates.add_user(balance)
+        return aggregates
+
+    def matches(self, other: "WalletAggregates") -> bool:
+        """Compare with another set of aggregates, allowing for float rounding"""
+        tolerance = 1e-6 * max(1.0, abs(other.total_balance))
+        return (self.total_users == other.total_users
+                and self.positive_users == other.positive_users
+                and self.histogram == other.histogram
+                and abs(self.total_balance - other.total_balance) <= tolerance)
+
+    def as_dict(self) -> Dict:
+        return {
+            'total_users': self.total_users,
+            'total_balance': self.total_balance,
+            'positive_users': self.positive_users,
+            'histogram': list(self.histogram)
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "WalletAggregates":
+        aggregates = cls()
+        aggregates.total_users = data['total_users']
+        aggregates.total_balance = data['total_balance']
+        aggregates.positive_users = data['positive_users']
+        aggregates.histogram = list(data['histogram'])
+        return aggregates
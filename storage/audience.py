@@ -0,0 +1,135 @@
+import heapq
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime
+from itertools import islice
+from typing import Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+
+# Suffixes accepted by --active-since, in seconds
+DURATION_UNITS = {'m': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400}
+
+
+def parse_duration(text: str) -> int:
+    """Parse a duration such as 30m, 12h, 7d or 2w into seconds (plain numbers are days)"""
+    text = text.strip().lower()
+    unit = DURATION_UNITS.get(text[-1:]) if text else None
+    number = text[:-1] if unit else text
+    seconds = float(number) * (unit or DURATION_UNITS['d'])
+    if seconds <= 0:
+        raise ValueError(f"Duration must be positive: {text}")
+    return int(seconds)
+
+
+class Audience:
+    """Which users a broadcast goes to.
+
+    Every criterion is optional and they combine with AND; an Audience with
+    none set is everyone. active_since is an epoch second, min_balance is in
+    currency units and language is a Telegram language_code such as "id".
+    """
+
+    def __init__(self, active_since: Optional[int] = None, min_balance: Optional[float] = None,
+                 language: Optional[str] = None):
+        self.active_since = active_since
+        self.min_balance = min_balance
+        self.language = language.lower() if language else None
+
+    @property
+    def is_everyone(self) -> bool:
+        return self.active_since is None and self.min_balance is None and self.language is None
+
+    @classmethod
+    def parse_args(cls, args: List[str], now: Optional[float] = None) -> Tuple["Audience", List[str]]:
+        """Split leading --active-since/--min-balance/--lang flags off command arguments.
+
+        Returns the audience and the remaining arguments (the message).
+        Raises ValueError for an unknown flag or a bad value.
+        """
+        now = datetime.now().timestamp() if now is None else now
+        audience = cls()
+        args = list(args)
+        # Some clients turn a typed "--" into an em dash
+        while args and args[0].startswith(('--', '\u2014')):
+            flag = '--' + args.pop(0).lstrip('-\u2014')
+            if not args:
+                raise ValueError(f"{flag} needs a value")
+            value = args.pop(0)
+            if flag == '--active-since':
+                audience.active_since = int(now) - parse_duration(value)
+            elif flag == '--min-balance':
+                audience.min_balance = float(value)
+            elif flag == '--lang':
+                audience.language = value.lower()
+            else:
+                raise ValueError(f"Unknown option {flag}")
+        return audience, args
+
+    def describe(self) -> str:
+        """Human-readable summary for previews and status messages"""
+        if self.is_everyone:
+            return "all users"
+        parts = []
+        if self.active_since is not None:
+            parts.append(f"active since {datetime.fromtimestamp(self.active_since).strftime('%Y-%m-%d %H:%M')}")
+        if self.min_balance is not None:
+            parts.append(f"balance ≥ {self.min_balance:.2f}")
+        if self.language is not None:
+            parts.append(f"language {self.language}")
+        return ", ".join(parts)
+
+    def as_dict(self) -> Dict:
+        return {'active_since': self.active_since, 'min_balance': self.min_balance, 'language': self.language}
+
+    @classmethod
+    def from_dict(cls, data: Optional[Dict]) -> "Audience":
+        if not data:
+            return cls()
+        return cls(data.get('active_since'), data.get('min_balance'), data.get('language'))
+
+
+class SortedBuckets:
+    """Secondary index from a bucket key to the rows in it.
+
+    Each bucket is an int64 array of row numbers kept sorted, so a bucket
+    can be counted by its length and several buckets can be walked together
+    in row order from any position. Moving a row between buckets costs a
+    bisect and a memmove in each.
+    """
+
+    def __init__(self):
+        self.buckets: Dict[Hashable, array] = {}
+
+    def add(self, key: Hashable, row: int):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            self.buckets[key] = array('q', (row,))
+        elif bucket[-1] < row:
+            # New users have the highest row number
+            bucket.append(row)
+        else:
+            insort(bucket, row)
+
+    def remove(self, key: Hashable, row: int):
+        bucket = self.buckets[key]
+        del bucket[bisect_left(bucket, row)]
+        if not bucket:
+            del self.buckets[key]
+
+    def move(self, row: int, old_key: Hashable, new_key: Hashable):
+        if old_key != new_key:
+            self.remove(old_key, row)
+            self.add(new_key, row)
+
+    def count(self, keys: Iterable[Hashable]) -> int:
+        """Number of rows in the given buckets"""
+        return sum(len(self.buckets[key]) for key in keys if key in self.buckets)
+
+    def rows_after(self, keys: Iterable[Hashable], after: int) -> Iterator[int]:
+        """Rows above a position across the given buckets, in ascending row order"""
+        streams = []
+        for key in keys:
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                start = bisect_right(bucket, after)
+                streams.append(islice(bucket, start, None))
+        return iter(streams[0]) if len(streams) == 1 else heapq.merge(*streams)
@@ -0,0 +1,198 @@
+import json
+import os
+import logging
+from typing import Dict, Iterator, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Reserved snapshot key holding engine metadata (never a user id)
+META_KEY = "_meta"
+
+
+class JournalStore:
+    """Append-only journal of mutations with periodic snapshot compaction.
+
+    Every mutation is appended as one compact JSON line to the journal file.
+    Once the journal has grown past the size of the data set it is compacted
+    into a full snapshot (the classic users.json file) and truncated, so the
+    amortized write cost per mutation stays constant. On startup the snapshot
+    is loaded and the journal is replayed on top of it.
+    """
+
+    def __init__(self, snapshot_file: str, journal_file: str = None,
+                 compact_min_records: int = 10000, compact_ratio: float = 1.0,
+                 fsync: bool = False):
+        self.snapshot_file = snapshot_file
+        self.journal_file = journal_file or f"{snapshot_file}.journal"
+        self.compact_min_records = compact_min_records
+        self.compact_ratio = compact_ratio
+        self.fsync = fsync
+        self.seq = 0
+        self.records_since_compaction = 0
+        self._snapshot_seq = 0
+        self._journal = None
+        self.meta: Dict = {}
+
+    def load_snapshot(self) -> Dict:
+        """Load the last snapshot, returning the stored data without metadata"""
+        data = {}
+        if os.path.exists(self.snapshot_file):
+            try:
+                with open(self.snapshot_file, 'r') as f:
+                    data = json.load(f)
+            except (json.JSONDecodeError, FileNotFoundError):
+                logger.error(f"Snapshot {self.snapshot_file} is unreadable, starting empty")
+                data = {}
+        meta = data.pop(META_KEY, None) or {}
+        self.meta = meta
+        self._snapshot_seq = meta.get('seq', 0)
+        self.seq = self._snapshot_seq
+        return data
+
+    def stream_snapshot(self, chunk_size: int = 1 << 20) -> Iterator[Tuple[str, Dict]]:
+        """Yield (key, value) snapshot entries without loading the whole file"""
+        self._snapshot_seq = 0
+        self.seq = 0
+        self.meta = {}
+        if not os.path.exists(self.snapshot_file):
+            return
+        decoder = json.JSONDecoder()
+        with open(self.snapshot_file, 'r') as f:
+            buf = f.read(chunk_size).lstrip()
+            if not buf.startswith('{'):
+                raise ValueError(f"Snapshot {self.snapshot_file} is not a JSON object")
+            pos = 1
+            eof = False
+
+            def decode_next():
+                nonlocal buf, pos, eof
+                while True:
+                    while pos < len(buf) and buf[pos] in ' \t\r\n,:':
+                        pos += 1
+                    if pos < len(buf) and buf[pos] == '}':
+                        return None
+                    try:
+                        value, end = decoder.raw_decode(buf, pos)
+                        if end < len(buf) or eof:
+                            pos = end
+                            return value
+                    except json.JSONDecodeError:
+                        if eof:
+                            raise
+                    chunk = f.read(chunk_size)
+                    eof = not chunk
+                    buf = buf[pos:] + chunk
+                    pos = 0
+
+            while True:
+                key = decode_next()
+                if key is None:
+                    return
+                value = decode_next()
+                if key == META_KEY:
+                    self.meta = value
+                    self._snapshot_seq = self.seq = value.get('seq', 0)
+                    continue
+                yield key, value
+
+    def replay(self) -> Iterator[Dict]:
+        """Yield journal records newer than the loaded snapshot"""
+        if not os.path.exists(self.journal_file):
+            return
+        with open(self.journal_file, 'r') as f:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # A torn write can only affect the tail of the journal
+                    logger.warning(f"Skipping corrupt journal record at {self.journal_file}:{line_no}")
+                    continue
+                seq = record.get('seq', 0)
+                if seq <= self._snapshot_seq:
+                    continue
+                self.seq = max(self.seq, seq)
+                self.records_since_compaction += 1
+                yield record
+
+    def _open_journal(self):
+        if self._journal is None:
+            self._journal = open(self.journal_file, 'a')
+        return self._journal
+
+    def next_seq(self) -> int:
+        """Allocate the sequence number for a new record"""
+        self.seq += 1
+        return self.seq
+
+    def encode(self, record: Dict) -> str:
+        """Serialize one record as a compact journal line"""
+        return json.dumps(record, separators=(',', ':'), default=str) + "\n"
+
+    def append(self, record: Dict):
+        """Append a single record to the journal"""
+        self.write_lines([self.encode(record)])
+
+    def write_lines(self, lines: List[str]) -> int:
+        """Append pre-encoded records in one write, returning the bytes written"""
+        if not lines:
+            return 0
+        payload = "".join(lines)
+        journal = self._open_journal()
+        journal.write(payload)
+        journal.flush()
+        if self.fsync:
+            os.fsync(journal.fileno())
+        self.records_since_compaction += len(lines)
+        return len(payload)
+
+    def needs_compaction(self, size: int) -> bool:
+        """Check whether the journal has outgrown the data set it describes"""
+        threshold = max(self.compact_min_records, int(size * self.compact_ratio))
+        return self.records_since_compaction >= threshold
+
+    def compact(self, data: Dict, seq: int = None, meta: Dict = None):
+        """Write a full snapshot (plus optional checkpointed metadata) and truncate the journal records it covers"""
+        seq = self.seq if seq is None else seq
+        meta = dict(meta or {}, seq=seq)
+        tmp_file = f"{self.snapshot_file}.tmp"
+        with open(tmp_file, 'w') as f:
+            f.write('{' + json.dumps(META_KEY) + ':' + json.dumps(meta, separators=(',', ':')))
+            for key, value in data.items():
+                f.write(',' + json.dumps(str(key)) + ':')
+                f.write(json.dumps(value, separators=(',', ':'), default=str))
+            f.write('}')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.snapshot_file)
+        self._snapshot_seq = seq
+        self.meta = meta
+
+        # Records newer than the snapshot must survive the truncation
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        kept = [] if seq == self.seq else self._lines_after(seq)
+        with open(self.journal_file, 'w') as f:
+            f.writelines(kept)
+        self.records_since_compaction = len(kept)
+
+    def _lines_after(self, seq: int) -> List[str]:
+        if not os.path.exists(self.journal_file):
+            return []
+        kept = []
+        with open(self.journal_file, 'r') as f:
+            for line in f:
+                try:
+                    if json.loads(line).get('seq', 0) > seq:
+                        kept.append(line)
+                except json.JSONDecodeError:
+                    continue
+        return kept
+
+    def close(self):
+        """Close the journal file handle"""
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
@@ -0,0 +1,139 @@
+import json
+import os
+import logging
+from array import array
+from typing import Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# An index entry packs the segment number above a 40-bit byte offset
+OFFSET_BITS = 40
+OFFSET_MASK = (1 << OFFSET_BITS) - 1
+
+
+class WalletLedger:
+    """Append-only wallet transaction ledger stored in rolling segment files.
+
+    Each line is "<user_id>\\t<json>" so the per-user index can be rebuilt on
+    startup without parsing the transactions themselves. The index keeps one
+    packed (segment, offset) integer per transaction, which makes a user's
+    transaction id simply its position in that user's index and lets a page
+    be read with one seek per row.
+    """
+
+    def __init__(self, ledger_dir: str, segment_size: int = 64 * 2**20):
+        self.ledger_dir = ledger_dir
+        self.segment_size = segment_size
+        self._index: Dict[int, array] = {}
+        self._readers: Dict[int, object] = {}
+        self._writer = None
+        self._segment = 1
+        os.makedirs(ledger_dir, exist_ok=True)
+        self._rebuild_index()
+
+    def _segment_path(self, segment: int) -> str:
+        return os.path.join(self.ledger_dir, f"segment-{segment:06d}.log")
+
+    def _segments(self) -> List[int]:
+        segments = []
+        for name in os.listdir(self.ledger_dir):
+            if name.startswith("segment-") and name.endswith(".log"):
+                segments.append(int(name[8:-4]))
+        return sorted(segments)
+
+    def _rebuild_index(self):
+        """Scan every segment and rebuild the per-user offset index"""
+        for segment in self._segments():
+            self._segment = segment
+            offset = 0
+            with open(self._segment_path(segment), 'rb') as f:
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        # A torn final write; drop it so the next append starts clean
+                        logger.warning(f"Truncating partial ledger record in segment {segment} at {offset}")
+                        break
+                    user_id = int(line[:line.index(b"\t")])
+                    self._index.setdefault(user_id, array('Q')).append((segment << OFFSET_BITS) | offset)
+                    offset += len(line)
+            if offset != os.path.getsize(self._segment_path(segment)):
+                with open(self._segment_path(segment), 'r+b') as f:
+                    f.truncate(offset)
+
+    def append(self, user_id: int, transaction: Dict) -> int:
+        """Append a transaction, returning its id within the user's history"""
+        if self._writer is None or self._writer.tell() >= self.segment_size:
+            self._roll()
+        line = f"{user_id}\t{json.dumps(transaction, separators=(',', ':'), default=str)}\n".encode()
+        offset = self._writer.tell()
+        self._writer.write(line)
+        entries = self._index.setdefault(user_id, array('Q'))
+        entries.append((self._segment << OFFSET_BITS) | offset)
+        return len(entries) - 1
+
+    def _roll(self):
+        if self._writer is not None:
+            self._writer.close()
+            if os.path.getsize(self._segment_path(self._segment)) >= self.segment_size:
+                self._segment += 1
+        self._writer = open(self._segment_path(self._segment), 'ab')
+
+    def flush(self):
+        """Push buffered appends to the operating system"""
+        if self._writer is not None:
+            self._writer.flush()
+
+    def count(self, user_id: int) -> int:
+        """Get the number of transactions recorded for a user"""
+        entries = self._index.get(user_id)
+        return len(entries) if entries else 0
+
+    def page(self, user_id: int, limit: int = 10, before_id: int = None,
+             after_id: int = None) -> Tuple[List[Dict], bool, bool]:
+        """Read one page of a user's history, oldest first.
+
+        The newest page is returned by default; before_id/after_id select the
+        page just older/newer than the given transaction id. Returns the page
+        plus whether older and newer transactions exist.
+        """
+        entries = self._index.get(user_id)
+        if not entries:
+            return [], False, False
+        if after_id is not None:
+            start = max(after_id + 1, 0)
+            end = min(start + limit, len(entries))
+        else:
+            end = len(entries) if before_id is None else max(min(before_id, len(entries)), 0)
+            start = max(end - limit, 0)
+        page = [self._read(entries[i], i) for i in range(start, end)]
+        return page, start > 0, end < len(entries)
+
+    def _read(self, entry: int, tx_id: int) -> Dict:
+        segment, offset = entry >> OFFSET_BITS, entry & OFFSET_MASK
+        if segment == self._segment:
+            self.flush()
+        reader = self._readers.get(segment)
+        if reader is None:
+            reader = self._readers[segment] = open(self._segment_path(segment), 'rb')
+        reader.seek(offset)
+        line = reader.readline()
+        transaction = json.loads(line[line.index(b"\t") + 1:])
+        transaction['id'] = tx_id
+        return transaction
+
+    def iter_all(self) -> Iterator[Tuple[int, Dict]]:
+        """Yield (user_id, transaction) for the whole ledger in append order"""
+        self.flush()
+        for segment in self._segments():
+            with open(self._segment_path(segment), 'rb') as f:
+                for line in f:
+                    tab = line.index(b"\t")
+                    yield int(line[:tab]), json.loads(line[tab + 1:])
+
+    def close(self):
+        """Close all segment files"""
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        for reader in self._readers.values():
+            reader.close()
+        self._readers.clear()
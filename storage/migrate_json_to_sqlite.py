@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+One-shot migration of users.json (snapshot + journal) into the SQLite backend.
+
+The snapshot is streamed entry by entry and written in batches, so the whole
+user map is never held in memory.
+
+    python -m storage.migrate_json_to_sqlite [--json users.json] [--sqlite users.db]
+"""
+
+import argparse
+import logging
+import os
+import sys
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot_config import BotConfig  # noqa: E402
+from storage.journal import JournalStore  # noqa: E402
+from storage.ledger import WalletLedger  # noqa: E402
+from storage.reachability import REACHABLE, STATE_CODES  # noqa: E402
+from storage.settled_invoices import SettledInvoices  # noqa: E402
+from storage.user_table import iso_to_micros  # noqa: E402
+from storage.sqlite_backend import SQLiteUserDatabase  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+
+def _user_row(user: dict, balance: float = 0.0) -> tuple:
+    return (user['user_id'], user.get('username'), user.get('first_name'), balance,
+            user['joined_date'], user['last_active'], user.get('language_code'))
+
+
+def _tx_row(user_id: int, tx: dict) -> tuple:
+    return (user_id, tx['amount'], tx.get('type', 'manual'), tx.get('description', ''),
+            tx['timestamp'], tx['old_balance'], tx['new_balance'])
+
+
+def _settled_row(invoice_id: str, settled_at: int, user_id: int = 0) -> tuple:
+    # The JSON store keeps no amount (nor, in its invoices file, a user) for a settled invoice
+    return (invoice_id, user_id, 0.0, datetime.fromtimestamp(settled_at).isoformat())
+
+
+def migrate(json_file: str, sqlite_file: str, batch_size: int = 5000, ledger_dir: str = None) -> int:
+    """Copy every user, transaction and settled invoice into SQLite, returning the number of users migrated"""
+    journal = JournalStore(json_file)
+    ledger = WalletLedger(ledger_dir or f"{os.path.splitext(json_file)[0]}_ledger")
+    target = SQLiteUserDatabase(sqlite_file)
+    users, transactions, reachability = [], [], []
+    migrated = 0
+
+    for _, user in journal.stream_snapshot():
+        users.append(_user_row(user, user.get('wallet_balance', 0.0)))
+        transactions.extend(_tx_row(user['user_id'], tx) for tx in user.get('wallet_transactions', []))
+        state = STATE_CODES[user.get('reachability', 'reachable')]
+        if state != REACHABLE:
+            checked = user.get('reachability_checked')
+            reachability.append((user['user_id'], state, iso_to_micros(checked) // 1_000_000 if checked else 0))
+        migrated += 1
+        if len(users) >= batch_size:
+            target.import_batch(users, transactions)
+            target.set_reachability(reachability)
+            users, transactions, reachability = [], [], []
+            logger.info(f"Migrated {migrated} users")
+    target.import_batch(users, transactions)
+    target.set_reachability(reachability)
+
+    # Invoices already credited, so a Xendit redelivery is not credited again by SQLite
+    settled = SettledInvoices(f"{os.path.splitext(json_file)[0]}_invoices.log",
+                              BotConfig.SETTLED_INVOICE_RETENTION_DAYS)
+    settled.load(journal.meta.get('settled_invoices_size', 0))
+    for invoice_id, settled_at in journal.meta.get('settled_invoices', {}).items():
+        settled.add(invoice_id, settled_at)
+    target.import_batch([], [], settled_invoices=[_settled_row(*item) for item in settled.items()])
+
+    # Replay journal records written after the snapshot
+    users, transactions, balances, invoices = [], [], [], []
+    for record in journal.replay():
+        if record['op'] == 'user':
+            users.append(_user_row(record))
+        elif record['op'] == 'active':
+            # Users touched here may still be in the pending batch
+            target.import_batch(users, transactions, balances, invoices)
+            users, transactions, balances, invoices = [], [], [], []
+            for user_id, timestamp in record['ts']:
+                target.activity.touch(user_id, timestamp)
+            target.flush_activity()
+        elif record['op'] == 'reach':
+            target.import_batch(users, transactions, balances, invoices)
+            users, transactions, balances, invoices = [], [], [], []
+            target.set_reachability(record['items'])
+        elif record['op'] == 'balance':
+            balances.append((record['balance'], record['user_id']))
+        elif record['op'] == 'tx':
+            transactions.append(_tx_row(record['user_id'], record['tx']))
+            balances.append((record['tx']['new_balance'], record['user_id']))
+        if 'invoice' in record:
+            # Written with the credit it marks settled
+            invoices.append(_settled_row(record['invoice'], record['ts'], record['user_id']))
+        if len(users) + len(transactions) >= batch_size:
+            target.import_batch(users, transactions, balances, invoices)
+            users, transactions, balances, invoices = [], [], [], []
+    target.import_batch(users, transactions, balances, invoices)
+
+    # Wallet history kept in the ledger, once every user it refers to exists
+    transactions = []
+    for user_id, tx in ledger.iter_all():
+        transactions.append(_tx_row(user_id, tx))
+        if len(transactions) >= batch_size:
+            target.import_batch([], transactions)
+            transactions = []
+    target.import_batch([], transactions)
+    ledger.close()
+
+    total = target.get_total_users()
+    target.close()
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--json", default="users.json", help="JSON snapshot to read (its journal is replayed too)")
+    parser.add_argument("--sqlite", default="users.db", help="SQLite database to create or update")
+    parser.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    total = migrate(args.json, args.sqlite, args.batch_size)
+    print(f"✅ Migration complete: {total} users in {args.sqlite}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,9 @@
+from typing import Dict
+
+# Delivery reachability of a user's chat, as stored by both backends
+REACHABLE = 0
+BLOCKED = 1  # the user blocked the bot
+GONE = 2     # the chat no longer exists (deleted or deactivated account)
+
+STATE_NAMES: Dict[int, str] = {REACHABLE: "reachable", BLOCKED: "blocked", GONE: "gone"}
+STATE_CODES: Dict[str, int] = {name: code for code, name in STATE_NAMES.items()}
@@ -0,0 +1,111 @@
+import os
+import time
+import logging
+from typing import Dict, Iterator, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class SettledInvoices:
+    """Xendit invoice ids already credited, kept in an append-only file.
+
+    Each line is "<epoch second>\\t<invoice id>". Ids settled since the last
+    snapshot are held back and appended (and fsynced) when the next one is
+    taken; the snapshot records the resulting file size, so bytes past
+    it (from a snapshot that never completed) are cut off on load and
+    those ids come back from the journal instead. Only ids settled within
+    the last retention_days are kept in memory; the file is rewritten
+    without the older ones on load once they make up most of it.
+    """
+
+    def __init__(self, path: str, retention_days: int = 90):
+        self.path = path
+        self.retention = retention_days * 86400
+        self._settled: Dict[str, int] = {}
+        self._unwritten: List[Tuple[str, int]] = []
+        self._writing: List[Tuple[str, int]] = []
+        self._lines = 0
+
+    def __contains__(self, invoice_id: str) -> bool:
+        return invoice_id in self._settled
+
+    def __len__(self) -> int:
+        return len(self._settled)
+
+    def items(self) -> Iterator[Tuple[str, int]]:
+        return iter(self._settled.items())
+
+    def add(self, invoice_id: str, settled_at: int):
+        """Remember a settled invoice; it reaches the file with the next snapshot"""
+        if invoice_id not in self._settled:
+            self._settled[invoice_id] = settled_at
+            self._unwritten.append((invoice_id, settled_at))
+
+    def load(self, size: int) -> bool:
+        """Read the first size bytes of the file, returning whether it should be rewritten and a snapshot taken"""
+        if not os.path.exists(self.path):
+            return False
+        horizon = time.time() - self.retention
+        with open(self.path, 'r+b') as f:
+            for line in f.read(size).splitlines(keepends=True):
+                if not line.endswith(b"\n"):
+                    break
+                settled_at, invoice_id = line[:-1].decode().split("\t", 1)
+                self._lines += 1
+                if int(settled_at) >= horizon:
+                    self._settled[invoice_id] = int(settled_at)
+            end = f.seek(0, os.SEEK_END)
+            if end > size:
+                logger.warning(f"Dropping settled invoices past the last snapshot in {self.path}")
+                f.truncate(size)
+        # A file shorter than the snapshot says was rewritten after it; the next snapshot must record its size
+        return end < size or self._lines > 2 * len(self._settled)
+
+    def prepare(self):
+        """Queue every id settled since the last call for write(); called on the event loop"""
+        self._forget_expired()
+        self._writing += self._unwritten
+        self._unwritten = []
+
+    def write(self) -> int:
+        """Append and fsync the queued ids, returning the file size a snapshot may record.
+
+        Runs in the compaction's worker thread. The ids stay queued until they
+        are on disk, so after a failure the next snapshot writes them again.
+        """
+        writing = self._writing
+        if writing:
+            with open(self.path, 'a') as f:
+                f.writelines(f"{settled_at}\t{invoice_id}\n" for invoice_id, settled_at in writing)
+                f.flush()
+                os.fsync(f.fileno())
+            self._lines += len(writing)
+            self._writing = []
+        return os.path.getsize(self.path) if os.path.exists(self.path) else 0
+
+    def checkpoint(self) -> int:
+        """prepare() and write() in one go, for snapshots taken on the calling thread"""
+        self.prepare()
+        return self.write()
+
+    def rewrite(self):
+        """Replace the file with the ids still kept in memory"""
+        self._forget_expired()
+        unwritten = dict(self._writing + self._unwritten)
+        tmp_file = f"{self.path}.tmp"
+        with open(tmp_file, 'w') as f:
+            f.writelines(f"{settled_at}\t{invoice_id}\n" for invoice_id, settled_at in self._settled.items()
+                         if invoice_id not in unwritten)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.path)
+        self._lines = len(self._settled) - len(unwritten)
+
+    def _forget_expired(self):
+        # Ids are added in settlement order, so the expired ones are at the front
+        horizon = time.time() - self.retention
+        while self._settled:
+            invoice_id = next(iter(self._settled))
+            if self._settled[invoice_id] >= horizon:
+                break
+            del self._settled[invoice_id]
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+"""
+One-shot split of users.json (snapshot + journal + wallet ledger) into the
+per-shard files multi-process mode uses: users.shard0.json, users.shard1.json,
+... each holding the users with user_id % SHARDS == shard, with their wallet
+history. The source is left untouched; shards that already hold users are
+refused rather than overwritten.
+
+    python -m storage.split_shards --shards 4 [--json users.json]
+
+Only the JSON backend is split; with DB_BACKEND=sqlite start each shard
+from its own database.
+"""
+
+import argparse
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bot_config import shard_file  # noqa: E402
+from database import UserDatabase  # noqa: E402
+from storage.aggregates import WalletAggregates  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+
+def split(json_file: str, shards: int) -> list:
+    """Write every user and transaction to its shard's files, returning the number of users per shard"""
+    source = UserDatabase(json_file)
+    targets = [UserDatabase(shard_file(json_file, shard)) for shard in range(shards)]
+    for shard, target in enumerate(targets):
+        if len(target.users):
+            raise SystemExit(f"{target.db_file} already holds {len(target.users)} users, not overwriting it")
+
+    for user_id, user in source.users.items():
+        targets[user_id % shards].users.add(
+            user_id, user['username'], user['first_name'], user['wallet_balance'], user['joined_date'],
+            user['last_active'], user['reachability'], user['reachability_checked'], user['language_code'])
+    for user_id, transaction in source.ledger.iter_all():
+        targets[user_id % shards].ledger.append(user_id, transaction)
+
+    for shard, target in enumerate(targets):
+        target.aggregates = WalletAggregates.recompute(target.users.balance_values())
+        # Invoice ids carry no user, so every shard remembers them all
+        for invoice_id, settled_at in source.settled_invoices.items():
+            target.settled_invoices.add(invoice_id, settled_at)
+        target.ledger.flush()
+        target._save_database()
+        logger.info(f"Shard {shard}: {len(target.users)} users in {target.db_file}")
+    counts = [len(target.users) for target in targets]
+    for database in [source] + targets:
+        database.close()
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--json", default="users.json", help="JSON snapshot to read (its journal is replayed too)")
+    parser.add_argument("--shards", type=int, required=True)
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    counts = split(args.json, args.shards)
+    print(f"✅ Split {sum(counts)} users into {args.shards} shards: {counts}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,528 @@
+import asyncio
+import sqlite3
+import threading
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+
+from bot_config import BotConfig
+from storage.activity import ActivityTracker
+from storage.audience import Audience
+from storage.reachability import REACHABLE, STATE_NAMES
+from storage.aggregates import BUCKET_COUNT, POSITIVE_BOUNDS, WalletAggregates, bucket_labels
+from storage.write_behind import FlushStats
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    first_name TEXT,
+    wallet_balance REAL NOT NULL DEFAULT 0,
+    joined_date TEXT NOT NULL,
+    last_active TEXT NOT NULL,
+    reachability INTEGER NOT NULL DEFAULT 0,
+    reachability_checked INTEGER NOT NULL DEFAULT 0,
+    language_code TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_users_username ON users(username);
+CREATE INDEX IF NOT EXISTS idx_users_last_active ON users(last_active);
+CREATE INDEX IF NOT EXISTS idx_users_balance ON users(wallet_balance);
+
+CREATE TABLE IF NOT EXISTS wallet_transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL REFERENCES users(user_id),
+    amount REAL NOT NULL,
+    type TEXT NOT NULL,
+    description TEXT NOT NULL DEFAULT '',
+    timestamp TEXT NOT NULL,
+    old_balance REAL NOT NULL,
+    new_balance REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_wallet_transactions_user ON wallet_transactions(user_id, id);
+
+-- Xendit invoices already credited; the primary key makes settlement idempotent
+CREATE TABLE IF NOT EXISTS settled_invoices (
+    invoice_id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    amount REAL NOT NULL,
+    settled_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS wallet_stats (
+    bucket INTEGER PRIMARY KEY,
+    users INTEGER NOT NULL DEFAULT 0,
+    balance REAL NOT NULL DEFAULT 0
+);
+"""
+
+
+def _bucket_sql(column: str) -> str:
+    """SQL expression matching storage.aggregates.balance_bucket"""
+    cases = [f"WHEN {column} < 0 THEN 0", f"WHEN {column} = 0 THEN 1"]
+    cases += [f"WHEN {column} <= {bound} THEN {i + 2}" for i, bound in enumerate(POSITIVE_BOUNDS)]
+    return f"CASE {' '.join(cases)} ELSE {len(POSITIVE_BOUNDS) + 2} END"
+
+
+# Columns added after the first release, with the DDL that adds them to older files
+COLUMN_MIGRATIONS = {
+    'reachability': "ALTER TABLE users ADD COLUMN reachability INTEGER NOT NULL DEFAULT 0",
+    'reachability_checked': "ALTER TABLE users ADD COLUMN reachability_checked INTEGER NOT NULL DEFAULT 0",
+    'language_code': "ALTER TABLE users ADD COLUMN language_code TEXT",
+}
+
+# Partial indexes: broadcasts walk the reachable users, re-probes the few others
+REACHABILITY_INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_users_reachable ON users(user_id) WHERE reachability = 0;
+CREATE INDEX IF NOT EXISTS idx_users_unreachable ON users(reachability, reachability_checked) WHERE reachability != 0;
+"""
+
+# Broadcast audiences filter on last_active, wallet_balance (both indexed in
+# SCHEMA) and language_code
+AUDIENCE_INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_users_language ON users(language_code, user_id) WHERE reachability = 0;
+"""
+
+# wallet_stats keeps one row per balance bucket, so every aggregate the admin
+# commands show is a scan of BUCKET_COUNT rows however many users there are
+STATS_TRIGGERS = f"""
+CREATE TRIGGER IF NOT EXISTS trg_users_stats_insert AFTER INSERT ON users BEGIN
+    UPDATE wallet_stats SET users = users + 1, balance = balance + NEW.wallet_balance
+    WHERE bucket = {_bucket_sql('NEW.wallet_balance')};
+END;
+CREATE TRIGGER IF NOT EXISTS trg_users_stats_update AFTER UPDATE OF wallet_balance ON users BEGIN
+    UPDATE wallet_stats SET users = users - 1, balance = balance - OLD.wallet_balance
+    WHERE bucket = {_bucket_sql('OLD.wallet_balance')};
+    UPDATE wallet_stats SET users = users + 1, balance = balance + NEW.wallet_balance
+    WHERE bucket = {_bucket_sql('NEW.wallet_balance')};
+END;
+CREATE TRIGGER IF NOT EXISTS trg_users_stats_delete AFTER DELETE ON users BEGIN
+    UPDATE wallet_stats SET users = users - 1, balance = balance - OLD.wallet_balance
+    WHERE bucket = {_bucket_sql('OLD.wallet_balance')};
+END;
+"""
+
+# Statements are kept as constants so sqlite3's statement cache reuses the
+# prepared form on every call
+SQL_UPSERT_USER = """
+INSERT INTO users (user_id, username, first_name, wallet_balance, joined_date, last_active, language_code)
+VALUES (?, ?, ?, 0, ?, ?, ?)
+ON CONFLICT(user_id) DO UPDATE SET
+    username = excluded.username,
+    first_name = excluded.first_name,
+    language_code = excluded.language_code
+"""
+SQL_GET_PROFILE = "SELECT username, first_name, language_code FROM users WHERE user_id = ?"
+SQL_SET_LAST_ACTIVE = "UPDATE users SET last_active = ? WHERE user_id = ?"
+SQL_GET_USER = "SELECT user_id, username, first_name, wallet_balance, joined_date, last_active FROM users WHERE user_id = ?"
+SQL_ALL_USERS = "SELECT user_id, username, first_name, wallet_balance, joined_date, last_active FROM users"
+SQL_USER_IDS = "SELECT user_id FROM users"
+SQL_USER_ID_PAGE = "SELECT user_id, user_id FROM users WHERE user_id > ? ORDER BY user_id LIMIT ?"
+SQL_REACHABLE_ID_PAGE = """
+SELECT user_id, user_id FROM users WHERE reachability = 0 AND user_id > ? ORDER BY user_id LIMIT ?
+"""
+SQL_REACHABLE_IDS = "SELECT user_id FROM users WHERE reachability = 0"
+SQL_SET_REACHABILITY = "UPDATE users SET reachability = ?, reachability_checked = ? WHERE user_id = ?"
+SQL_UNREACHABLE_COUNTS = "SELECT reachability, COUNT(*) FROM users WHERE reachability != 0 GROUP BY reachability"
+SQL_STALE_UNREACHABLE = "SELECT user_id FROM users WHERE reachability != 0 AND reachability_checked < ?"
+SQL_GET_BALANCE = "SELECT wallet_balance FROM users WHERE user_id = ?"
+SQL_SET_BALANCE = "UPDATE users SET wallet_balance = ? WHERE user_id = ?"
+SQL_INSERT_TX = """
+INSERT INTO wallet_transactions (user_id, amount, type, description, timestamp, old_balance, new_balance)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+SQL_SETTLE_INVOICE = """
+INSERT OR IGNORE INTO settled_invoices (invoice_id, user_id, amount, settled_at) VALUES (?, ?, ?, ?)
+"""
+SQL_TX_PAGE_BEFORE = """
+SELECT id, amount, type, description, timestamp, old_balance, new_balance
+FROM wallet_transactions WHERE user_id = ? AND id < ? ORDER BY id DESC LIMIT ?
+"""
+SQL_TX_PAGE_AFTER = """
+SELECT id, amount, type, description, timestamp, old_balance, new_balance
+FROM wallet_transactions WHERE user_id = ? AND id > ? ORDER BY id ASC LIMIT ?
+"""
+SQL_TX_EXISTS_BEFORE = "SELECT EXISTS(SELECT 1 FROM wallet_transactions WHERE user_id = ? AND id < ?)"
+SQL_TX_EXISTS_AFTER = "SELECT EXISTS(SELECT 1 FROM wallet_transactions WHERE user_id = ? AND id > ?)"
+SQL_IMPORT_USER = """
+INSERT INTO users (user_id, username, first_name, wallet_balance, joined_date, last_active, language_code)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT(user_id) DO UPDATE SET
+    username = excluded.username,
+    first_name = excluded.first_name,
+    joined_date = excluded.joined_date,
+    last_active = excluded.last_active,
+    language_code = excluded.language_code
+"""
+SQL_STATS = "SELECT bucket, users, balance FROM wallet_stats ORDER BY bucket"
+SQL_RECOMPUTE_STATS = f"""
+SELECT {_bucket_sql('wallet_balance')} AS bucket, COUNT(*), COALESCE(SUM(wallet_balance), 0)
+FROM users GROUP BY bucket
+"""
+SQL_RESET_STATS = "INSERT OR REPLACE INTO wallet_stats (bucket, users, balance) VALUES (?, ?, ?)"
+
+# Audience criteria as SQL conditions, in the order of Audience's attributes
+AUDIENCE_CONDITIONS = (
+    ('active_since', "last_active >= ?"),
+    ('min_balance', "wallet_balance >= ?"),
+    ('language', "language_code = ?"),
+)
+
+
+def _audience_sql(audience: Audience) -> Tuple[str, list]:
+    """WHERE conditions selecting the reachable users of an audience, with their parameters.
+
+    There are only a handful of combinations, so each one keeps its own
+    entry in the statement cache.
+    """
+    conditions, params = ["reachability = 0"], []
+    for attribute, condition in AUDIENCE_CONDITIONS:
+        value = getattr(audience, attribute)
+        if value is not None:
+            conditions.append(condition)
+            # last_active is stored as a local isoformat() string, which sorts chronologically
+            params.append(datetime.fromtimestamp(value).isoformat() if attribute == 'active_since' else value)
+    return " AND ".join(conditions), params
+
+
+class SQLiteUserDatabase:
+    """SQLite implementation of the UserDatabase interface.
+
+    All statements share one connection in WAL mode. Handlers should go
+    through run() so that queries execute on the database thread instead
+    of blocking the asyncio event loop. Once start() is called writes are
+    group-committed: they share one open transaction that a background task
+    commits every flush_interval_ms or every max_batch writes.
+    """
+
+    def __init__(self, db_file: str = "users.db", flush_interval_ms: int = 200, max_batch: int = 500):
+        self.db_file = db_file
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_batch = max_batch
+        self.stats = FlushStats()
+        self._group_commit = False
+        self._in_tx = False
+        self._uncommitted = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._activity_task: Optional[asyncio.Task] = None
+        self.activity = ActivityTracker()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn = sqlite3.connect(db_file, check_same_thread=False, isolation_level=None,
+                                     cached_statements=64)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(SCHEMA)
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(users)")}
+        for column, ddl in COLUMN_MIGRATIONS.items():
+            if column not in columns:
+                self._conn.execute(ddl)
+        self._conn.executescript(REACHABILITY_INDEXES)
+        self._conn.executescript(AUDIENCE_INDEXES)
+        self._conn.executescript(STATS_TRIGGERS)
+        if self._conn.execute("SELECT COUNT(*) FROM wallet_stats").fetchone()[0] != BUCKET_COUNT:
+            # First start on this file (or an older one): seed the stats from a full scan
+            with self._write():
+                self._reset_stats(self._conn)
+
+    async def run(self, func, *args, **kwargs):
+        """Run a database method on the database thread"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(func, *args, **kwargs))
+
+    @contextmanager
+    def _write(self):
+        """Hold the connection for one write inside the current transaction.
+
+        Each write runs in its own savepoint, so a failed write never rolls
+        back other writes that are waiting for the same group commit.
+        """
+        with self._lock:
+            if not self._in_tx:
+                self._conn.execute("BEGIN IMMEDIATE")
+                self._in_tx = True
+            self._conn.execute("SAVEPOINT write")
+            try:
+                yield self._conn
+            except Exception:
+                self._conn.execute("ROLLBACK TO write")
+                self._conn.execute("RELEASE write")
+                raise
+            self._conn.execute("RELEASE write")
+            self._uncommitted += 1
+            if not self._group_commit:
+                self._commit_locked()
+            elif self._uncommitted >= self.max_batch:
+                self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _commit_locked(self):
+        if self._in_tx:
+            start = time.perf_counter()
+            self._conn.execute("COMMIT")
+            self._in_tx = False
+            if self._group_commit:
+                self.stats.record(self._uncommitted, (time.perf_counter() - start) * 1000)
+            self._uncommitted = 0
+
+    def _commit_pending(self):
+        with self._lock:
+            self._commit_locked()
+
+    def _fetchone(self, sql: str, params=()) -> Optional[sqlite3.Row]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()
+
+    def _fetchall(self, sql: str, params=()) -> List[sqlite3.Row]:
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def add_user(self, user_id: int, username: str = None, first_name: str = None, language_code: str = None):
+        """Add or update user in database, skipping the write when the profile is unchanged"""
+        profile = self._fetchone(SQL_GET_PROFILE, (user_id,))
+        if profile is not None:
+            self.activity.touch(user_id)
+            if tuple(profile) == (username, first_name, language_code):
+                return
+        now = datetime.now().isoformat()
+        with self._write() as conn:
+            conn.execute(SQL_UPSERT_USER, (user_id, username, first_name, now, now, language_code))
+
+    def get_user(self, user_id: int) -> Optional[Dict]:
+        """Get user data (without the transaction history)"""
+        row = self._fetchone(SQL_GET_USER, (user_id,))
+        return dict(row) if row else None
+
+    def get_all_users(self) -> List[Dict]:
+        """Get all users"""
+        return [dict(row) for row in self._fetchall(SQL_ALL_USERS)]
+
+    def get_user_ids(self, reachable_only: bool = False) -> List[int]:
+        """Get all user IDs for broadcasting, optionally only users the bot can still reach"""
+        return [row[0] for row in self._fetchall(SQL_REACHABLE_IDS if reachable_only else SQL_USER_IDS)]
+
+    def get_user_id_page(self, after: int = 0, limit: int = 1000, reachable_only: bool = False,
+                         audience: Optional[Audience] = None) -> List[Tuple[int, int]]:
+        """Get up to limit (cursor, user_id) pairs in id order, starting after a cursor.
+
+        The cursor is the user id itself; pass the last one back to continue.
+        An audience restricts the page to the reachable users it selects.
+        """
+        if audience is not None and not audience.is_everyone:
+            where, params = _audience_sql(audience)
+            sql = f"SELECT user_id, user_id FROM users WHERE {where} AND user_id > ? ORDER BY user_id LIMIT ?"
+            return [tuple(row) for row in self._fetchall(sql, params + [after, limit])]
+        sql = SQL_REACHABLE_ID_PAGE if reachable_only else SQL_USER_ID_PAGE
+        return [tuple(row) for row in self._fetchall(sql, (after, limit))]
+
+    def count_audience(self, audience: Audience) -> int:
+        """Get the number of reachable users a broadcast audience selects"""
+        if audience.is_everyone:
+            return self.get_reachability_stats()[STATE_NAMES[REACHABLE]]
+        where, params = _audience_sql(audience)
+        return self._fetchone(f"SELECT COUNT(*) FROM users WHERE {where}", params)[0]
+
+    def set_reachability(self, updates: List[Tuple[int, int, int]]):
+        """Record delivery outcomes as (user_id, state, epoch_seconds) reachability updates"""
+        if not updates:
+            return
+        with self._write() as conn:
+            conn.executemany(SQL_SET_REACHABILITY, [(state, timestamp, user_id)
+                                                    for user_id, state, timestamp in updates])
+
+    def get_reachability_stats(self) -> Dict[str, int]:
+        """Get the number of users in each reachability state"""
+        stats = {name: 0 for name in STATE_NAMES.values()}
+        for state, count in self._fetchall(SQL_UNREACHABLE_COUNTS):
+            stats[STATE_NAMES[state]] = count
+        stats[STATE_NAMES[REACHABLE]] = self.get_total_users() - sum(stats.values())
+        return stats
+
+    def get_stale_unreachable(self, checked_before: int) -> List[int]:
+        """Get unreachable users whose state was last established before an epoch second"""
+        return [row[0] for row in self._fetchall(SQL_STALE_UNREACHABLE, (checked_before,))]
+
+    def update_wallet_balance(self, user_id: int, amount: float, transaction_type: str = "manual", description: str = ""):
+        """Update user wallet balance"""
+        with self._write() as conn:
+            return self._change_balance(conn, user_id, amount, transaction_type, description)
+
+    @staticmethod
+    def _change_balance(conn: sqlite3.Connection, user_id: int, amount: float, transaction_type: str,
+                        description: str) -> bool:
+        row = conn.execute(SQL_GET_BALANCE, (user_id,)).fetchone()
+        if row is None:
+            return False
+        old_balance = row[0]
+        new_balance = old_balance + amount
+        conn.execute(SQL_SET_BALANCE, (new_balance, user_id))
+        conn.execute(SQL_INSERT_TX, (user_id, amount, transaction_type, description,
+                                     datetime.now().isoformat(), old_balance, new_balance))
+        return True
+
+    def settle_invoice(self, invoice_id: str, user_id: int, amount: float, description: str = "") -> bool:
+        """Credit a paid invoice once; False if it was already settled or the user is unknown"""
+        with self._write() as conn:
+            if conn.execute(SQL_GET_BALANCE, (user_id,)).fetchone() is None:
+                return False
+            if conn.execute(SQL_SETTLE_INVOICE, (invoice_id, user_id, amount,
+                                                 datetime.now().isoformat())).rowcount == 0:
+                return False
+            return self._change_balance(conn, user_id, amount, "deposit", description)
+
+    def get_wallet_balance(self, user_id: int) -> float:
+        """Get user wallet balance"""
+        row = self._fetchone(SQL_GET_BALANCE, (user_id,))
+        return row[0] if row else 0.0
+
+    def get_wallet_transactions(self, user_id: int, limit: int = 10, before_id: int = None,
+                                after_id: int = None) -> List[Dict]:
+        """Get a page of user wallet transactions, oldest first.
+
+        Without before_id/after_id the newest page is returned; pass the
+        smallest (largest) id of a page to fetch the page before (after) it.
+        """
+        if after_id is not None:
+            rows = self._fetchall(SQL_TX_PAGE_AFTER, (user_id, after_id, limit))
+            return [dict(row) for row in rows]
+        before_id = before_id if before_id is not None else 2 ** 63 - 1
+        rows = self._fetchall(SQL_TX_PAGE_BEFORE, (user_id, before_id, limit))
+        return [dict(row) for row in reversed(rows)]
+
+    def get_wallet_history_page(self, user_id: int, limit: int = 10, before_id: int = None,
+                                after_id: int = None) -> Tuple[List[Dict], bool, bool]:
+        """Get a page of wallet transactions plus whether older and newer ones exist"""
+        page = self.get_wallet_transactions(user_id, limit, before_id, after_id)
+        if not page:
+            return page, False, False
+        has_older = self._fetchone(SQL_TX_EXISTS_BEFORE, (user_id, page[0]['id']))[0]
+        has_newer = self._fetchone(SQL_TX_EXISTS_AFTER, (user_id, page[-1]['id']))[0]
+        return page, bool(has_older), bool(has_newer)
+
+    @staticmethod
+    def _aggregates(rows) -> WalletAggregates:
+        aggregates = WalletAggregates()
+        for bucket, users, balance in rows:
+            aggregates.total_users += users
+            aggregates.total_balance += balance
+            aggregates.positive_users += users if bucket >= 2 else 0
+            aggregates.histogram[bucket] = users
+        return aggregates
+
+    def _reset_stats(self, conn: sqlite3.Connection):
+        rows = {row[0]: (row[1], row[2]) for row in conn.execute(SQL_RECOMPUTE_STATS)}
+        conn.executemany(SQL_RESET_STATS, [(bucket,) + rows.get(bucket, (0, 0.0))
+                                           for bucket in range(BUCKET_COUNT)])
+
+    def get_total_users(self) -> int:
+        """Get total number of users"""
+        return self._aggregates(self._fetchall(SQL_STATS)).total_users
+
+    def get_total_wallet_balance(self) -> float:
+        """Get total wallet balance across all users"""
+        return self._aggregates(self._fetchall(SQL_STATS)).total_balance
+
+    def get_wallet_stats(self) -> Dict:
+        """Get running wallet aggregates, including the balance histogram"""
+        stats = self._aggregates(self._fetchall(SQL_STATS)).as_dict()
+        stats['histogram'] = list(zip(bucket_labels(), stats['histogram']))
+        return stats
+
+    def verify_aggregates(self) -> bool:
+        """Recompute the aggregates with a full scan, replacing them if they drifted"""
+        current = self._aggregates(self._fetchall(SQL_STATS))
+        recomputed = self._aggregates(self._fetchall(SQL_RECOMPUTE_STATS))
+        if recomputed.matches(current):
+            return True
+        with self._write() as conn:
+            self._reset_stats(conn)
+        return False
+
+    def import_batch(self, users: List[Tuple], transactions: List[Tuple], balances: List[Tuple] = (),
+                     settled_invoices: List[Tuple] = ()):
+        """Bulk-load rows in one transaction (used by the migrator).
+
+        Rows follow SQL_IMPORT_USER, SQL_INSERT_TX, SQL_SET_BALANCE and
+        SQL_SETTLE_INVOICE; an existing user keeps its balance unless it
+        appears in balances.
+        """
+        with self._write() as conn:
+            conn.executemany(SQL_IMPORT_USER, users)
+            conn.executemany(SQL_INSERT_TX, transactions)
+            conn.executemany(SQL_SET_BALANCE, balances)
+            conn.executemany(SQL_SETTLE_INVOICE, settled_invoices)
+
+    def flush_activity(self):
+        """Persist every last_active change collected by the activity tracker in one statement"""
+        seen = self.activity.drain()
+        if not seen:
+            return
+        rows = [(datetime.fromtimestamp(ts).isoformat(), user_id) for user_id, ts in seen.items()]
+        with self._write() as conn:
+            conn.executemany(SQL_SET_LAST_ACTIVE, rows)
+
+    async def _flush_activity_periodically(self):
+        while True:
+            await asyncio.sleep(BotConfig.ACTIVITY_FLUSH_INTERVAL)
+            await self.run(self.flush_activity)
+
+    async def start(self):
+        """Switch to group commit with background commit and activity tasks"""
+        if self._task is None:
+            self._loop = asyncio.get_running_loop()
+            self._wakeup = asyncio.Event()
+            self._group_commit = True
+            self._task = asyncio.create_task(self._run(), name="sqlite-group-commit")
+            self._activity_task = asyncio.create_task(self._flush_activity_periodically())
+
+    async def stop(self):
+        """Commit pending writes and go back to per-write commits"""
+        if self._task is None:
+            return
+        for task in (self._task, self._activity_task):
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._task = None
+        self._activity_task = None
+        await self.run(self.flush_activity)
+        await self.commit()
+        self._group_commit = False
+
+    async def commit(self):
+        """Wait until every write made so far has been committed"""
+        await self.run(self._commit_pending)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.commit()
+            except Exception as e:
+                logger.error(f"SQLite group commit failed: {e}")
+
+    def get_flush_stats(self) -> Dict:
+        """Get group commit latency and batch size counters"""
+        return dict(self.stats.as_dict(), pending=self._uncommitted)
+
+    def close(self):
+        """Commit, close the connection and stop the database thread"""
+        self._executor.shutdown(wait=True)
+        self.flush_activity()
+        with self._lock:
+            self._commit_locked()
+            self._conn.close()
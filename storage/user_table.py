@@ -0,0 +1,282 @@
+import sys
+from array import array
+from collections.abc import Mapping
+from datetime import datetime
+from itertools import islice
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from storage.aggregates import balance_bucket
+from storage.audience import Audience, SortedBuckets
+from storage.reachability import REACHABLE, STATE_CODES, STATE_NAMES
+
+# Balances are kept as integer minor units (cents)
+MINOR_UNITS = 100
+
+# last_active is indexed by calendar day (UTC) of the epoch timestamp
+DAY_MICROS = 86400 * 1_000_000
+
+FIELDS = ('user_id', 'username', 'first_name', 'wallet_balance', 'joined_date', 'last_active',
+          'reachability', 'reachability_checked', 'language_code')
+
+
+def iso_to_micros(timestamp: str) -> int:
+    """Convert an isoformat() timestamp to epoch microseconds"""
+    dt = datetime.fromisoformat(timestamp)
+    return int(dt.replace(microsecond=0).timestamp()) * 1_000_000 + dt.microsecond
+
+
+def micros_to_iso(micros: int) -> str:
+    """Convert epoch microseconds back to the isoformat() string it came from"""
+    seconds, microsecond = divmod(micros, 1_000_000)
+    return datetime.fromtimestamp(seconds).replace(microsecond=microsecond).isoformat()
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    return sys.intern(value) if value is not None else None
+
+
+class UserRow(Mapping):
+    """Dict-compatible live view of one row of a UserTable.
+
+    Reads and item assignment go straight to the table's columns, so the
+    view behaves like the per-user dicts the database used to hand out.
+    """
+
+    __slots__ = ('_table', '_row')
+
+    def __init__(self, table: "UserTable", row: int):
+        self._table = table
+        self._row = row
+
+    def __getitem__(self, key: str):
+        table, row = self._table, self._row
+        if key == 'user_id':
+            return table.ids[row]
+        if key == 'username':
+            return table.usernames[row]
+        if key == 'first_name':
+            return table.first_names[row]
+        if key == 'wallet_balance':
+            return table.balances[row] / MINOR_UNITS
+        if key == 'joined_date':
+            return micros_to_iso(table.joined[row])
+        if key == 'last_active':
+            return micros_to_iso(table.last_active[row])
+        if key == 'reachability':
+            return STATE_NAMES[table.reach[row]]
+        if key == 'reachability_checked':
+            checked = table.reach_checked[row]
+            return micros_to_iso(checked * 1_000_000) if checked else None
+        if key == 'language_code':
+            return table.languages[row]
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value):
+        table, row = self._table, self._row
+        if key == 'username':
+            table.usernames[row] = _intern(value)
+        elif key == 'first_name':
+            table.first_names[row] = _intern(value)
+        elif key == 'wallet_balance':
+            table._set_balance(row, round(value * MINOR_UNITS))
+        elif key == 'joined_date':
+            table.joined[row] = iso_to_micros(value)
+        elif key == 'last_active':
+            table._set_last_active(row, iso_to_micros(value))
+        elif key == 'reachability':
+            table._set_reach(row, STATE_CODES[value])
+        elif key == 'reachability_checked':
+            table.reach_checked[row] = iso_to_micros(value) // 1_000_000 if value else 0
+        elif key == 'language_code':
+            table._set_language(row, value)
+        else:
+            raise KeyError(key)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(FIELDS)
+
+    def __len__(self) -> int:
+        return len(FIELDS)
+
+    def __repr__(self) -> str:
+        return repr(dict(self))
+
+
+class UserTable:
+    """Column-oriented in-memory user store.
+
+    Each field is one column: ids, balances (in cents) and timestamps (epoch
+    microseconds) are packed int64 arrays, names are interned strings, the
+    reachability state is one byte per user, and an int-keyed index maps a
+    user id to its row. Rows are only ever appended, so a row number (and
+    any UserRow view) stays valid for the table's lifetime and the ids
+    column lists users in join order.
+
+    Broadcast audiences are resolved through three secondary indexes of
+    sorted row numbers: by last_active day, by balance bucket and by
+    language_code. A segment is walked from its most selective index and
+    checked against the columns, never by scanning the whole table.
+    """
+
+    def __init__(self):
+        self.ids = array('q')
+        self.balances = array('q')
+        self.joined = array('q')
+        self.last_active = array('q')
+        self.usernames: List[Optional[str]] = []
+        self.first_names: List[Optional[str]] = []
+        self.reach = bytearray()
+        # Epoch second the reachability state was last established, 0 if never
+        self.reach_checked = array('q')
+        self.reach_counts = [0] * len(STATE_NAMES)
+        self.languages: List[Optional[str]] = []
+        self._index: Dict[int, int] = {}
+        self.by_day = SortedBuckets()
+        self.by_balance = SortedBuckets()
+        self.by_language = SortedBuckets()
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._index
+
+    def add(self, user_id: int, username: Optional[str], first_name: Optional[str], balance: float,
+            joined_date: str, last_active: str, reachability: str = "reachable",
+            reachability_checked: Optional[str] = None, language_code: Optional[str] = None) -> UserRow:
+        """Append a new user and return its row view"""
+        row = len(self.ids)
+        self.ids.append(user_id)
+        self.usernames.append(_intern(username))
+        self.first_names.append(_intern(first_name))
+        self.balances.append(round(balance * MINOR_UNITS))
+        self.joined.append(iso_to_micros(joined_date))
+        self.last_active.append(iso_to_micros(last_active))
+        self.reach.append(STATE_CODES[reachability])
+        self.reach_counts[self.reach[row]] += 1
+        self.reach_checked.append(iso_to_micros(reachability_checked) // 1_000_000 if reachability_checked else 0)
+        self.languages.append(_intern(language_code))
+        self._index[user_id] = row
+        self.by_day.add(self.last_active[row] // DAY_MICROS, row)
+        self.by_balance.add(balance_bucket(balance), row)
+        self.by_language.add(language_code, row)
+        return UserRow(self, row)
+
+    def _set_balance(self, row: int, cents: int):
+        self.by_balance.move(row, balance_bucket(self.balances[row] / MINOR_UNITS), balance_bucket(cents / MINOR_UNITS))
+        self.balances[row] = cents
+
+    def _set_last_active(self, row: int, micros: int):
+        self.by_day.move(row, self.last_active[row] // DAY_MICROS, micros // DAY_MICROS)
+        self.last_active[row] = micros
+
+    def _set_language(self, row: int, language_code: Optional[str]):
+        self.by_language.move(row, self.languages[row], language_code)
+        self.languages[row] = _intern(language_code)
+
+    def _set_reach(self, row: int, state: int):
+        self.reach_counts[self.reach[row]] -= 1
+        self.reach_counts[state] += 1
+        self.reach[row] = state
+
+    def set_reachability(self, user_id: int, state: int, epoch_seconds: int) -> bool:
+        """Record a user's reachability state, returning whether it changed"""
+        row = self._index[user_id]
+        self.reach_checked[row] = epoch_seconds
+        if self.reach[row] == state:
+            return False
+        self._set_reach(row, state)
+        return True
+
+    def reachable_page(self, after: int, limit: int) -> List[Tuple[int, int]]:
+        """Up to limit (row position + 1, user_id) pairs of reachable users after a position"""
+        ids, reach = self.ids, self.reach
+        page = []
+        row = after
+        while row < len(ids) and len(page) < limit:
+            if reach[row] == REACHABLE:
+                page.append((row + 1, ids[row]))
+            row += 1
+        return page
+
+    def _segment_plan(self, audience: Audience) -> Tuple[SortedBuckets, List]:
+        """Pick the index whose matching buckets hold the fewest rows"""
+        plans = []
+        if audience.active_since is not None:
+            first = audience.active_since * 1_000_000 // DAY_MICROS
+            plans.append((self.by_day, [day for day in self.by_day.buckets if day >= first]))
+        if audience.min_balance is not None:
+            first = balance_bucket(audience.min_balance)
+            plans.append((self.by_balance, [bucket for bucket in self.by_balance.buckets if bucket >= first]))
+        if audience.language is not None:
+            plans.append((self.by_language, [audience.language]))
+        return min(plans, key=lambda plan: plan[0].count(plan[1]))
+
+    def _segment_rows(self, audience: Audience, after: int) -> Iterator[int]:
+        """Reachable rows above a position that match every criterion, in row order"""
+        index, keys = self._segment_plan(audience)
+        since = audience.active_since * 1_000_000 if audience.active_since is not None else None
+        min_cents = audience.min_balance * MINOR_UNITS if audience.min_balance is not None else None
+        language = audience.language
+        reach, last_active, balances, languages = self.reach, self.last_active, self.balances, self.languages
+        for row in index.rows_after(keys, after):
+            if (reach[row] == REACHABLE
+                    and (since is None or last_active[row] >= since)
+                    and (min_cents is None or balances[row] >= min_cents)
+                    and (language is None or languages[row] == language)):
+                yield row
+
+    def segment_count(self, audience: Audience) -> int:
+        """Number of reachable users in an audience"""
+        if audience.is_everyone:
+            return self.reach_counts[REACHABLE]
+        return sum(1 for _ in self._segment_rows(audience, -1))
+
+    def segment_page(self, after: int, limit: int, audience: Audience) -> List[Tuple[int, int]]:
+        """Like reachable_page(), restricted to the users in an audience"""
+        if audience.is_everyone:
+            return self.reachable_page(after, limit)
+        ids = self.ids
+        return [(row + 1, ids[row]) for row in islice(self._segment_rows(audience, after - 1), limit)]
+
+    def get(self, user_id: int) -> Optional[UserRow]:
+        """Get the row view for a user, or None"""
+        row = self._index.get(user_id)
+        return UserRow(self, row) if row is not None else None
+
+    def set_last_active(self, user_id: int, epoch_seconds: int):
+        """Set a user's last_active from an epoch second"""
+        self._set_last_active(self._index[user_id], epoch_seconds * 1_000_000)
+
+    def rows(self) -> Iterator[UserRow]:
+        """Iterate over row views in join order"""
+        return (UserRow(self, row) for row in range(len(self.ids)))
+
+    def balance_values(self) -> Iterator[float]:
+        """Iterate over every balance in currency units"""
+        return (balance / MINOR_UNITS for balance in self.balances)
+
+    def items(self) -> Iterator[Tuple[int, Dict]]:
+        """Yield (user_id, plain dict) pairs, the shape snapshots are written in"""
+        for row in range(len(self.ids)):
+            yield self.ids[row], dict(UserRow(self, row))
+
+    def copy(self) -> "UserTable":
+        """Copy the table so it can be serialized off the event loop while this one changes.
+
+        The secondary indexes are not copied; the copy is only meant to be read row by row.
+        """
+        table = UserTable.__new__(UserTable)
+        table.ids = array('q', self.ids)
+        table.balances = array('q', self.balances)
+        table.joined = array('q', self.joined)
+        table.last_active = array('q', self.last_active)
+        table.usernames = list(self.usernames)
+        table.first_names = list(self.first_names)
+        table.reach = bytearray(self.reach)
+        table.reach_checked = array('q', self.reach_checked)
+        table.reach_counts = list(self.reach_counts)
+        table.languages = list(self.languages)
+        table._index = dict(self._index)
+        table.by_day, table.by_balance, table.by_language = SortedBuckets(), SortedBuckets(), SortedBuckets()
+        return table
@@ -0,0 +1,191 @@
+import asyncio
+import time
+import logging
+from typing import Callable, Dict, List, Optional, Tuple
+
+from storage.journal import JournalStore
+from utils.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+
+class FlushStats:
+    """Counters describing the write-behind flushes"""
+
+    def __init__(self):
+        self.flushes = 0
+        self.records = 0
+        self.coalesced = 0
+        self.bytes = 0
+        self.last_batch_size = 0
+        self.last_latency_ms = 0.0
+        self.max_latency_ms = 0.0
+
+    def record(self, batch_size: int, latency_ms: float, written: int = 0):
+        self.flushes += 1
+        self.records += batch_size
+        self.bytes += written
+        self.last_batch_size = batch_size
+        self.last_latency_ms = latency_ms
+        self.max_latency_ms = max(self.max_latency_ms, latency_ms)
+        metrics = get_metrics()
+        metrics.db_flush_latency.observe(latency_ms / 1000)
+        metrics.db_flush_records.inc(batch_size)
+        metrics.db_flush_bytes.inc(written)
+
+    def as_dict(self) -> Dict:
+        return {
+            'flushes': self.flushes,
+            'records': self.records,
+            'coalesced': self.coalesced,
+            'bytes': self.bytes,
+            'last_batch_size': self.last_batch_size,
+            'last_latency_ms': round(self.last_latency_ms, 2),
+            'max_latency_ms': round(self.max_latency_ms, 2),
+            'avg_batch_size': round(self.records / self.flushes, 1) if self.flushes else 0
+        }
+
+
+class WriteBehindQueue:
+    """Buffers journal records in memory and writes them in group commits.
+
+    User upserts are coalesced per user (only the latest profile is written),
+    all other records are kept in order. A background task flushes everything
+    pending every flush_interval_ms, or as soon as max_batch records are
+    waiting, in one write off the event loop. Compaction of the journal into
+    a snapshot runs on the same task so it never races a flush: snapshot()
+    copies the data on the loop and returns it with a function building the
+    snapshot metadata, which runs in the worker thread before the snapshot
+    is written.
+    """
+
+    def __init__(self, journal: JournalStore, snapshot: Callable[[], Tuple[Dict, Callable[[], Dict]]],
+                 size: Callable[[], int],
+                 flush_interval_ms: int = 200, max_batch: int = 500,
+                 before_write: Optional[Callable[[], None]] = None):
+        self.journal = journal
+        self.before_write = before_write
+        self.snapshot = snapshot
+        self.size = size
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_batch = max_batch
+        self.stats = FlushStats()
+        self._dirty_users: Dict[int, Dict] = {}
+        self._records: List[Dict] = []
+        self._waiters: List[asyncio.Future] = []
+        self._inflight: Optional[List[asyncio.Future]] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stopping = False
+
+    @property
+    def pending(self) -> int:
+        return len(self._dirty_users) + len(self._records)
+
+    def submit(self, record: Dict):
+        """Queue a record for the next group commit"""
+        if record['op'] == 'user':
+            if record['user_id'] in self._dirty_users:
+                self.stats.coalesced += 1
+            self._dirty_users[record['user_id']] = record
+        else:
+            self._records.append(record)
+        if self._wakeup is not None and self.pending >= self.max_batch:
+            self._wakeup.set()
+
+    async def wait_flushed(self):
+        """Wait for the flush that contains every record queued so far"""
+        if self._task is None or (not self.pending and self._inflight is None):
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        if self.pending:
+            self._waiters.append(waiter)
+            self._wakeup.set()
+        else:
+            self._inflight.append(waiter)
+        await waiter
+
+    def start(self):
+        """Start the background flush task on the running event loop"""
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._stopping = False
+            self._task = asyncio.create_task(self._run(), name="write-behind")
+
+    async def stop(self):
+        """Drain everything pending and stop the background task"""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+                if self.journal.needs_compaction(self.size()):
+                    await self._compact()
+            except Exception as e:
+                logger.error(f"Write-behind flush failed, will retry: {e}")
+                if self._stopping:
+                    logger.error(f"Dropping {self.pending} unflushed records on shutdown")
+                    for waiter in self._waiters:
+                        if not waiter.done():
+                            waiter.set_exception(e)
+                    return
+            if self._stopping and not self.pending:
+                return
+
+    async def flush(self):
+        """Write all pending records to the journal in one commit"""
+        if not self.pending:
+            return
+        users, records = self._dirty_users, self._records
+        waiters, self._waiters = self._waiters, []
+        self._dirty_users, self._records = {}, []
+        batch = list(users.values()) + records
+        lines = [self.journal.encode(record) for record in batch]
+
+        self._inflight = waiters
+        start = time.perf_counter()
+        try:
+            self._before_write()
+            written = await asyncio.to_thread(self.journal.write_lines, lines)
+        except Exception:
+            # Put the batch back so the next flush retries it
+            for user_id, record in users.items():
+                self._dirty_users.setdefault(user_id, record)
+            self._records = records + self._records
+            self._waiters = waiters + self._waiters
+            raise
+        finally:
+            self._inflight = None
+        self.stats.record(len(batch), (time.perf_counter() - start) * 1000, written)
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _before_write(self):
+        # Dependent files (the wallet ledger) are flushed before the journal that refers to them.
+        # This runs on the event loop: the loop keeps appending to them, and may close and
+        # replace the file being flushed, while the journal is written in the worker thread
+        if self.before_write is not None:
+            self.before_write()
+
+    async def _compact(self):
+        # The copy is taken on the loop, so it reflects every seq allocated so far
+        seq = self.journal.seq
+        data, meta = self.snapshot()
+        start = time.perf_counter()
+        self._before_write()
+        await asyncio.to_thread(lambda: self.journal.compact(data, seq, meta()))
+        elapsed = time.perf_counter() - start
+        get_metrics().db_snapshot_latency.observe(elapsed)
+        logger.info(f"Journal compacted into snapshot in {elapsed * 1000:.0f} ms")
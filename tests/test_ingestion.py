@@ -0,0 +1,92 @@
+import asyncio
+
+import pytest
+from telegram import Update
+
+from utils.ingestion import ADMITTED, DEFERRED, HIGH, LOW, REJECTED, SHED, UpdateQueue, update_priority
+from utils.metrics import get_metrics
+
+USER_ID = 555001
+
+
+def update(text: str = "hello", update_id: int = 1) -> Update:
+    return Update.de_json({'update_id': update_id, 'message': {
+        'message_id': 1, 'date': 0, 'chat': {'id': USER_ID, 'type': 'private'},
+        'from': {'id': USER_ID, 'is_bot': False, 'first_name': 'Test'}, 'text': text}}, None)
+
+
+def test_priorities():
+    assert update_priority(update("/start")) == HIGH
+    assert update_priority(update("hello")) == LOW
+    # An amount typed during a top-up is a reply the user is waiting on
+    assert update_priority(update("50000"), {USER_ID: {'topup_pending': True}}) == HIGH
+    assert update_priority(update("50000"), {USER_ID: {}}) == LOW
+    callback = Update.de_json({'update_id': 2, 'callback_query': {
+        'id': "1", 'chat_instance': "1", 'data': "wallet_history:0",
+        'from': {'id': USER_ID, 'is_bot': False, 'first_name': 'Test'}}}, None)
+    assert update_priority(callback) == HIGH
+
+
+@pytest.mark.parametrize("policy, low_outcome", [("defer", DEFERRED), ("drop", SHED)])
+def test_low_priority_updates_are_shed_first(policy, low_outcome):
+    queue = UpdateQueue(10, shed_at=0.5, shed_policy=policy)
+    assert [queue.admit(update(), LOW) for _ in range(6)] == [ADMITTED] * 5 + [low_outcome]
+    # HIGH updates keep the headroom above the mark
+    assert [queue.admit(update(), HIGH) for _ in range(6)] == [ADMITTED] * 5 + [REJECTED]
+    stats = queue.stats()
+    assert (stats['admitted_low'], stats['admitted_high'], stats['depth'], stats['peak_depth']) == (5, 5, 10, 10)
+    assert stats[low_outcome] == 1 and stats['rejected'] == 1
+
+
+def test_depth_counts_updates_until_their_handlers_finish():
+    queue = UpdateQueue(2)
+    queue.admit(update(), HIGH)
+    queue.admit(update(), HIGH)
+    queue.get_nowait()
+    queue.get_nowait()
+    # Taken off the queue but still being handled
+    assert queue.qsize() == 0 and queue.pending == 2
+    assert queue.admit(update(), HIGH) == REJECTED
+    queue.task_done()
+    assert queue.pending == 1
+    assert queue.admit(update(), HIGH) == ADMITTED
+
+
+def test_put_waits_for_a_finished_update():
+    async def run():
+        queue = UpdateQueue(1)
+        await queue.put(update(update_id=1))
+        await queue.get()
+        blocked = asyncio.create_task(queue.put(update(update_id=2)))
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+        queue.task_done()
+        await asyncio.wait_for(blocked, 1)
+        return queue.pending
+    assert asyncio.run(run()) == 1
+
+
+def test_wait_time_is_measured_when_updates_are_taken(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr("utils.ingestion.time.monotonic", lambda: clock[0])
+    queue = UpdateQueue(10)
+    for _ in range(4):
+        queue.admit(update(), HIGH)
+    for waited in (0.010, 0.020, 0.030, 0.100):
+        clock[0] = 100.0 + waited
+        queue.get_nowait()
+    stats = queue.stats()
+    assert stats['dequeued'] == 4
+    assert stats['wait_avg_ms'] == 40.0
+    assert stats['wait_p50_ms'] == 30.0
+    assert stats['wait_max_ms'] == stats['wait_p99_ms'] == 100.0
+
+
+def test_wait_time_is_exported_to_prometheus():
+    waits = get_metrics().update_queue_wait.labels()
+    before = waits.count
+    queue = UpdateQueue(10)
+    queue.admit(update(), HIGH)
+    queue.get_nowait()
+    assert waits.count == before + 1
+    assert 'bot_update_queue_wait_seconds_count' in get_metrics().render()
@@ -0,0 +1,72 @@
+import json
+
+from storage.journal import META_KEY, JournalStore
+
+
+def record(journal: JournalStore, user_id: int) -> dict:
+    return {'op': 'user', 'user_id': user_id, 'seq': journal.next_seq()}
+
+
+def reopen(tmp_path) -> JournalStore:
+    journal = JournalStore(str(tmp_path / "users.json"))
+    list(journal.stream_snapshot())
+    return journal
+
+
+def test_torn_last_line_is_ignored(tmp_path):
+    journal = reopen(tmp_path)
+    for user_id in (1, 2):
+        journal.append(record(journal, user_id))
+    journal.close()
+    with open(journal.journal_file, 'a') as f:
+        f.write('{"op":"user","user_id":3,"se')
+
+    journal = reopen(tmp_path)
+    assert [r['user_id'] for r in journal.replay()] == [1, 2]
+    assert journal.seq == 2
+
+
+def test_records_covered_by_the_snapshot_are_skipped(tmp_path):
+    journal = reopen(tmp_path)
+    records = [record(journal, user_id) for user_id in range(1, 6)]
+    # Records 4 and 5 are allocated but still queued when the snapshot is taken at seq 3
+    for r in records[:3]:
+        journal.append(r)
+    journal.compact({'1': {}, '2': {}, '3': {}}, seq=3, meta={'note': 'kept'})
+    for r in records[3:]:
+        journal.append(r)
+    journal.close()
+
+    journal = reopen(tmp_path)
+    assert journal.meta == {'note': 'kept', 'seq': 3}
+    assert [r['user_id'] for r in journal.replay()] == [4, 5]
+    assert journal.seq == 5
+
+
+def test_compaction_keeps_records_newer_than_its_seq(tmp_path):
+    journal = reopen(tmp_path)
+    for user_id in range(1, 6):
+        journal.append(record(journal, user_id))
+    journal.compact({}, seq=3)
+    with open(journal.journal_file) as f:
+        assert [json.loads(line)['user_id'] for line in f] == [4, 5]
+    assert journal.records_since_compaction == 2
+
+
+def test_snapshot_entries_straddling_chunks_are_decoded(tmp_path):
+    data = {str(user_id): {'user_id': user_id, 'username': "x" * (user_id * 7 % 50)} for user_id in range(200)}
+    journal = reopen(tmp_path)
+    journal.compact(data, meta={'aggregates': {'total': 200}})
+
+    for chunk_size in (1, 7, 64, 1000):
+        journal = JournalStore(str(tmp_path / "users.json"))
+        assert dict(journal.stream_snapshot(chunk_size)) == data
+        assert journal.meta['aggregates'] == {'total': 200}
+    with open(tmp_path / "users.json") as f:
+        assert next(iter(json.load(f))) == META_KEY
+
+
+def test_empty_snapshot_streams_nothing(tmp_path):
+    journal = reopen(tmp_path)
+    journal.compact({})
+    assert list(JournalStore(str(tmp_path / "users.json")).stream_snapshot(2)) == []
@@ -0,0 +1,76 @@
+import os
+
+from storage.ledger import OFFSET_BITS, WalletLedger
+
+
+def transaction(amount: int) -> dict:
+    return {'amount': amount, 'type': "deposit", 'description': f"tx {amount}"}
+
+
+def filled_ledger(path, count: int = 60) -> WalletLedger:
+    # Small segments, so the history of one user spans several of them
+    ledger = WalletLedger(str(path), segment_size=200)
+    for amount in range(count):
+        ledger.append(1, transaction(amount))
+        ledger.append(2, transaction(-amount))
+    return ledger
+
+
+def amounts(page) -> list:
+    return [tx['amount'] for tx in page]
+
+
+def test_index_packs_segment_and_offset(tmp_path):
+    ledger = filled_ledger(tmp_path / "ledger")
+    segments = {entry >> OFFSET_BITS for entry in ledger._index[1]}
+    assert len(segments) > 5
+    assert segments == set(ledger._segments())
+    assert [tx['id'] for tx in ledger.page(1, 60)[0]] == list(range(60))
+    ledger.close()
+
+
+def test_pages_across_segment_rolls(tmp_path):
+    ledger = filled_ledger(tmp_path / "ledger")
+    page, has_older, has_newer = ledger.page(1, 25)
+    assert amounts(page) == list(range(35, 60)) and has_older and not has_newer
+    page, has_older, has_newer = ledger.page(1, 25, before_id=page[0]['id'])
+    assert amounts(page) == list(range(10, 35)) and has_older and has_newer
+    page, has_older, has_newer = ledger.page(1, 25, before_id=page[0]['id'])
+    assert amounts(page) == list(range(10)) and not has_older and has_newer
+    page, has_older, has_newer = ledger.page(1, 25, after_id=page[-1]['id'])
+    assert amounts(page) == list(range(10, 35)) and has_older and has_newer
+    assert amounts(ledger.page(2, 3)[0]) == [-57, -58, -59]
+    assert ledger.page(3, 10) == ([], False, False)
+    ledger.close()
+
+
+def test_reopen_rebuilds_the_index(tmp_path):
+    filled_ledger(tmp_path / "ledger").close()
+    ledger = WalletLedger(str(tmp_path / "ledger"), segment_size=200)
+    assert ledger.count(1) == ledger.count(2) == 60
+    assert amounts(ledger.page(1, 60)[0]) == list(range(60))
+    ledger.append(1, transaction(60))
+    assert amounts(ledger.page(1, 2)[0]) == [59, 60]
+    ledger.close()
+
+
+def test_reopen_after_a_torn_tail(tmp_path):
+    ledger = filled_ledger(tmp_path / "ledger")
+    last = ledger._segment_path(ledger._segments()[-1])
+    ledger.close()
+    size = os.path.getsize(last)
+    with open(last, 'ab') as f:
+        f.write(b'1\t{"amount": 99, "ty')
+
+    ledger = WalletLedger(str(tmp_path / "ledger"), segment_size=200)
+    assert os.path.getsize(last) == size
+    assert ledger.count(1) == 60
+    ledger.append(1, transaction(60))
+    ledger.flush()
+    assert amounts(ledger.page(1, 2)[0]) == [59, 60]
+    ledger.close()
+
+    ledger = WalletLedger(str(tmp_path / "ledger"), segment_size=200)
+    assert amounts(ledger.page(1, 61)[0]) == list(range(61))
+    assert [user_id for user_id, _ in ledger.iter_all()].count(1) == 61
+    ledger.close()
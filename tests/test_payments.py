@@ -0,0 +1,286 @@
+import asyncio
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from bot_config import BotConfig
+from database import UserDatabase
+from storage.migrate_json_to_sqlite import migrate
+from storage.settled_invoices import SettledInvoices
+from storage.sqlite_backend import SQLiteUserDatabase
+from utils.payments import DUPLICATE, IGNORED, SETTLED, UNKNOWN_USER, InvoiceSettler, deposit_fee
+from utils.webhook import CALLBACK_PATH, Request, WebhookApp
+
+USER_ID = 4242
+CALLBACK_TOKEN = "callback-token"
+
+
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append((chat_id, text))
+
+
+def open_database(backend: str, directory):
+    if backend == "sqlite":
+        return SQLiteUserDatabase(str(directory / "users.db"))
+    return UserDatabase(str(directory / "users.json"))
+
+
+@pytest.fixture(params=["json", "sqlite"])
+def backend(request):
+    return request.param
+
+
+def invoice(invoice_id: str = "inv-1", user_id: int = USER_ID, amount: float = 1000, status: str = "PAID") -> dict:
+    return {'id': invoice_id, 'external_id': f"telegram_{user_id}_00000000000000001abcd",
+            'status': status, 'amount': amount, 'paid_amount': amount}
+
+
+def settle(db, *payloads):
+    async def run():
+        settler = InvoiceSettler(db, FakeBot())
+        results = [await settler.handle_invoice(payload) for payload in payloads]
+        await asyncio.gather(*settler._notifications)
+        return results
+    return asyncio.run(run())
+
+
+def history(db, user_id: int = USER_ID):
+    return [(tx['amount'], tx['type'], tx['description'], tx['old_balance'], tx['new_balance'])
+            for tx in db.get_wallet_transactions(user_id)]
+
+
+def test_duplicate_callback_pays_out_once(backend, tmp_path):
+    db = open_database(backend, tmp_path)
+    db.add_user(USER_ID, "payer", "Payer")
+    assert settle(db, invoice(), invoice()) == [SETTLED, DUPLICATE]
+    _, net = deposit_fee(1000)
+    assert db.get_wallet_balance(USER_ID) == net
+    assert len(history(db)) == 1
+    db.close()
+
+
+def test_duplicate_callback_after_reload_pays_out_once(backend, tmp_path):
+    db = open_database(backend, tmp_path)
+    db.add_user(USER_ID, "payer", "Payer")
+    assert settle(db, invoice()) == [SETTLED]
+    db.close()
+
+    # Replayed from the journal
+    db = open_database(backend, tmp_path)
+    assert settle(db, invoice()) == [DUPLICATE]
+    if backend == "json":
+        db._save_database()
+    db.close()
+
+    # Loaded from the snapshot
+    db = open_database(backend, tmp_path)
+    assert settle(db, invoice()) == [DUPLICATE]
+    assert db.get_wallet_balance(USER_ID) == deposit_fee(1000)[1]
+    assert len(history(db)) == 1
+    db.close()
+
+
+def snapshot_meta(tmp_path) -> dict:
+    with open(tmp_path / "users.json") as f:
+        return json.load(f)['_meta']
+
+
+def test_settled_invoices_are_kept_out_of_the_snapshot(tmp_path):
+    db = open_database("json", tmp_path)
+    db.add_user(USER_ID, "payer", "Payer")
+    settle(db, invoice("inv-1"), invoice("inv-2"))
+    db._save_database()
+    db.close()
+
+    meta = snapshot_meta(tmp_path)
+    assert 'settled_invoices' not in meta
+    assert meta['settled_invoices_size'] == (tmp_path / "users_invoices.log").stat().st_size
+    assert [line.split("\t")[1] for line in (tmp_path / "users_invoices.log").read_text().splitlines()] == \
+        ["inv-1", "inv-2"]
+
+
+def test_settled_invoices_past_the_snapshot_come_from_the_journal(tmp_path):
+    db = open_database("json", tmp_path)
+    db.add_user(USER_ID, "payer", "Payer")
+    settle(db, invoice("inv-1"))
+    db._save_database()
+    settle(db, invoice("inv-2"))
+    db.close()
+    # Written for a snapshot that never completed
+    with open(tmp_path / "users_invoices.log", 'a') as f:
+        f.write("1700000000\tinv-3\n")
+
+    db = open_database("json", tmp_path)
+    assert settle(db, invoice("inv-1"), invoice("inv-2"), invoice("inv-3")) == [DUPLICATE, DUPLICATE, SETTLED]
+    db.close()
+
+
+def test_settled_invoices_move_out_of_old_snapshots(tmp_path):
+    db = open_database("json", tmp_path)
+    db.add_user(USER_ID, "payer", "Payer")
+    db.journal.compact(db.users, meta={'aggregates': db.aggregates.as_dict(),
+                                       'settled_invoices': {'inv-old': int(time.time())}})
+    db.close()
+
+    db = open_database("json", tmp_path)
+    assert 'settled_invoices' not in snapshot_meta(tmp_path)
+    assert settle(db, invoice("inv-old")) == [DUPLICATE]
+    db.close()
+
+
+def test_settled_invoices_are_forgotten_after_the_retention(tmp_path, monkeypatch):
+    monkeypatch.setattr(BotConfig, "SETTLED_INVOICE_RETENTION_DAYS", 30)
+    db = open_database("json", tmp_path)
+    db.add_user(USER_ID, "payer", "Payer")
+    old = int(time.time()) - 31 * 86400
+    for number in range(3):
+        db.settled_invoices.add(f"inv-old-{number}", old)
+    db._save_database()
+    settle(db, invoice("inv-new"))
+    db._save_database()
+    db.close()
+
+    db = open_database("json", tmp_path)
+    assert len(db.settled_invoices) == 1
+    # Mostly expired ids, so the file was rewritten on load
+    assert (tmp_path / "users_invoices.log").read_text().count("\n") == 1
+    assert snapshot_meta(tmp_path)['settled_invoices_size'] == (tmp_path / "users_invoices.log").stat().st_size
+    # Xendit sends created in UTC
+    created = time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(old))
+    assert settle(db, dict(invoice("inv-old-0"), created=created)) == [IGNORED]
+    assert db.get_wallet_balance(USER_ID) == deposit_fee(1000)[1]
+    db.close()
+
+
+def test_settled_invoices_are_fsynced_off_the_event_loop(tmp_path, monkeypatch):
+    fsync_threads = []
+
+    def fsync(fd):
+        fsync_threads.append(threading.current_thread())
+        return real_fsync(fd)
+    real_fsync = os.fsync
+    monkeypatch.setattr("storage.settled_invoices.os.fsync", fsync)
+
+    async def run():
+        db = open_database("json", tmp_path)
+        db.add_user(USER_ID, "payer", "Payer")
+        db.journal.compact_min_records = 1
+        await db.start()
+        await InvoiceSettler(db, FakeBot()).handle_invoice(invoice())
+        while db.journal.records_since_compaction:
+            await asyncio.sleep(0.01)
+        await db.stop()
+        db.close()
+    asyncio.run(run())
+
+    assert fsync_threads and threading.main_thread() not in fsync_threads
+    assert snapshot_meta(tmp_path)['settled_invoices_size'] == (tmp_path / "users_invoices.log").stat().st_size
+    assert settle(open_database("json", tmp_path), invoice()) == [DUPLICATE]
+
+
+def test_settled_invoices_stay_queued_until_written(tmp_path, monkeypatch):
+    invoices = SettledInvoices(str(tmp_path / "users_invoices.log"))
+    invoices.add("inv-1", int(time.time()))
+    invoices.prepare()
+    def fsync(fd):
+        raise OSError("disk full")
+    monkeypatch.setattr("storage.settled_invoices.os.fsync", fsync)
+    with pytest.raises(OSError):
+        invoices.write()
+    monkeypatch.undo()
+    invoices.add("inv-2", int(time.time()))
+    size = invoices.checkpoint()
+
+    reloaded = SettledInvoices(str(tmp_path / "users_invoices.log"))
+    reloaded.load(size)
+    assert "inv-1" in reloaded and "inv-2" in reloaded
+
+
+def test_settled_invoices_survive_migration_to_sqlite(tmp_path):
+    db = open_database("json", tmp_path)
+    db.add_user(USER_ID, "payer", "Payer")
+    settle(db, invoice("inv-1"))
+    # inv-1 is in the invoices file, inv-2 only in the journal
+    db._save_database()
+    settle(db, invoice("inv-2"))
+    db.close()
+
+    migrate(str(tmp_path / "users.json"), str(tmp_path / "users.db"))
+    db = open_database("sqlite", tmp_path)
+    for invoice_id in ("inv-1", "inv-2"):
+        assert not db.settle_invoice(invoice_id, USER_ID, 100)
+    assert db.get_wallet_balance(USER_ID) == 2 * deposit_fee(1000)[1]
+    assert settle(db, invoice("inv-3")) == [SETTLED]
+    db.close()
+
+
+def test_callback_for_unknown_user_is_not_credited(backend, tmp_path):
+    db = open_database(backend, tmp_path)
+    assert settle(db, invoice(user_id=999)) == [UNKNOWN_USER]
+    assert db.get_user(999) is None
+    assert db.get_total_wallet_balance() == 0
+    db.close()
+
+
+def test_unpaid_or_foreign_invoices_are_ignored(backend, tmp_path):
+    db = open_database(backend, tmp_path)
+    db.add_user(USER_ID, "payer", "Payer")
+    foreign = dict(invoice("inv-2"), external_id="order_17")
+    assert settle(db, invoice(status="EXPIRED"), foreign) == [IGNORED, IGNORED]
+    assert db.get_wallet_balance(USER_ID) == 0
+    db.close()
+
+
+@pytest.mark.parametrize("amount", [1000, 1234.5, 99])
+def test_fee_and_net_amount(backend, tmp_path, amount):
+    db = open_database(backend, tmp_path)
+    db.add_user(USER_ID, "payer", "Payer")
+    settle(db, invoice(amount=amount))
+    fee = int(amount * BotConfig.FEE_PERCENT)
+    assert deposit_fee(amount) == (fee, amount - fee)
+    assert db.get_wallet_balance(USER_ID) == pytest.approx(amount - fee)
+    description = history(db)[0][2]
+    assert description == f"Xendit invoice inv-1: paid {amount:g}, fee {fee}"
+    db.close()
+
+
+def test_backends_agree_on_balance_and_history(tmp_path):
+    results = {}
+    for backend in ("json", "sqlite"):
+        directory = tmp_path / backend
+        directory.mkdir()
+        db = open_database(backend, directory)
+        db.add_user(USER_ID, "payer", "Payer")
+        settle(db, invoice("inv-1", amount=1000), invoice("inv-2", amount=250), invoice("inv-1", amount=1000))
+        db.update_wallet_balance(USER_ID, -300, "withdrawal", "cash out")
+        results[backend] = (db.get_wallet_balance(USER_ID), history(db), db.get_total_wallet_balance())
+        db.close()
+    assert results["json"] == results["sqlite"]
+
+
+def callback_request(token):
+    headers = [(b'x-callback-token', token.encode())] if token is not None else []
+    return Request({'method': 'POST', 'path': CALLBACK_PATH, 'headers': headers}, json.dumps(invoice()).encode())
+
+
+@pytest.mark.parametrize("token", [None, "", "wrong-token"])
+def test_callback_without_the_right_token_is_forbidden(tmp_path, monkeypatch, token):
+    monkeypatch.setattr(BotConfig, "XENDIT_CALLBACK_TOKEN", CALLBACK_TOKEN)
+    db = open_database("json", tmp_path)
+    db.add_user(USER_ID, "payer", "Payer")
+
+    class Application:
+        bot_data = {'payments': InvoiceSettler(db, FakeBot())}
+
+    app = WebhookApp(Application(), "secret")
+    assert asyncio.run(app.xendit_callback(callback_request(token))) == (403, {'status': 'forbidden'})
+    assert db.get_wallet_balance(USER_ID) == 0
+    assert asyncio.run(app.xendit_callback(callback_request(CALLBACK_TOKEN))) == (200, {'status': SETTLED})
+    db.close()
@@ -0,0 +1,98 @@
+import asyncio
+
+import httpx
+import pytest
+
+from utils.resilience import CLOSED, HALF_OPEN, OPEN, CircuitBreaker
+from utils.xendit_api import XenditClient
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("utils.resilience.time.monotonic", lambda: now[0])
+    return now
+
+
+def half_open_breaker(clock) -> CircuitBreaker:
+    breaker = CircuitBreaker("test", min_calls=1, cooldown=30.0)
+    breaker.record_failure()
+    assert breaker.state == OPEN
+    clock[0] += 30
+    return breaker
+
+
+def test_one_probe_at_a_time(clock):
+    breaker = half_open_breaker(clock)
+    assert breaker.allow()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CLOSED
+    assert breaker.allow()
+
+
+def test_abandoned_probe_lets_the_next_call_probe(clock):
+    breaker = half_open_breaker(clock)
+    assert breaker.allow()
+    breaker.abandon()
+    assert breaker.allow()
+
+
+def test_stale_probe_expires_after_the_cooldown(clock):
+    breaker = half_open_breaker(clock)
+    assert breaker.allow()
+    clock[0] += 29
+    assert not breaker.allow()
+    clock[0] += 1
+    assert breaker.allow()
+
+
+def xendit_client(handler) -> XenditClient:
+    client = XenditClient(secret_key="xnd_test", base_url="http://xendit.test", max_retries=0,
+                          breaker=CircuitBreaker("xendit", min_calls=1, cooldown=0.0))
+    client._client = httpx.AsyncClient(base_url=client.base_url, transport=httpx.MockTransport(handler))
+    return client
+
+
+def test_probe_that_raises_unexpectedly_does_not_wedge_the_breaker():
+    calls = []
+
+    async def handler(request):
+        calls.append(request)
+        if len(calls) == 1:
+            raise RuntimeError("unexpected")
+        return httpx.Response(200, json={'id': 'inv'})
+
+    async def run():
+        client = xendit_client(handler)
+        client.breaker.record_failure()
+        with pytest.raises(RuntimeError):
+            await client._post('invoice', '/v2/invoices', {})
+        return await client._post('invoice', '/v2/invoices', {})
+
+    assert asyncio.run(run()) == {'id': 'inv'}
+
+
+def test_cancelled_probe_does_not_wedge_the_breaker():
+    async def run():
+        gate = asyncio.Event()
+        responses = iter([None, httpx.Response(200, json={'id': 'inv'})])
+
+        async def handler(request):
+            response = next(responses)
+            if response is None:
+                gate.set()
+                await asyncio.sleep(60)
+            return response
+
+        client = xendit_client(handler)
+        client.breaker.record_failure()
+        probe = asyncio.create_task(client._post('invoice', '/v2/invoices', {}))
+        await gate.wait()
+        probe.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await probe
+        return await client._post('invoice', '/v2/invoices', {})
+
+    assert asyncio.run(run()) == {'id': 'inv'}
@@ -0,0 +1,37 @@
+import asyncio
+
+from utils.sharding import CURSOR_STRIDE, ShardedDatabase, shard_for
+
+# Telegram user ids have up to 52 significant bits
+USER_IDS = [7, 12, 1 << 40, (1 << 52) - 1, (1 << 52) - 4, 5_000_000_001]
+
+
+class IdCursorShards(ShardedDatabase):
+    """Shards paging like the SQLite backend: the cursor is the user id itself"""
+
+    def __init__(self, shards: int, user_ids, tmp_path):
+        super().__init__(None, 0, shards, str(tmp_path))
+        self.owned = {shard: sorted(u for u in user_ids if shard_for(u, shards) == shard) for shard in range(shards)}
+
+    async def call_shard(self, shard, method, after, limit, reachable_only, audience):
+        assert method == 'get_user_id_page'
+        return [(user_id, user_id) for user_id in self.owned[shard] if user_id > after][:limit]
+
+
+def test_cursor_stride_clears_sqlite_user_ids():
+    assert CURSOR_STRIDE > max(USER_IDS)
+
+
+def test_user_id_pages_walk_every_shard_once(tmp_path):
+    db = IdCursorShards(3, USER_IDS, tmp_path)
+
+    async def walk():
+        seen, cursor = [], 0
+        while True:
+            page = await db._user_id_page(cursor, 2)
+            if not page:
+                return seen
+            seen += [user_id for _, user_id in page]
+            cursor = page[-1][0]
+
+    assert sorted(asyncio.run(walk())) == sorted(USER_IDS)
@@ -0,0 +1,161 @@
+import asyncio
+import threading
+
+import pytest
+
+from database import UserDatabase
+from storage.audience import Audience
+from storage.migrate_json_to_sqlite import migrate
+from storage.reachability import BLOCKED, GONE
+from storage.sqlite_backend import SQLiteUserDatabase
+
+# What handlers, jobs and the shard router call on either backend
+INTERFACE = [
+    'run', 'start', 'stop', 'commit', 'close', 'add_user', 'get_user', 'get_all_users', 'get_user_ids',
+    'get_user_id_page', 'count_audience', 'set_reachability', 'get_reachability_stats', 'get_stale_unreachable',
+    'update_wallet_balance', 'settle_invoice', 'get_wallet_balance', 'get_wallet_transactions',
+    'get_wallet_history_page', 'get_total_users', 'get_total_wallet_balance', 'get_wallet_stats',
+    'verify_aggregates', 'flush_activity', 'get_flush_stats',
+]
+
+
+def open_database(backend: str, directory):
+    if backend == "sqlite":
+        return SQLiteUserDatabase(str(directory / "users.db"))
+    return UserDatabase(str(directory / "users.json"))
+
+
+def amounts(page):
+    return [tx['amount'] for tx in page]
+
+
+def populate(db):
+    for user_id in (1, 2, 3):
+        db.add_user(user_id, f"user{user_id}", f"User {user_id}", "en" if user_id != 3 else "id")
+    for amount in range(1, 26):
+        db.update_wallet_balance(1, amount, "deposit", f"deposit {amount}")
+    db.update_wallet_balance(2, 500, "deposit")
+    db.update_wallet_balance(2, -120.5, "withdrawal")
+    db.settle_invoice("inv-1", 3, 98)
+    db.set_reachability([(2, BLOCKED, 1700000000)])
+
+
+def test_both_backends_implement_the_interface():
+    for name in INTERFACE:
+        assert callable(getattr(UserDatabase, name)), name
+        assert callable(getattr(SQLiteUserDatabase, name)), name
+
+
+def test_users_and_balances(tmp_path):
+    db = open_database("sqlite", tmp_path)
+    populate(db)
+    assert db.get_user(1)['username'] == "user1"
+    assert db.get_user(99) is None
+    assert db.get_wallet_balance(1) == sum(range(1, 26))
+    assert db.get_wallet_balance(2) == 379.5
+    assert not db.update_wallet_balance(99, 10)
+    assert not db.settle_invoice("inv-1", 3, 98)
+    assert db.get_total_users() == 3
+    assert db.get_total_wallet_balance() == sum(range(1, 26)) + 379.5 + 98
+    assert db.get_reachability_stats() == {'reachable': 2, 'blocked': 1, 'gone': 0}
+    assert db.get_user_ids(reachable_only=True) == [1, 3]
+    assert db.count_audience(Audience(min_balance=100, language="en")) == 1
+    db.close()
+
+
+def test_history_pages_match_the_json_backend(tmp_path):
+    pages = {}
+    for backend in ("json", "sqlite"):
+        directory = tmp_path / backend
+        directory.mkdir()
+        db = open_database(backend, directory)
+        populate(db)
+        newest, has_older, has_newer = db.get_wallet_history_page(1, 10)
+        older, older_has_older, _ = db.get_wallet_history_page(1, 10, before_id=newest[0]['id'])
+        oldest, oldest_has_older, _ = db.get_wallet_history_page(1, 10, before_id=older[0]['id'])
+        again, _, again_has_newer = db.get_wallet_history_page(1, 10, after_id=oldest[-1]['id'])
+        pages[backend] = [amounts(newest), has_older, has_newer, amounts(older), older_has_older,
+                          amounts(oldest), oldest_has_older, amounts(again), again_has_newer]
+        assert db.get_wallet_history_page(99, 10) == ([], False, False)
+        db.close()
+    assert pages["sqlite"] == pages["json"]
+    assert pages["sqlite"][:3] == [list(range(16, 26)), True, False]
+    assert pages["sqlite"][5:7] == [list(range(1, 6)), False]
+
+
+def test_stats_triggers_keep_the_aggregates_exact(tmp_path):
+    db = open_database("sqlite", tmp_path)
+    populate(db)
+    db.update_wallet_balance(1, -sum(range(1, 26)))
+    assert db.verify_aggregates()
+    json_dir = tmp_path / "json"
+    json_dir.mkdir()
+    reference = open_database("json", json_dir)
+    populate(reference)
+    reference.update_wallet_balance(1, -sum(range(1, 26)))
+    assert db.get_wallet_stats() == reference.get_wallet_stats()
+    reference.close()
+
+    # Drift is found by the full scan and repaired
+    db._conn.execute("UPDATE wallet_stats SET users = users + 5 WHERE bucket = 0")
+    assert db.get_total_users() == 8
+    assert not db.verify_aggregates()
+    assert db.get_total_users() == 3
+    assert db.verify_aggregates()
+    db.close()
+
+
+def test_group_commit_runs_off_the_event_loop(tmp_path):
+    threads = []
+
+    def record_thread():
+        threads.append(threading.current_thread())
+
+    async def run():
+        db = open_database("sqlite", tmp_path)
+        await db.start()
+        await db.run(db.add_user, 1, "user1", "User 1")
+        await db.run(db.update_wallet_balance, 1, 42)
+        await db.run(record_thread)
+        await db.commit()
+        await db.stop()
+        db.close()
+    asyncio.run(run())
+
+    assert threads and threads[0] is not threading.main_thread()
+    db = open_database("sqlite", tmp_path)
+    assert db.get_wallet_balance(1) == 42
+    db.close()
+
+
+@pytest.mark.parametrize("snapshot", [False, True])
+def test_migration_round_trip(tmp_path, snapshot):
+    source = open_database("json", tmp_path)
+    populate(source)
+    if snapshot:
+        source._save_database()
+        # Journal records after the snapshot are migrated too
+        source.add_user(4, "late", "Late")
+        source.update_wallet_balance(4, 7, "deposit")
+        source.set_reachability([(3, GONE, 1700000100)])
+    source.close()
+    source = open_database("json", tmp_path)
+
+    migrate(str(tmp_path / "users.json"), str(tmp_path / "users.db"), batch_size=2)
+    target = open_database("sqlite", tmp_path)
+    fields = ('user_id', 'username', 'first_name', 'wallet_balance', 'joined_date')
+    assert sorted(tuple(user[key] for key in fields) for user in target.get_all_users()) == \
+        sorted(tuple(user[key] for key in fields) for user in source.get_all_users())
+    for user_id in source.get_user_ids():
+        assert history(target, user_id) == history(source, user_id)
+    assert target.get_reachability_stats() == source.get_reachability_stats()
+    assert target.get_wallet_stats() == source.get_wallet_stats()
+    assert target.verify_aggregates()
+    assert not target.settle_invoice("inv-1", 3, 98)
+    source.close()
+    target.close()
+
+
+def history(db, user_id):
+    return [(tx['amount'], tx['type'], tx['description'], tx['old_balance'], tx['new_balance'])
+            for tx in db.get_wallet_transactions(user_id, limit=100)]
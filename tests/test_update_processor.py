@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+from telegram import Update
+
+from utils.update_processor import PerUserUpdateProcessor
+
+
+def update(user_id: int, update_id: int) -> Update:
+    return Update.de_json({'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': 0, 'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': 'Test'}, 'text': "hi"}}, None)
+
+
+class Recorder:
+    def __init__(self):
+        self.events = []
+        self.running = 0
+        self.peak = 0
+
+    async def handle(self, user_id: int, update_id: int, delay: float, fail: bool = False):
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        self.events.append(('start', user_id, update_id))
+        await asyncio.sleep(delay)
+        self.running -= 1
+        self.events.append(('end', user_id, update_id))
+        if fail:
+            raise RuntimeError(f"update {update_id} failed")
+
+
+def process(processor, recorder, jobs):
+    """Hand (user_id, update_id, delay[, fail]) jobs to the processor in order, as the Application does"""
+    async def run():
+        await processor.initialize()
+        tasks = []
+        for job in jobs:
+            tasks.append(asyncio.create_task(processor.process_update(update(*job[:2]), recorder.handle(*job))))
+            # Updates are handed over in arrival order
+            await asyncio.sleep(0)
+        return await asyncio.gather(*tasks, return_exceptions=True)
+    return asyncio.run(run())
+
+
+def user_events(recorder, user_id):
+    return [(kind, update_id) for kind, user, update_id in recorder.events if user == user_id]
+
+
+def test_same_user_updates_run_one_at_a_time_in_order():
+    recorder = Recorder()
+    # Later updates are quicker, so any overlap would reorder them
+    process(PerUserUpdateProcessor(8), recorder, [(1, 1, 0.03), (1, 2, 0.02), (1, 3, 0.01)])
+    assert user_events(recorder, 1) == [('start', 1), ('end', 1), ('start', 2), ('end', 2), ('start', 3), ('end', 3)]
+    assert recorder.peak == 1
+
+
+def test_different_users_run_concurrently_up_to_the_limit():
+    recorder = Recorder()
+    processor = PerUserUpdateProcessor(2)
+    process(processor, recorder, [(user_id, user_id, 0.02) for user_id in range(1, 7)])
+    assert recorder.peak == 2
+    assert processor.stats()['processed'] == 6
+
+    recorder = Recorder()
+    process(PerUserUpdateProcessor(8), recorder, [(user_id, user_id, 0.02) for user_id in range(1, 7)])
+    assert recorder.peak == 6
+
+
+def test_a_failing_update_does_not_wedge_its_user():
+    recorder = Recorder()
+    processor = PerUserUpdateProcessor(2)
+    results = process(processor, recorder, [(1, 1, 0.01, True), (1, 2, 0.0), (2, 3, 0.0)])
+    assert isinstance(results[0], RuntimeError) and results[1:] == [None, None]
+    assert user_events(recorder, 1) == [('start', 1), ('end', 1), ('start', 2), ('end', 2)]
+    stats = processor.stats()
+    assert (stats['running'], stats['held'], stats['users']) == (0, 0, 0)
+
+
+def test_a_cancelled_update_releases_the_next_one():
+    recorder = Recorder()
+    processor = PerUserUpdateProcessor(2)
+
+    async def run():
+        await processor.initialize()
+        first = asyncio.create_task(processor.process_update(update(1, 1), recorder.handle(1, 1, 10)))
+        await asyncio.sleep(0.01)
+        second = asyncio.create_task(processor.process_update(update(1, 2), recorder.handle(1, 2, 0)))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        await asyncio.wait_for(second, 1)
+    asyncio.run(run())
+    assert user_events(recorder, 1)[-2:] == [('start', 2), ('end', 2)]
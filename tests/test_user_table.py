@@ -0,0 +1,123 @@
+import random
+from datetime import datetime
+
+from storage.aggregates import balance_bucket
+from storage.audience import Audience
+from storage.reachability import BLOCKED
+from storage.user_table import DAY_MICROS, MINOR_UNITS, UserTable, iso_to_micros, micros_to_iso
+
+NOW = datetime(2024, 6, 1, 12, 0, 0, 123456)
+
+
+def table_with(count: int, seed: int = 7) -> UserTable:
+    rng = random.Random(seed)
+    table = UserTable()
+    for user_id in range(1000, 1000 + count):
+        active = NOW.timestamp() - rng.randrange(0, 30 * 86400)
+        table.add(user_id, f"user{user_id}", "Name", rng.choice([0, 5, 99.99, 1000, 25000.5]),
+                  NOW.isoformat(), datetime.fromtimestamp(active).isoformat(),
+                  language_code=rng.choice(["en", "id", None]))
+    return table
+
+
+def matching(table: UserTable, audience: Audience) -> list:
+    # Brute force over the columns, for comparison with the indexed lookup
+    return [user['user_id'] for user in table.rows()
+            if user['reachability'] == 'reachable'
+            and (audience.active_since is None
+                 or iso_to_micros(user['last_active']) >= audience.active_since * 1_000_000)
+            and (audience.min_balance is None or user['wallet_balance'] >= audience.min_balance)
+            and (audience.language is None or user['language_code'] == audience.language)]
+
+
+def check_indexes(table: UserTable):
+    for row in range(len(table)):
+        assert row in table.by_day.buckets[table.last_active[row] // DAY_MICROS]
+        assert row in table.by_balance.buckets[balance_bucket(table.balances[row] / MINOR_UNITS)]
+        assert row in table.by_language.buckets[table.languages[row]]
+    for index in (table.by_day, table.by_balance, table.by_language):
+        assert sum(len(bucket) for bucket in index.buckets.values()) == len(table)
+        assert all(list(bucket) == sorted(bucket) for bucket in index.buckets.values())
+
+
+def test_rows_round_trip_through_packed_columns():
+    table = UserTable()
+    user = table.add(1, "alice", "Alice", 12.34, NOW.isoformat(), NOW.isoformat(), language_code="en")
+    assert dict(user) == {
+        'user_id': 1, 'username': "alice", 'first_name': "Alice", 'wallet_balance': 12.34,
+        'joined_date': NOW.isoformat(), 'last_active': NOW.isoformat(), 'reachability': "reachable",
+        'reachability_checked': None, 'language_code': "en"}
+    assert table.balances[0] == 1234
+    assert micros_to_iso(iso_to_micros(NOW.isoformat())) == NOW.isoformat()
+
+    # Balances are exact in cents, without float drift
+    for _ in range(10):
+        user['wallet_balance'] += 0.1
+    assert user['wallet_balance'] == 13.34
+    assert table.get(1)['wallet_balance'] == 13.34
+    assert table.get(2) is None
+
+
+def test_names_are_interned():
+    table = UserTable()
+    first = table.add(1, "".join(["bo", "b"]), "".join(["Bo", "b"]), 0, NOW.isoformat(), NOW.isoformat(),
+                      language_code="".join(["e", "n"]))
+    second = table.add(2, "".join(["b", "ob"]), "".join(["B", "ob"]), 0, NOW.isoformat(), NOW.isoformat(),
+                       language_code="".join(["e", "n"]))
+    assert first['username'] is second['username']
+    assert first['first_name'] is second['first_name']
+    assert first['language_code'] is second['language_code']
+
+
+def test_copy_is_independent_and_skips_the_indexes():
+    table = table_with(50)
+    copy = table.copy()
+    table.get(1000)['wallet_balance'] = 777
+    table.get(1000)['username'] = "renamed"
+    table.add(5000, "new", "New", 0, NOW.isoformat(), NOW.isoformat())
+
+    assert copy.get(1000)['wallet_balance'] != 777
+    assert copy.get(1000)['username'] == "user1000"
+    assert 5000 not in copy and len(copy) == 50
+    assert [user_id for user_id, _ in copy.items()] == list(range(1000, 1050))
+    assert not copy.by_day.buckets and not copy.by_balance.buckets and not copy.by_language.buckets
+
+
+def test_indexes_follow_every_change():
+    table = table_with(300)
+    rng = random.Random(11)
+    for _ in range(500):
+        user = table.get(rng.randrange(1000, 1300))
+        change = rng.randrange(4)
+        if change == 0:
+            user['wallet_balance'] = rng.choice([0, 3, 150, 40000])
+        elif change == 1:
+            table.set_last_active(user['user_id'], int(NOW.timestamp()) - rng.randrange(0, 60 * 86400))
+        elif change == 2:
+            user['language_code'] = rng.choice(["en", "id", "ru", None])
+        else:
+            table.set_reachability(user['user_id'], BLOCKED, int(NOW.timestamp()))
+    check_indexes(table)
+
+    since = int(NOW.timestamp()) - 7 * 86400
+    for audience in (Audience(active_since=since), Audience(min_balance=100), Audience(language="id"),
+                     Audience(active_since=since, min_balance=100, language="en"), Audience()):
+        expected = matching(table, audience)
+        assert table.segment_count(audience) == len(expected)
+        pages, after = [], 0
+        while True:
+            page = table.segment_page(after, 17, audience)
+            if not page:
+                break
+            pages += [user_id for _, user_id in page]
+            after = page[-1][0]
+        assert pages == expected
+
+
+def test_reachability_counts():
+    table = table_with(10)
+    assert table.set_reachability(1003, BLOCKED, 1700000000)
+    assert not table.set_reachability(1003, BLOCKED, 1700000100)
+    assert table.reach_counts == [9, 1, 0]
+    assert table.get(1003)['reachability_checked'] == micros_to_iso(1700000100 * 1_000_000)
+    assert [user_id for _, user_id in table.reachable_page(0, 100)] == [u for u in range(1000, 1010) if u != 1003]
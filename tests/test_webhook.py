@@ -0,0 +1,94 @@
+import asyncio
+import json
+
+import pytest
+from telegram.ext import Application
+
+from utils.ingestion import UpdateDeduplicator, UpdateQueue
+from utils.webhook import Request, WebhookApp
+
+SECRET = "secret"
+
+
+def telegram_request(payload: dict) -> Request:
+    scope = {'method': 'POST', 'path': '/telegram/webhook',
+             'headers': [(b'x-telegram-bot-api-secret-token', SECRET.encode())]}
+    return Request(scope, json.dumps(payload).encode())
+
+
+def message(update_id: int) -> dict:
+    return {'update_id': update_id, 'message': {
+        'message_id': 1, 'date': 0, 'chat': {'id': 7, 'type': 'private'},
+        'from': {'id': 7, 'is_bot': False, 'first_name': 'Test'}, 'text': '/start',
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}]}}
+
+
+def webhook_app(tmp_path, queue_size: int = 10) -> WebhookApp:
+    application = (Application.builder().token("123456:test").updater(None)
+                   .update_queue(UpdateQueue(queue_size)).build())
+    return WebhookApp(application, SECRET, UpdateDeduplicator(100, str(tmp_path / "update_ids.json")))
+
+
+def test_redelivery_is_dropped(tmp_path):
+    app = webhook_app(tmp_path)
+
+    async def deliver_twice():
+        return [await app.telegram_webhook(telegram_request(message(1))) for _ in range(2)]
+
+    first, second = asyncio.run(deliver_twice())
+    assert first == (200, {'status': 'received'})
+    assert second == (200, {'status': 'duplicate'})
+    assert app.application.update_queue.qsize() == 1
+    assert app.deduplicator.duplicates == 1
+
+
+def test_refused_update_is_accepted_when_redelivered(tmp_path):
+    app = webhook_app(tmp_path, queue_size=1)
+
+    async def deliver():
+        await app.telegram_webhook(telegram_request(message(1)))
+        refused = await app.telegram_webhook(telegram_request(message(2)))
+        await app.application.update_queue.get()
+        app.application.update_queue.task_done()
+        return refused, await app.telegram_webhook(telegram_request(message(2)))
+
+    refused, redelivered = asyncio.run(deliver())
+    assert refused[0] == 503
+    assert redelivered == (200, {'status': 'received'})
+
+
+def test_failed_offer_does_not_mark_update_as_seen(tmp_path):
+    app = webhook_app(tmp_path)
+    calls = []
+
+    async def failing_offer(data):
+        calls.append(data['update_id'])
+        if len(calls) == 1:
+            raise ValueError("could not parse update")
+        return await WebhookApp.offer(app, data)
+
+    app.offer = failing_offer
+
+    async def deliver():
+        with pytest.raises(ValueError):
+            await app.telegram_webhook(telegram_request({'update_id': 42, 'message': {}}))
+        return await app.telegram_webhook(telegram_request(message(42)))
+
+    assert asyncio.run(deliver()) == (200, {'status': 'received'})
+    assert calls == [42, 42]
+
+
+def test_high_water_mark_survives_restart(tmp_path):
+    state_file = str(tmp_path / "update_ids.json")
+    before = UpdateDeduplicator(100, state_file)
+    for update_id in (1000, 1001, 1002):
+        assert before.claim(update_id)
+        before.finish(update_id, queued=True)
+    before.save()
+
+    after = UpdateDeduplicator(100, state_file)
+    assert not after.claim(1002)
+    assert not after.claim(950)
+    assert after.claim(1003)
+    # Far below the saved mark: Telegram started a new sequence
+    assert after.claim(1)
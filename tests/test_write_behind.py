@@ -0,0 +1,49 @@
+import asyncio
+import logging
+import threading
+
+from storage.journal import JournalStore
+from storage.ledger import WalletLedger
+from storage.write_behind import WriteBehindQueue
+
+
+def test_ledger_is_flushed_on_the_event_loop(tmp_path):
+    threads = []
+    journal = JournalStore(str(tmp_path / "users.json"))
+    queue = WriteBehindQueue(journal, lambda: ({}, dict), lambda: 0, flush_interval_ms=1,
+                             before_write=lambda: threads.append(threading.get_ident()))
+
+    async def run():
+        queue.start()
+        queue.submit({'op': 'active', 'ts': [], 'seq': journal.next_seq()})
+        await queue.wait_flushed()
+        await queue.stop()
+
+    asyncio.run(run())
+    assert threads == [threading.get_ident()]
+    journal.close()
+
+
+def test_ledger_segments_roll_while_the_journal_is_flushed(tmp_path, caplog):
+    journal = JournalStore(str(tmp_path / "users.json"))
+    # Tiny segments, so appends keep closing and replacing the ledger's writer
+    ledger = WalletLedger(str(tmp_path / "ledger"), segment_size=256)
+    queue = WriteBehindQueue(journal, lambda: ({}, dict), lambda: 0, flush_interval_ms=1, max_batch=5,
+                             before_write=ledger.flush)
+
+    async def run():
+        queue.start()
+        for i in range(2000):
+            ledger.append(i % 7, {'amount': i})
+            queue.submit({'op': 'balance', 'user_id': i % 7, 'balance': i, 'seq': journal.next_seq()})
+            if i % 3 == 0:
+                await asyncio.sleep(0)
+        await queue.stop()
+
+    with caplog.at_level(logging.ERROR):
+        asyncio.run(run())
+    assert not [record for record in caplog.records if "flush failed" in record.getMessage()]
+    assert queue.stats.records == 2000
+    assert sum(ledger.count(user_id) for user_id in range(7)) == 2000
+    ledger.close()
+    journal.close()
@@ -0,0 +1,234 @@
+import asyncio
+import time
+import logging
+from datetime import timedelta
+from typing import AsyncIterable, Awaitable, Callable, Dict, Iterable, Optional, Union
+
+from telegram.error import RetryAfter, TimedOut
+
+logger = logging.getLogger(__name__)
+
+# Called once per recipient with the final error, or None when delivered
+ResultCallback = Callable[[int, Optional[Exception]], None]
+
+
+def retry_after_seconds(error: RetryAfter) -> float:
+    """Read RetryAfter.retry_after, which is an int or a timedelta depending on the PTB version"""
+    value = error.retry_after
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+
+class TokenBucket:
+    """Async token bucket shared by all senders of a broadcast.
+
+    Waiters are served in FIFO order under one lock, so tokens are handed
+    out evenly at `rate` per second after an initial burst of `capacity`.
+    pause() empties the bucket and holds every waiter until the deadline.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1.0):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def pause(self, seconds: float):
+        """Hand out no tokens for the next `seconds`, then restart from an empty bucket"""
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self.tokens = 0.0
+        self._updated = self._paused_until
+
+    @property
+    def paused(self) -> bool:
+        return time.monotonic() < self._paused_until
+
+    async def acquire(self, tokens: float = 1.0):
+        """Wait for the given number of tokens (at most the capacity)"""
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+
+class BroadcastStats:
+    """Counters for one broadcast run"""
+
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.flood_waits = 0
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    @property
+    def rate(self) -> float:
+        """Delivered messages per second"""
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    def as_dict(self) -> Dict:
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'retries': self.retries,
+            'flood_waits': self.flood_waits,
+            'elapsed_s': round(self.elapsed, 2),
+            'rate': round(self.rate, 2)
+        }
+
+
+class BroadcastEngine:
+    """Sends one message per recipient through a pool of concurrent senders.
+
+    Every send takes a token from a global TokenBucket (Telegram allows about
+    30 messages per second per bot) and respects a minimum interval per chat.
+    A RetryAfter pauses the whole engine for the requested time, retries the
+    recipient and lowers the rate a step. The rate that triggered it becomes
+    a ceiling just below which the rate climbs back after a run of clean
+    sends, so the engine settles close to the limit Telegram actually
+    enforces. Timeouts are retried too; any other error is final for that
+    recipient. A send that Telegram counts as several messages, such as an
+    album, takes `cost` tokens.
+    """
+
+    def __init__(self, send: Callable[[int], Awaitable], rate: float = 30.0, concurrency: int = 16,
+                 per_chat_interval: float = 1.0, max_retries: int = 3, burst: float = 1.0,
+                 min_rate: float = 1.0, backoff: float = 0.8, cost: int = 1):
+        self.send = send
+        self.cost = cost
+        self.max_rate = rate
+        self.ceiling = rate
+        self.min_rate = min(min_rate, rate)
+        self.backoff = backoff
+        self.concurrency = concurrency
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(rate, max(burst, cost))
+        self.stats = BroadcastStats()
+        self._chat_next: Dict[int, float] = {}
+        self._clean_sends = 0
+        self._stopping = False
+
+    def stop(self):
+        """Stop taking new recipients; sends already in flight still finish.
+
+        Recipients pulled from the source but not yet sent are dropped without
+        a result, so a resumed run starts again from them.
+        """
+        self._stopping = True
+
+    @property
+    def stopping(self) -> bool:
+        return self._stopping
+
+    async def run(self, recipients: Union[Iterable[int], AsyncIterable[int]],
+                  on_result: Optional[ResultCallback] = None) -> BroadcastStats:
+        """Send to every recipient and return the final counters.
+
+        Recipients are pulled lazily, so they can be a generator over the
+        user store rather than a materialized list.
+        """
+        self.stats = BroadcastStats()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.concurrency * 2)
+        workers = [asyncio.create_task(self._worker(queue, on_result)) for _ in range(self.concurrency)]
+        try:
+            if hasattr(recipients, '__aiter__'):
+                async for chat_id in recipients:
+                    if self._stopping:
+                        break
+                    await queue.put(chat_id)
+            else:
+                for chat_id in recipients:
+                    if self._stopping:
+                        break
+                    await queue.put(chat_id)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            self.stats.finished = time.monotonic()
+        return self.stats
+
+    async def _worker(self, queue: asyncio.Queue, on_result: Optional[ResultCallback]):
+        while True:
+            chat_id = await queue.get()
+            if chat_id is None:
+                return
+            if self._stopping:
+                continue
+            error = await self._deliver(chat_id)
+            if error is None:
+                self.stats.sent += 1
+            else:
+                self.stats.failed += 1
+                logger.warning(f"Failed to send broadcast to user {chat_id}: {error}")
+            if on_result is not None:
+                on_result(chat_id, error)
+
+    async def _deliver(self, chat_id: int) -> Optional[Exception]:
+        error = None
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self.stats.retries += 1
+            await self._wait_chat(chat_id)
+            await self.bucket.acquire(self.cost)
+            try:
+                await self.send(chat_id)
+            except RetryAfter as e:
+                self._on_flood(retry_after_seconds(e))
+                error = e
+            except TimedOut as e:
+                error = e
+            except Exception as e:
+                return e
+            else:
+                self._on_success()
+                return None
+        return error
+
+    async def _wait_chat(self, chat_id: int):
+        now = time.monotonic()
+        wait = self._chat_next.get(chat_id, 0.0) - now
+        if wait > 0:
+            await asyncio.sleep(wait)
+            now += wait
+        self._chat_next[chat_id] = now + self.per_chat_interval
+        if len(self._chat_next) > 10000:
+            self._chat_next = {chat: ready for chat, ready in self._chat_next.items() if ready > now}
+
+    def _on_flood(self, seconds: float):
+        self.stats.flood_waits += 1
+        self._clean_sends = 0
+        if not self.bucket.paused:
+            self.ceiling = max(self.min_rate, min(self.ceiling, self.bucket.rate * 0.95))
+            self.bucket.rate = max(self.min_rate, self.bucket.rate * self.backoff)
+            logger.warning(f"Flood control: pausing broadcast for {seconds:.0f}s, "
+                           f"rate lowered to {self.bucket.rate:.1f} msg/s")
+        self.bucket.pause(seconds)
+
+    def _on_success(self):
+        # Additive increase: one msg/s more after ~2 seconds' worth of clean sends
+        self._clean_sends += 1
+        if self.bucket.rate < self.ceiling and self._clean_sends >= self.bucket.rate * 2:
+            self.bucket.rate = min(self.ceiling, self.bucket.rate + 1)
+            self._clean_sends = 0
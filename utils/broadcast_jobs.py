@@ -0,0 +1,423 @@
+import asyncio
+import csv
+import json
+import os
+import time
+import logging
+from collections import deque
+from datetime import datetime
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from telegram.constants import ChatAction
+from telegram.error import BadRequest, Forbidden
+from telegram.ext import Application, ContextTypes, JobQueue
+
+from bot_config import BotConfig
+from storage.audience import Audience
+from storage.reachability import BLOCKED, GONE, REACHABLE
+from utils.broadcast_engine import BroadcastEngine
+from utils.broadcast_media import AlbumCollector, MediaLibrary, media_sender, message_cost
+
+logger = logging.getLogger(__name__)
+
+RUNNING = "running"
+PAUSED = "paused"
+COMPLETED = "completed"
+
+# Finished jobs kept in the store for /broadcast_status
+KEEP_FINISHED = 20
+
+# Columns of the per-recipient results file
+RESULT_FIELDS = ('user_id', 'status', 'error_class', 'error', 'timestamp')
+
+# Distinct error classes tracked per job; the rest are counted as "Other"
+MAX_ERROR_CLASSES = 10
+
+
+def count_error(errors: Dict[str, Dict], error: Exception):
+    """Add a failure to a job's per-error-class counters, keeping one example message"""
+    name = type(error).__name__
+    if name not in errors and len(errors) >= MAX_ERROR_CLASSES:
+        name = "Other"
+    entry = errors.setdefault(name, {'count': 0, 'example': str(error)[:100]})
+    entry['count'] += 1
+
+
+def classify_error(error: Exception) -> Optional[int]:
+    """Map a send error to the reachability state it proves, if any"""
+    message = str(error).lower()
+    if isinstance(error, Forbidden):
+        return GONE if "deactivated" in message else BLOCKED
+    if isinstance(error, BadRequest) and "chat not found" in message:
+        return GONE
+    return None
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h {minutes:02d}m"
+    return f"{minutes}m {seconds:02d}s" if minutes else f"{seconds}s"
+
+
+class BroadcastJobStore:
+    """Broadcast jobs and cached media persisted as one small JSON file, replaced atomically on save"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.jobs: Dict[str, Dict] = {}
+        self.media: Dict[str, Dict] = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    data = json.load(f)
+            except (json.JSONDecodeError, OSError) as e:
+                logger.error(f"Broadcast job file {path} is unreadable, starting empty: {e}")
+            else:
+                # Older versions stored the jobs map alone
+                self.jobs = data['jobs'] if 'jobs' in data else data
+                self.media = data.get('media', {}) if 'jobs' in data else {}
+
+    def _write(self, payload: str):
+        tmp_file = f"{self.path}.tmp"
+        with open(tmp_file, 'w') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.path)
+
+    async def save(self):
+        """Write the current state of every job off the event loop"""
+        finished = [job_id for job_id, job in self.jobs.items() if job['status'] == COMPLETED]
+        for job_id in finished[:-KEEP_FINISHED]:
+            del self.jobs[job_id]
+        # Serialized on the loop so the worker thread sees a consistent copy
+        await asyncio.to_thread(self._write, json.dumps({'jobs': self.jobs, 'media': self.media}, indent=2))
+
+
+class CursorTracker:
+    """Low-water mark over recipients that complete out of order.
+
+    Each recipient handed to the engine is registered with the cursor that
+    follows it. The checkpoint cursor only moves past a recipient once it and
+    every recipient before it have a result, so resuming from it never skips
+    anyone (at worst, sends still in flight at a crash are repeated).
+    """
+
+    def __init__(self, cursor: List):
+        self.cursor = cursor
+        self._issued: deque = deque()
+        self._done = set()
+        self._pending: Dict[int, int] = {}
+        self._next = 0
+
+    def issue(self, chat_id: int, cursor: List):
+        self._pending[chat_id] = self._next
+        self._issued.append((self._next, cursor))
+        self._next += 1
+
+    def complete(self, chat_id: int):
+        self._done.add(self._pending.pop(chat_id))
+        while self._issued and self._issued[0][0] in self._done:
+            seq, self.cursor = self._issued.popleft()
+            self._done.discard(seq)
+
+
+class BroadcastManager:
+    """Runs broadcasts as background jobs on the application's JobQueue.
+
+    A job walks the reachable users of its audience page by page through
+    get_user_id_page(), starting with any admins who are not users
+    themselves, and checkpoints its cursor and counters every
+    BROADCAST_CHECKPOINT_INTERVAL seconds. A job may carry a media asset
+    from the MediaLibrary, which every recipient gets by file_id.
+    Users found to have blocked the bot or deleted their chat are marked
+    unreachable in the store, so later broadcasts skip them until a
+    re-probe finds them reachable again.
+    Jobs still marked running are scheduled again on startup and continue
+    from their last checkpoint.
+    """
+
+    def __init__(self, db, jobs_file: str):
+        self.db = db
+        self.store = BroadcastJobStore(jobs_file)
+        self.media = MediaLibrary(self.store.media)
+        self.albums = AlbumCollector()
+        # Runs in progress: job id -> (engine, cursor tracker)
+        self._active: Dict[str, Tuple[BroadcastEngine, CursorTracker]] = {}
+
+    def create(self, text: str, admin_id: int, chat_id: int, message_id: int, extra_ids: List[int],
+               total: int, audience: Optional[Audience] = None, media: Optional[Dict] = None) -> Dict:
+        """Register a new job; call start() to schedule it.
+
+        With a media asset, text becomes its caption.
+        """
+        job_id = str(max((int(key) for key in self.store.jobs), default=0) + 1)
+        job = {
+            'id': job_id,
+            'status': RUNNING,
+            'text': text,
+            'admin_id': admin_id,
+            'chat_id': chat_id,
+            'message_id': message_id,
+            'extra_ids': extra_ids,
+            # Only the criteria are stored; recipients are paged from the indexes as the job runs
+            'audience': audience.as_dict() if audience is not None else None,
+            'media': media,
+            # Next position in extra_ids, then the user store cursor
+            'cursor': ['extra', 0],
+            'total': total,
+            'sent': 0,
+            'failed': 0,
+            # Error class -> {'count', 'example'}
+            'errors': {},
+            'created': datetime.now().isoformat(),
+            'finished': None
+        }
+        self.store.jobs[job_id] = job
+        return job
+
+    def get(self, job_id: Optional[str] = None, status: str = None) -> Optional[Dict]:
+        """Get a job by id, or else the most recent one with the given status"""
+        if job_id is not None:
+            return self.store.jobs.get(job_id)
+        matching = [job for job in self.store.jobs.values() if job['status'] == status]
+        return matching[-1] if matching else None
+
+    def jobs(self) -> List[Dict]:
+        return list(self.store.jobs.values())
+
+    def is_active(self, job_id: str) -> bool:
+        """Whether a run of the job is still in progress (possibly finishing a pause)"""
+        return job_id in self._active
+
+    async def start(self, job_queue: JobQueue, job_id: str):
+        """Persist the job as running and schedule a run of it"""
+        self.store.jobs[job_id]['status'] = RUNNING
+        await self.store.save()
+        job_queue.run_once(self._run_job, when=0, data=job_id, name=f"broadcast:{job_id}")
+
+    async def pause(self, job_id: str):
+        """Mark a job paused and stop its engine after the sends in flight"""
+        self.store.jobs[job_id]['status'] = PAUSED
+        if job_id in self._active:
+            self._active[job_id][0].stop()
+        await self.store.save()
+    
+    async def shutdown(self):
+        """Stop every run and checkpoint it; the jobs stay running and resume on the next start"""
+        for job_id, (engine, tracker) in self._active.items():
+            engine.stop()
+            self.store.jobs[job_id]['cursor'] = tracker.cursor
+        await self.store.save()
+
+    async def resume_unfinished(self, application: Application):
+        """Schedule every job that was running when the bot last stopped"""
+        for job in self.jobs():
+            if job['status'] == RUNNING:
+                logger.info(f"Resuming broadcast {job['id']} from {job['cursor']}")
+                await self.start(application.job_queue, job['id'])
+
+    async def _recipients(self, job: Dict, tracker: CursorTracker) -> AsyncIterator[int]:
+        phase, position = job['cursor']
+        extra_ids = job['extra_ids']
+        audience = Audience.from_dict(job.get('audience'))
+        if phase == 'extra':
+            for i in range(position, len(extra_ids)):
+                tracker.issue(extra_ids[i], ['extra', i + 1])
+                yield extra_ids[i]
+            position = 0
+        while True:
+            page = await self.db.run(self.db.get_user_id_page, position, BotConfig.BROADCAST_PAGE_SIZE,
+                                     True, audience)
+            if not page:
+                return
+            for position, user_id in page:
+                tracker.issue(user_id, ['db', position])
+                yield user_id
+
+    async def _save_reachability(self, updates: List[Tuple[int, int, int]]):
+        if updates:
+            batch = updates[:]
+            updates.clear()
+            await self.db.run(self.db.set_reachability, batch)
+
+    async def _checkpoint_periodically(self, job: Dict, tracker: CursorTracker, results,
+                                       reachability: List[Tuple[int, int, int]]):
+        while True:
+            await asyncio.sleep(BotConfig.BROADCAST_CHECKPOINT_INTERVAL)
+            results.flush()
+            await self._save_reachability(reachability)
+            job['cursor'] = tracker.cursor
+            await self.store.save()
+
+    async def _progress_periodically(self, context: ContextTypes.DEFAULT_TYPE, job: Dict,
+                                     engine: BroadcastEngine):
+        # Edits are throttled: a status edit per result would hit the flood limits itself
+        last_text = None
+        while True:
+            await asyncio.sleep(BotConfig.BROADCAST_PROGRESS_INTERVAL)
+            text = self._progress_text(job, engine)
+            if text != last_text:
+                await self._edit_status(context, job, text)
+                last_text = text
+
+    def _progress_text(self, job: Dict, engine: BroadcastEngine) -> str:
+        done = job['sent'] + job['failed']
+        total = max(job['total'], done)
+        rate = engine.stats.rate
+        eta = format_duration((total - done) / rate) if rate > 0 else "unknown"
+        text = f"📡 Broadcast #{job['id']} in progress\n\n"
+        text += f"📊 {done}/{total} ({done / total if total else 1:.1%})\n"
+        text += f"📤 Sent: {job['sent']}\n"
+        text += f"❌ Failed: {job['failed']}\n"
+        text += f"⚡ Rate: {rate:.1f} msg/s\n"
+        text += f"⏳ ETA: {eta}"
+        return text
+
+    async def _edit_status(self, context: ContextTypes.DEFAULT_TYPE, job: Dict, text: str):
+        try:
+            await context.bot.edit_message_text(text, chat_id=job['chat_id'], message_id=job['message_id'])
+        except Exception as e:
+            logger.warning(f"Could not update status message of broadcast {job['id']}: {e}")
+
+    def _results_path(self, job_id: str) -> str:
+        return os.path.join(BotConfig.BROADCAST_RESULTS_DIR, f"broadcast_{job_id}.csv")
+
+    def _open_results(self, job_id: str):
+        """Open the job's results CSV for appending (a resumed run continues the same file)"""
+        os.makedirs(BotConfig.BROADCAST_RESULTS_DIR, exist_ok=True)
+        results = open(self._results_path(job_id), 'a', newline='')
+        if results.tell() == 0:
+            csv.writer(results).writerow(RESULT_FIELDS)
+        return results
+
+    async def _run_job(self, context: ContextTypes.DEFAULT_TYPE):
+        job = self.store.jobs.get(context.job.data)
+        if job is None or job['status'] != RUNNING or job['id'] in self._active:
+            return
+        media = job.get('media')
+        if media:
+            send = media_sender(context.bot, media, job['text'] or None)
+        else:
+            text = f"📢 **Broadcast Message**\n\n{job['text']}\n\n_This is an official broadcast from the bot administrators._"
+            send = lambda user_id: context.bot.send_message(chat_id=user_id, text=text, parse_mode='Markdown')
+        engine = BroadcastEngine(
+            send,
+            rate=BotConfig.BROADCAST_RATE,
+            concurrency=BotConfig.BROADCAST_CONCURRENCY,
+            per_chat_interval=BotConfig.BROADCAST_PER_CHAT_INTERVAL,
+            max_retries=BotConfig.BROADCAST_MAX_RETRIES,
+            cost=message_cost(media)
+        )
+        tracker = CursorTracker(job['cursor'])
+        job.setdefault('errors', {})
+        results = self._open_results(job['id'])
+        writer = csv.writer(results)
+        reachability: List[Tuple[int, int, int]] = []
+
+        def on_result(user_id, error):
+            timestamp = datetime.now().isoformat(timespec='seconds')
+            if error is None:
+                job['sent'] += 1
+                writer.writerow((user_id, 'sent', '', '', timestamp))
+            else:
+                job['failed'] += 1
+                count_error(job['errors'], error)
+                state = classify_error(error)
+                if state is not None:
+                    reachability.append((user_id, state, int(time.time())))
+                writer.writerow((user_id, 'failed', type(error).__name__, str(error), timestamp))
+            tracker.complete(user_id)
+
+        self._active[job['id']] = (engine, tracker)
+        background = [
+            asyncio.create_task(self._checkpoint_periodically(job, tracker, results, reachability)),
+            asyncio.create_task(self._progress_periodically(context, job, engine))
+        ]
+        completed = False
+        try:
+            await engine.run(self._recipients(job, tracker), on_result)
+            completed = not engine.stopping
+        finally:
+            for task in background:
+                task.cancel()
+            del self._active[job['id']]
+            results.close()
+            await self._save_reachability(reachability)
+            job['cursor'] = tracker.cursor
+            if completed:
+                job['status'] = COMPLETED
+                job['finished'] = datetime.now().isoformat()
+            await self.store.save()
+
+        if completed:
+            await self._report(context, job, engine)
+
+    async def _report(self, context: ContextTypes.DEFAULT_TYPE, job: Dict, engine: BroadcastEngine):
+        """Replace the status message with a fixed-size summary and send the full results as a document"""
+        message = f"✅ Broadcast #{job['id']} completed!\n\n"
+        message += f"📤 Successfully sent: {job['sent']}\n"
+        message += f"❌ Failed to send: {job['failed']}\n"
+        message += f"📊 Total users: {job['sent'] + job['failed']}\n"
+        message += f"⏱ Last run: {format_duration(engine.stats.elapsed)} at {engine.stats.rate:.1f} msg/s"
+        if job['errors']:
+            message += "\n\n⚠️ Failures by error:\n"
+            for name, entry in sorted(job['errors'].items(), key=lambda item: -item[1]['count']):
+                message += f"• {name}: {entry['count']} (e.g. {entry['example']})\n"
+        await self._edit_status(context, job, message)
+
+        try:
+            with open(self._results_path(job['id']), 'rb') as document:
+                await context.bot.send_document(
+                    chat_id=job['chat_id'],
+                    document=document,
+                    filename=f"broadcast_{job['id']}.csv",
+                    caption=f"📄 Per-recipient results of broadcast #{job['id']}"
+                )
+        except Exception as e:
+            logger.warning(f"Could not send results of broadcast {job['id']}: {e}")
+        logger.info(f"Broadcast {job['id']} completed: {job['sent']} success, {job['failed']} failed")
+
+    async def start_reprobe(self, job_queue: JobQueue, chat_id: int, older_than: float) -> int:
+        """Schedule a low-priority re-probe of users unreachable for longer than older_than seconds"""
+        user_ids = await self.db.run(self.db.get_stale_unreachable, int(time.time() - older_than))
+        if user_ids:
+            job_queue.run_once(self._run_reprobe, when=0, data={'chat_id': chat_id, 'user_ids': user_ids},
+                               name="broadcast:reprobe")
+        return len(user_ids)
+
+    async def _run_reprobe(self, context: ContextTypes.DEFAULT_TYPE):
+        # A chat action is invisible to the user but fails exactly like a message would
+        async def probe(user_id):
+            while self._active:
+                # Broadcasts have priority over the shared flood budget
+                await asyncio.sleep(1)
+            await context.bot.send_chat_action(chat_id=user_id, action=ChatAction.TYPING)
+
+        engine = BroadcastEngine(
+            probe,
+            rate=BotConfig.REPROBE_RATE,
+            concurrency=2,
+            per_chat_interval=BotConfig.BROADCAST_PER_CHAT_INTERVAL,
+            max_retries=BotConfig.BROADCAST_MAX_RETRIES
+        )
+        updates: List[Tuple[int, int, int]] = []
+
+        def on_result(user_id, error):
+            state = REACHABLE if error is None else classify_error(error)
+            if state is not None:
+                updates.append((user_id, state, int(time.time())))
+
+        user_ids = context.job.data['user_ids']
+        await engine.run(user_ids, on_result)
+        await self.db.run(self.db.set_reachability, updates)
+
+        recovered = sum(1 for _, state, _ in updates if state == REACHABLE)
+        message = f"🔁 Re-probe finished: {recovered} of {len(user_ids)} unreachable users are reachable again."
+        try:
+            await context.bot.send_message(chat_id=context.job.data['chat_id'], text=message)
+        except Exception as e:
+            logger.warning(f"Could not report re-probe results: {e}")
+        logger.info(f"Re-probe finished: {recovered}/{len(user_ids)} reachable again")
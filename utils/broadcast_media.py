@@ -0,0 +1,113 @@
+from collections import OrderedDict
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from telegram import Bot, InputMediaDocument, InputMediaPhoto, InputMediaVideo, Message
+
+# Longest caption Telegram accepts on a photo, video or document
+MAX_CAPTION_LENGTH = 1024
+
+# Media groups remembered while waiting for a /broadcast reply
+MAX_PENDING_ALBUMS = 20
+
+INPUT_MEDIA = {'photo': InputMediaPhoto, 'video': InputMediaVideo, 'document': InputMediaDocument}
+
+
+def media_from_message(message: Message) -> Optional[Dict]:
+    """The photo (largest size), video or document of a message as a media item, or None"""
+    if message.photo:
+        kind, media = 'photo', message.photo[-1]
+    elif message.video:
+        kind, media = 'video', message.video
+    elif message.document:
+        kind, media = 'document', message.document
+    else:
+        return None
+    return {'kind': kind, 'file_id': media.file_id, 'file_unique_id': media.file_unique_id}
+
+
+class AlbumCollector:
+    """Remembers the media groups admins send to the bot.
+
+    Telegram delivers an album as separate messages that share a
+    media_group_id, and a reply only points at one of them, so the items
+    are gathered here as they arrive.
+    """
+
+    def __init__(self, limit: int = MAX_PENDING_ALBUMS):
+        self.limit = limit
+        self._albums: "OrderedDict[str, Dict[int, Dict]]" = OrderedDict()
+
+    def add(self, message: Message):
+        item = media_from_message(message)
+        if item is None or message.media_group_id is None:
+            return
+        self._albums.setdefault(message.media_group_id, {})[message.message_id] = item
+        self._albums.move_to_end(message.media_group_id)
+        while len(self._albums) > self.limit:
+            self._albums.popitem(last=False)
+
+    def get(self, media_group_id: str) -> List[Dict]:
+        """Items of an album in the order they were sent"""
+        album = self._albums.get(media_group_id, {})
+        return [album[message_id] for message_id in sorted(album)]
+
+
+class MediaLibrary:
+    """Broadcast media by Telegram file_id, kept in the broadcast job store.
+
+    Anything the bot has received is already on Telegram's servers, so an
+    asset is sent to every recipient by file_id and is never uploaded again.
+    Assets get short ids (m1, m2, ...) that /broadcast --media reuses, and
+    the same file or album is only registered once.
+    """
+
+    def __init__(self, assets: Dict[str, Dict]):
+        self.assets = assets
+
+    def add(self, items: List[Dict]) -> Dict:
+        """Register a single file or an album, returning the existing asset if it is known"""
+        key = [item['file_unique_id'] for item in items]
+        for asset in self.assets.values():
+            if [item['file_unique_id'] for item in asset['items']] == key:
+                return asset
+        asset_id = f"m{max((int(existing[1:]) for existing in self.assets), default=0) + 1}"
+        asset = {
+            'id': asset_id,
+            'kind': 'album' if len(items) > 1 else items[0]['kind'],
+            'items': items,
+            'saved': datetime.now().isoformat()
+        }
+        self.assets[asset_id] = asset
+        return asset
+
+    def get(self, asset_id: str) -> Optional[Dict]:
+        return self.assets.get(asset_id)
+
+
+def describe_media(asset: Dict) -> str:
+    """Short label such as "photo (m3)" or "album of 4 (m5)"""
+    if asset['kind'] == 'album':
+        return f"album of {len(asset['items'])} ({asset['id']})"
+    return f"{asset['kind']} ({asset['id']})"
+
+
+def message_cost(asset: Optional[Dict]) -> int:
+    """How many messages one delivery counts as against Telegram's rate limit"""
+    return len(asset['items']) if asset else 1
+
+
+def media_sender(bot: Bot, asset: Dict, caption: Optional[str]) -> Callable[[int], Awaitable]:
+    """Build the per-recipient send function for an asset, captioned with Markdown text"""
+    items = asset['items']
+    if len(items) > 1:
+        def album_item(i: int, item: Dict):
+            # Telegram shows the first item's caption as the album's caption
+            return INPUT_MEDIA[item['kind']](media=item['file_id'], caption=caption if i == 0 else None,
+                                             parse_mode='Markdown')
+        media = [album_item(i, item) for i, item in enumerate(items)]
+        return lambda chat_id: bot.send_media_group(chat_id=chat_id, media=media)
+
+    item = items[0]
+    send = {'photo': bot.send_photo, 'video': bot.send_video, 'document': bot.send_document}[item['kind']]
+    return lambda chat_id: send(chat_id, item['file_id'], caption=caption, parse_mode='Markdown')
@@ -2,7 +2,9 @@ from functools import wraps
 from telegram import Update
 from telegram.ext import ContextTypes
 from bot_config import BotConfig
+from utils.metrics import get_metrics
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -34,4 +36,27 @@ def log_message(func):
         logger.info(f"Message from {username} (ID: {user_id}): {message_text}")
         return await func(update, context)
     
-    return wrapper
\ No newline at end of file
+    return wrapper
+
+def track_metrics(func):
+    """Decorator to count handler calls and time them for /metrics"""
+    metrics = get_metrics()
+    # Series are created once here, so a call only updates numbers already in place
+    succeeded = metrics.handler_calls.labels(func.__name__, "ok")
+    failed = metrics.handler_calls.labels(func.__name__, "error")
+    latency = metrics.handler_latency.labels(func.__name__)
+
+    @wraps(func)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        start = time.perf_counter()
+        try:
+            result = await func(update, context)
+        except Exception:
+            failed.inc()
+            raise
+        finally:
+            latency.observe(time.perf_counter() - start)
+        succeeded.inc()
+        return result
+    
+    return wrapper
@@ -0,0 +1,294 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import Counter, OrderedDict, deque
+from typing import Dict, Mapping, Optional
+
+from telegram import Update
+
+from bot_config import BotConfig
+from utils.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+# Update priorities: HIGH updates are ones a user is waiting on, LOW ones can wait or be dropped
+HIGH = "high"
+LOW = "low"
+
+# Admission outcomes
+ADMITTED = "admitted"
+SHED = "shed"
+DEFERRED = "deferred"
+REJECTED = "rejected"
+
+# Seconds a refused sender is told to wait before redelivering
+RETRY_AFTER = 1
+
+# user_data flags set by MessageHandler while it waits for a method or an amount as plain text
+CONVERSATION_FLAGS = ('topup_method_pending', 'topup_pending', 'withdraw_pending')
+
+
+def update_priority(update: Update, user_data: Optional[Mapping[int, Dict]] = None) -> str:
+    """HIGH for commands, button presses, payments, admins and conversation replies; LOW for the rest.
+
+    Plain text outside a top-up or withdrawal conversation is only echoed
+    and forwarded to the admins, so it is the first thing to go under load.
+    `user_data` is Application.user_data, used to tell an amount typed
+    during a top-up from chatter.
+    """
+    if update.callback_query or update.pre_checkout_query or update.shipping_query:
+        return HIGH
+    message = update.message
+    if message is None:
+        return LOW
+    if message.successful_payment:
+        return HIGH
+    user = update.effective_user
+    if user is not None and BotConfig.is_admin(user.id):
+        return HIGH
+    text = message.text or ''
+    if text.startswith('/'):
+        return HIGH
+    if text and user is not None and user_data:
+        state = user_data.get(user.id) or {}
+        if any(state.get(flag) for flag in CONVERSATION_FLAGS):
+            return HIGH
+    return LOW
+
+
+async def offer_update(application, update: Update) -> str:
+    """Hand an update to the Application, through admission control when its queue is an UpdateQueue"""
+    queue = application.update_queue
+    if isinstance(queue, UpdateQueue):
+        return queue.admit(update, update_priority(update, application.user_data))
+    await queue.put(update)
+    return ADMITTED
+
+
+class UpdateQueue(asyncio.Queue):
+    """The Application's update_queue with a fixed depth, admission control and wait-time tracking.
+
+    The webhook route offers each update with admit() instead of awaiting
+    put(): once the queue holds `shed_at` of its depth, LOW updates are
+    dropped ('drop') or refused so Telegram redelivers them later
+    ('defer'); a full queue refuses everything. HIGH updates therefore
+    keep the headroom above the shedding mark. When polling, the Updater
+    awaits put(), so a full queue simply pauses fetching.
+
+    The depth counts every update from put() until the Application calls
+    task_done() for it, i.e. until its handlers have finished. With
+    concurrent updates the Application takes updates off the queue as
+    soon as they arrive, so this is what keeps the work in progress
+    bounded. Every update's time in the queue is measured when the
+    Application takes it off; stats() reports recent percentiles.
+    """
+
+    def __init__(self, maxsize: int = 1000, shed_at: float = 0.8, shed_policy: str = "defer", window: int = 1024):
+        if maxsize <= 0:
+            raise ValueError("UpdateQueue needs a positive maxsize")
+        if shed_policy not in ("drop", "defer"):
+            raise ValueError(f"Unknown shed policy: {shed_policy}")
+        super().__init__(maxsize)
+        self.shed_depth = max(1, min(maxsize, int(maxsize * shed_at)))
+        self.shed_policy = shed_policy
+        self.peak_depth = 0
+        self.outcomes = Counter()
+        self.admitted_by_priority = Counter()
+        self.waits = deque(maxlen=window)
+        self.total_wait = 0.0
+        self.dequeued = 0
+        self._shedding = False
+        self._room = asyncio.Event()
+
+    @property
+    def pending(self) -> int:
+        """Updates put on the queue whose processing has not finished"""
+        return self._unfinished
+
+    def full(self) -> bool:
+        return self.pending >= self.maxsize
+
+    async def put(self, item):
+        """Wait until an earlier update has finished when the queue is full, then queue `item`"""
+        while self.full():
+            self._room.clear()
+            await self._room.wait()
+        self.put_nowait(item)
+
+    def task_done(self):
+        super().task_done()
+        self._unfinished -= 1
+        self._room.set()
+
+    def _init(self, maxsize):
+        super()._init(maxsize)
+        self._enqueued_at = deque()
+        self._unfinished = 0
+
+    def _put(self, item):
+        super()._put(item)
+        self._enqueued_at.append(time.monotonic())
+        self._unfinished += 1
+        if self._unfinished > self.peak_depth:
+            self.peak_depth = self._unfinished
+
+    def _get(self):
+        waited = time.monotonic() - self._enqueued_at.popleft()
+        self.waits.append(waited)
+        self.total_wait += waited
+        get_metrics().update_queue_wait.observe(waited)
+        self.dequeued += 1
+        return super()._get()
+
+    def admit(self, update: Update, priority: str = HIGH) -> str:
+        """Queue the update if there is room for its priority; returns the admission outcome"""
+        depth = self.pending
+        if depth >= self.maxsize:
+            outcome = REJECTED
+        elif priority == LOW and depth >= self.shed_depth:
+            outcome = SHED if self.shed_policy == "drop" else DEFERRED
+        else:
+            self.put_nowait(update)
+            self.admitted_by_priority[priority] += 1
+            outcome = ADMITTED
+        self.outcomes[outcome] += 1
+
+        # Logged once per overload episode: the episode ends when the queue has drained to half the mark
+        if not self._shedding and depth >= self.shed_depth:
+            self._shedding = True
+            logger.warning(f"Update queue at {depth}/{self.maxsize}, shedding low-priority updates")
+        elif self._shedding and depth < self.shed_depth // 2:
+            self._shedding = False
+            logger.info(f"Update queue back to {depth}/{self.maxsize}, admitting all updates")
+        return outcome
+
+    def stats(self) -> Dict:
+        waits = sorted(self.waits)
+
+        def percentile(fraction: float) -> float:
+            if not waits:
+                return 0.0
+            return round(waits[min(len(waits) - 1, int(len(waits) * fraction))] * 1000, 2)
+
+        return {
+            'depth': self.pending,
+            'queued': self.qsize(),
+            'capacity': self.maxsize,
+            'shed_depth': self.shed_depth,
+            'peak_depth': self.peak_depth,
+            'admitted': self.outcomes[ADMITTED],
+            'admitted_high': self.admitted_by_priority[HIGH],
+            'admitted_low': self.admitted_by_priority[LOW],
+            'shed': self.outcomes[SHED],
+            'deferred': self.outcomes[DEFERRED],
+            'rejected': self.outcomes[REJECTED],
+            'dequeued': self.dequeued,
+            'wait_avg_ms': round(self.total_wait / self.dequeued * 1000, 2) if self.dequeued else 0.0,
+            'wait_p50_ms': percentile(0.5),
+            'wait_p99_ms': percentile(0.99),
+            'wait_max_ms': round(waits[-1] * 1000, 2) if waits else 0.0,
+        }
+
+
+class UpdateDeduplicator:
+    """Recognises Telegram's redeliveries of a webhook update by update_id, in bounded memory.
+
+    Telegram redelivers an update it got no timely 2xx for, even when the
+    first delivery was queued, so slow answers would make the handlers run
+    twice. The webhook route claims each update_id before parsing the
+    update, then finishes it: a refused update is forgotten again, since
+    Telegram should send that one again. The last `window` claimed ids
+    are remembered.
+
+    The highest remembered id is saved to `state_file` after every
+    `checkpoint_every` queued updates and on shutdown; after a restart,
+    ids up to `window` below it count as already seen. Telegram starts
+    again from a random update_id after a week without updates, so ids
+    further below the saved mark are accepted.
+    """
+
+    def __init__(self, window: int = 10000, state_file: Optional[str] = None, checkpoint_every: int = 100):
+        if window <= 0:
+            raise ValueError("UpdateDeduplicator needs a positive window")
+        self.window = window
+        self.state_file = state_file
+        self.checkpoint_every = checkpoint_every
+        self.checked = 0
+        self.duplicates = 0
+        self._recent: OrderedDict = OrderedDict()
+        self._restored = self._load()
+        self._unsaved = 0
+
+    def _load(self) -> Optional[int]:
+        if not self.state_file or not os.path.exists(self.state_file):
+            return None
+        try:
+            with open(self.state_file) as f:
+                return int(json.load(f)['high_water'])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Ignoring unreadable {self.state_file}: {e}")
+            return None
+
+    @property
+    def high_water(self) -> Optional[int]:
+        """The highest update_id still counted as seen"""
+        return max(self._recent) if self._recent else self._restored
+
+    def save(self):
+        """Persist the highest remembered update_id; refused updates are not remembered, so not counted"""
+        high_water = self.high_water
+        self._unsaved = 0
+        if not self.state_file or high_water is None:
+            return
+        tmp_file = f"{self.state_file}.tmp"
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump({'high_water': high_water}, f)
+            os.replace(tmp_file, self.state_file)
+        except OSError as e:
+            logger.error(f"Could not save {self.state_file}: {e}")
+
+    def claim(self, update_id) -> bool:
+        """Record an update_id about to be queued; False when it is a duplicate and must be dropped"""
+        if not isinstance(update_id, int):
+            return True
+        self.checked += 1
+        restored = self._restored
+        if update_id in self._recent or (restored is not None and restored - self.window < update_id <= restored):
+            self.duplicates += 1
+            return False
+        self._recent[update_id] = None
+        if len(self._recent) > self.window:
+            self._recent.popitem(last=False)
+        return True
+
+    def finish(self, update_id, queued: bool):
+        """Settle a claimed update_id; a refused update is forgotten, so its redelivery is accepted"""
+        if not queued:
+            self._recent.pop(update_id, None)
+            return
+        self._unsaved += 1
+        if self._unsaved >= self.checkpoint_every:
+            self.save()
+
+    def stats(self) -> Dict:
+        return {
+            'checked': self.checked,
+            'duplicates': self.duplicates,
+            'remembered': len(self._recent),
+            'window': self.window,
+            'high_water': self.high_water,
+        }
+
+
+_update_deduplicator: Optional[UpdateDeduplicator] = None
+
+
+def get_update_deduplicator() -> UpdateDeduplicator:
+    """Return the process-wide webhook update de-duplicator"""
+    global _update_deduplicator
+    if _update_deduplicator is None:
+        _update_deduplicator = UpdateDeduplicator(BotConfig.UPDATE_DEDUP_WINDOW, BotConfig.UPDATE_DEDUP_FILE or None)
+    return _update_deduplicator
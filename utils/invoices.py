@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Optional, Tuple
+
+from bot_config import BotConfig
+from utils.xendit_api import XenditClient, get_xendit_client, new_external_id
+
+logger = logging.getLogger(__name__)
+
+# An open invoice is not handed out again this close to its expiry
+EXPIRY_MARGIN = 60.0
+
+InvoiceKey = Tuple[int, float, str]
+
+
+class InvoiceRegistry:
+    """Open Xendit invoices by (user, amount, payment method).
+
+    A user who taps Top Up again for the same amount gets the invoice that
+    is already waiting for payment, without another API call; concurrent
+    taps share a single create call. Every new invoice gets a fresh
+    external_id from new_external_id(). Entries leave the registry when
+    their invoice is paid or expires (a callback for it arrives), or when
+    their TTL runs out; sweep() drops the expired ones and runs from a
+    repeating job.
+    """
+
+    def __init__(self, client: Optional[XenditClient] = None, ttl: float = 3600.0):
+        self.client = client
+        self.ttl = ttl
+        self._open: Dict[InvoiceKey, Dict] = {}
+        self._by_external_id: Dict[str, InvoiceKey] = {}
+        self._pending: Dict[InvoiceKey, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._open)
+
+    @staticmethod
+    def key(user_id: int, amount, method: str) -> InvoiceKey:
+        return user_id, float(amount), method
+
+    def get(self, user_id: int, amount, method: str) -> Optional[Dict]:
+        """The open invoice for this user, amount and method, or None"""
+        entry = self._open.get(self.key(user_id, amount, method))
+        if entry is None or entry['expires'] - EXPIRY_MARGIN <= time.time():
+            return None
+        return entry['invoice']
+
+    async def open_invoice(self, user_id: int, amount, method: str) -> Dict:
+        """Return the open invoice for this user, amount and method, creating it when there is none.
+
+        The result is the Xendit invoice (or error) dict; a reused invoice
+        carries 'reused': True. Errors are returned but never remembered.
+        """
+        key = self.key(user_id, amount, method)
+        invoice = self.get(*key)
+        if invoice is not None:
+            self.hits += 1
+            return dict(invoice, reused=True)
+        pending = self._pending.get(key)
+        if pending is not None:
+            self.hits += 1
+            invoice = await asyncio.shield(pending)
+            return dict(invoice, reused=True) if not invoice.get('error') else invoice
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            client = self.client or get_xendit_client()
+            external_id = new_external_id('telegram', user_id)
+            invoice = await client.create_invoice(amount, user_id, external_id=external_id,
+                                                  duration=int(self.ttl))
+            if not invoice.get('error'):
+                self._remember(key, invoice)
+            future.set_result(invoice)
+            return invoice
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # retrieved, so an unshared failure is not logged as unhandled
+            raise
+        finally:
+            del self._pending[key]
+
+    def _remember(self, key: InvoiceKey, invoice: Dict):
+        self.discard_key(key)
+        self._open[key] = {'invoice': invoice, 'expires': time.time() + self.ttl}
+        self._by_external_id[invoice.get('external_id')] = key
+
+    def discard_key(self, key: InvoiceKey):
+        entry = self._open.pop(key, None)
+        if entry is not None:
+            self._by_external_id.pop(entry['invoice'].get('external_id'), None)
+
+    def discard(self, external_id: str) -> bool:
+        """Forget the invoice with this external_id (it was paid or expired); False if it was not open"""
+        key = self._by_external_id.get(external_id)
+        if key is None:
+            return False
+        self.discard_key(key)
+        return True
+
+    def sweep(self, now: Optional[float] = None) -> int:
+        """Drop every invoice past its TTL, returning how many were dropped"""
+        now = time.time() if now is None else now
+        expired = [key for key, entry in self._open.items() if entry['expires'] <= now]
+        for key in expired:
+            self.discard_key(key)
+        return len(expired)
+
+    def stats(self) -> Dict:
+        return {'open': len(self._open), 'hits': self.hits, 'misses': self.misses}
+
+
+_shared_registry: Optional[InvoiceRegistry] = None
+
+def get_invoice_registry() -> InvoiceRegistry:
+    """Return the process-wide invoice registry shared by the top-up handlers"""
+    global _shared_registry
+    if _shared_registry is None:
+        _shared_registry = InvoiceRegistry(ttl=BotConfig.INVOICE_TTL)
+    return _shared_registry
+
+
+async def sweep_expired_invoices(context):
+    """JobQueue callback: drop expired invoices from the registry"""
+    dropped = get_invoice_registry().sweep()
+    if dropped:
+        logger.info(f"Swept {dropped} expired invoices from the registry")
@@ -0,0 +1,238 @@
+"""
+Prometheus metrics for the bot, served as text by GET /metrics on the webhook server.
+
+Recording is cheap enough for every update: a counter is one number and a
+histogram a list of bucket counts, both allocated when the series is first
+used (handler series when the handler is decorated), and updated in place
+from the event loop without locks. Figures other components already keep,
+such as the update queue depth or the Xendit calls in flight, are read
+when the endpoint is scraped. The text format is written here directly,
+so no Prometheus client library is needed.
+"""
+
+import time
+from bisect import bisect_left
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from telegram.request import HTTPXRequest
+
+# Seconds; shared by handlers, database flushes and outbound API calls
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class CounterSeries:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class HistogramSeries:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        # One slot per bucket plus +Inf; made cumulative only when rendered
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Counter:
+    """A monotonically increasing count, optionally split by labels"""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.series: Dict[Tuple, CounterSeries] = {}
+
+    def labels(self, *values) -> CounterSeries:
+        series = self.series.get(values)
+        if series is None:
+            series = self.series[values] = CounterSeries()
+        return series
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, values)} {_format_value(series.value)}"
+                for values, series in self.series.items()]
+
+
+class Histogram:
+    """Observations counted into fixed buckets, optionally split by labels"""
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.series: Dict[Tuple, HistogramSeries] = {}
+
+    def labels(self, *values) -> HistogramSeries:
+        series = self.series.get(values)
+        if series is None:
+            series = self.series[values] = HistogramSeries(self.buckets)
+        return series
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for values, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series.counts):
+                cumulative += count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, values, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, values)} {_format_value(series.sum)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, values)} {series.count}")
+        return lines
+
+
+def _family(name: str, kind: str, documentation: str, samples: List[str]) -> List[str]:
+    return [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"] + samples
+
+
+def _gauge(name: str, documentation: str, value: float) -> List[str]:
+    return _family(name, "gauge", documentation, [f"{name} {_format_value(value)}"])
+
+
+def _counter(name: str, documentation: str, value: float) -> List[str]:
+    return _family(name, "counter", documentation, [f"{name} {_format_value(value)}"])
+
+
+class BotMetrics:
+    """The bot's metrics; get_metrics() returns the process-wide instance"""
+
+    def __init__(self):
+        self.handler_calls = Counter("bot_handler_calls_total", "Handler invocations by outcome",
+                                     ("handler", "outcome"))
+        self.handler_latency = Histogram("bot_handler_duration_seconds", "Time spent in each handler",
+                                         ("handler",))
+        self.db_flush_latency = Histogram("bot_db_flush_duration_seconds",
+                                          "Time to write one batch of database changes")
+        self.db_flush_bytes = Counter("bot_db_flush_bytes_total", "Bytes written to the database journal")
+        self.db_flush_records = Counter("bot_db_flush_records_total", "Database changes written")
+        self.db_snapshot_latency = Histogram("bot_db_snapshot_duration_seconds",
+                                             "Time to write a full database snapshot")
+        self.update_queue_wait = Histogram("bot_update_queue_wait_seconds",
+                                           "Time updates wait in the update queue before a handler takes them")
+        self.xendit_latency = Histogram("bot_xendit_request_duration_seconds",
+                                        "Xendit API attempts by endpoint and HTTP status", ("endpoint", "status"))
+        self.telegram_requests = Counter("bot_telegram_requests_total",
+                                         "Bot API requests by method and HTTP status (429 is flood control)",
+                                         ("method", "status"))
+        self.telegram_latency = Histogram("bot_telegram_request_duration_seconds", "Bot API request time by method",
+                                          ("method",))
+        self.metrics = [self.handler_calls, self.handler_latency, self.db_flush_latency, self.db_flush_bytes,
+                        self.db_flush_records, self.db_snapshot_latency, self.update_queue_wait, self.xendit_latency,
+                        self.telegram_requests, self.telegram_latency]
+
+    def render(self, application=None) -> str:
+        """Every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in self.metrics:
+            lines += _family(metric.name, metric.type, metric.documentation, metric.samples())
+        lines += self._runtime(application)
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _runtime(application) -> List[str]:
+        # Imported here: these modules record into get_metrics() themselves
+        from utils.ingestion import UpdateQueue, get_update_deduplicator
+        from utils.update_processor import PerUserUpdateProcessor
+        from utils.xendit_api import get_xendit_client
+
+        lines = []
+        dedup = get_update_deduplicator().stats()
+        lines += _counter("bot_updates_checked_total", "Webhook updates checked for redelivery", dedup['checked'])
+        lines += _counter("bot_updates_duplicate_total", "Webhook redeliveries dropped", dedup['duplicates'])
+        if application is None:
+            return lines
+
+        queue = application.update_queue
+        if isinstance(queue, UpdateQueue):
+            stats = queue.stats()
+            lines += _gauge("bot_update_queue_depth", "Updates queued or being handled", stats['depth'])
+            lines += _gauge("bot_update_queue_capacity", "Update queue capacity", stats['capacity'])
+            lines += _family("bot_update_queue_admissions_total", "counter", "Webhook updates by admission outcome",
+                             [f'bot_update_queue_admissions_total{{outcome="{outcome}"}} {stats[outcome]}'
+                              for outcome in ('admitted', 'shed', 'deferred', 'rejected')])
+        processor = application.update_processor
+        if isinstance(processor, PerUserUpdateProcessor):
+            stats = processor.stats()
+            lines += _gauge("bot_handlers_running", "Updates being handled", stats['running'])
+            lines += _gauge("bot_handlers_waiting", "Updates waiting for a slot or an earlier update from the same user",
+                            stats['held'] - stats['running'])
+        db = application.bot_data.get('db')
+        if db is not None:
+            lines += _gauge("bot_db_pending_records", "Database changes not yet written",
+                            db.get_flush_stats()['pending'])
+        xendit = get_xendit_client().stats()
+        lines += _gauge("bot_xendit_in_flight", "Xendit calls in progress", xendit['in_flight'])
+        lines += _gauge("bot_xendit_circuit_open", "1 while the Xendit circuit breaker is failing calls fast",
+                        int(xendit['breaker']['state'] == 'open'))
+        return lines
+
+
+class MeteredRequest(HTTPXRequest):
+    """The Bot API transport, counting every request by method and status and timing it"""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        metrics = get_metrics()
+        api_method = url.rsplit('/', 1)[-1]
+        start = time.perf_counter()
+        try:
+            status, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            metrics.telegram_requests.labels(api_method, "error").inc()
+            raise
+        finally:
+            metrics.telegram_latency.labels(api_method).observe(time.perf_counter() - start)
+        metrics.telegram_requests.labels(api_method, str(status)).inc()
+        return status, payload
+
+
+_metrics: Optional[BotMetrics] = None
+
+
+def get_metrics() -> BotMetrics:
+    """Return the process-wide metrics"""
+    global _metrics
+    if _metrics is None:
+        _metrics = BotMetrics()
+    return _metrics
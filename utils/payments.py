@@ -0,0 +1,109 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional, Set, Tuple
+
+from telegram import Bot
+
+from bot_config import BotConfig
+
+logger = logging.getLogger(__name__)
+
+# Invoice statuses that mean the money arrived
+PAID_STATUSES = ('PAID', 'SETTLED')
+
+# Results of handling one callback, returned to Xendit in the response body
+SETTLED = "settled"
+DUPLICATE = "duplicate"
+IGNORED = "ignored"
+UNKNOWN_USER = "unknown_user"
+
+
+def deposit_fee(amount: float) -> Tuple[int, float]:
+    """The fee kept from a top-up and the net amount credited to the wallet"""
+    fee = int(amount * BotConfig.FEE_PERCENT)
+    return fee, amount - fee
+
+
+def created_before_retention(payload: Dict) -> bool:
+    """Whether an invoice was created before the oldest settled invoice id the database still remembers"""
+    try:
+        created = datetime.fromisoformat(payload['created'])
+    except (KeyError, TypeError, ValueError):
+        return False
+    if created.tzinfo is None:
+        created = created.replace(tzinfo=timezone.utc)
+    return created < datetime.now(timezone.utc) - timedelta(days=BotConfig.SETTLED_INVOICE_RETENTION_DAYS)
+
+
+def user_id_from_external_id(external_id: str) -> Optional[int]:
+    """Telegram user id encoded in an invoice external_id (telegram_<user_id>_...), or None"""
+    parts = (external_id or "").split('_')
+    if len(parts) >= 2 and parts[0] == 'telegram' and parts[1].isdigit():
+        return int(parts[1])
+    return None
+
+
+class InvoiceSettler:
+    """Credits wallets from Xendit invoice callbacks.
+
+    Each invoice is credited at most once: the database marks the invoice
+    id settled in the same write that changes the balance, so a callback
+    Xendit retries or delivers twice is acknowledged without paying out
+    again. Settled ids are only remembered for
+    SETTLED_INVOICE_RETENTION_DAYS, so a callback for an older invoice is
+    not credited. The callback is answered once the credit is on disk; the user
+    is notified from a background task. A paid or expired invoice is
+    dropped from the invoice registry so it is never handed out again.
+    """
+
+    def __init__(self, db, bot: Bot, invoices=None):
+        self.db = db
+        self.bot = bot
+        self.invoices = invoices
+        self._notifications: Set[asyncio.Task] = set()
+
+    async def handle_invoice(self, payload: Dict) -> str:
+        """Settle one invoice callback payload, returning what was done with it"""
+        invoice_id = payload['id']
+        if self.invoices is not None:
+            self.invoices.discard(payload.get('external_id'))
+        if payload.get('status') not in PAID_STATUSES:
+            logger.info(f"Invoice {invoice_id} callback with status {payload.get('status')}, nothing to settle")
+            return IGNORED
+        user_id = user_id_from_external_id(payload.get('external_id'))
+        if user_id is None:
+            logger.error(f"Invoice {invoice_id} has an external_id not issued by the bot: {payload.get('external_id')}")
+            return IGNORED
+        if created_before_retention(payload):
+            logger.error(f"Invoice {invoice_id} was created {payload['created']}, too long ago to tell whether "
+                         f"it was settled; not crediting it")
+            return IGNORED
+
+        amount = float(payload.get('paid_amount') or payload['amount'])
+        fee, net_amount = deposit_fee(amount)
+        description = f"Xendit invoice {invoice_id}: paid {amount:g}, fee {fee}"
+        if not await self.db.run(self.db.settle_invoice, invoice_id, user_id, net_amount, description):
+            if await self.db.run(self.db.get_user, user_id) is None:
+                logger.error(f"Invoice {invoice_id} paid for unknown user {user_id}")
+                return UNKNOWN_USER
+            logger.info(f"Invoice {invoice_id} was already settled")
+            return DUPLICATE
+        await self.db.commit()
+        logger.info(f"Invoice {invoice_id} settled: {net_amount:g} credited to user {user_id}")
+
+        task = asyncio.create_task(self._notify(user_id, amount, fee, net_amount))
+        self._notifications.add(task)
+        task.add_done_callback(self._notifications.discard)
+        return SETTLED
+
+    async def _notify(self, user_id: int, amount: float, fee: int, net_amount: float):
+        try:
+            balance = await self.db.run(self.db.get_wallet_balance, user_id)
+            await self.bot.send_message(
+                chat_id=user_id,
+                text=(f"✅ Payment received! {amount:g}P paid, {fee}P fee deducted, "
+                      f"{net_amount:g}P added to your wallet.\n💰 New balance: {balance:.2f}P")
+            )
+        except Exception as e:
+            logger.warning(f"Could not notify user {user_id} about a settled payment: {e}")
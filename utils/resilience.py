@@ -0,0 +1,117 @@
+import random
+import time
+import logging
+from collections import deque
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def backoff_delay(attempt: int, base: float = 0.25, cap: float = 4.0) -> float:
+    """Full-jitter exponential backoff: a random wait up to base * 2^(attempt-1), capped"""
+    return random.uniform(0, min(cap, base * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """Stops calling a dependency while most recent calls to it fail.
+
+    Outcomes of the last `window` calls are kept. Once at least
+    `min_calls` of them are in and the failure rate reaches `threshold`,
+    the breaker opens and allow() refuses every call for `cooldown`
+    seconds, so callers fail fast instead of waiting on a dependency that
+    is down. After the cooldown one probe call is let through (half open):
+    success closes the breaker, failure opens it for another cooldown. A
+    probe that ends without either (it was cancelled and abandon() was
+    called, or it is still out after another cooldown) lets the next call
+    probe instead.
+    """
+
+    def __init__(self, name: str, threshold: float = 0.5, window: int = 20, min_calls: int = 5,
+                 cooldown: float = 30.0):
+        self.name = name
+        self.threshold = threshold
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.opened = 0
+        self.rejected = 0
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probing = False
+        self._probe_started = 0.0
+
+    @property
+    def failure_rate(self) -> float:
+        return self._outcomes.count(False) / len(self._outcomes) if self._outcomes else 0.0
+
+    @property
+    def retry_in(self) -> float:
+        """Seconds until an open breaker lets a probe through"""
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self._opened_at + self.cooldown - time.monotonic())
+
+    @property
+    def rejecting(self) -> bool:
+        """True while the breaker is open and its cooldown has not run out"""
+        return self.state == OPEN and self.retry_in > 0
+
+    def allow(self) -> bool:
+        """Whether a call may go ahead now; every allowed call must be followed by a record_*() call"""
+        if self.state == OPEN:
+            if self.retry_in > 0:
+                self.rejected += 1
+                return False
+            self.state = HALF_OPEN
+            self._probing = False
+            logger.info(f"Circuit {self.name} half open, probing")
+        if self.state == HALF_OPEN:
+            if self._probing and time.monotonic() - self._probe_started < self.cooldown:
+                self.rejected += 1
+                return False
+            self._probing = True
+            self._probe_started = time.monotonic()
+        return True
+
+    def abandon(self):
+        """End an allowed call that produced no outcome, such as a cancelled one"""
+        if self.state == HALF_OPEN:
+            self._probing = False
+
+    def record_success(self):
+        if self.state == HALF_OPEN:
+            self.state = CLOSED
+            self._probing = False
+            self._outcomes.clear()
+            logger.info(f"Circuit {self.name} closed")
+        self._outcomes.append(True)
+
+    def record_failure(self):
+        self._outcomes.append(False)
+        if self.state == HALF_OPEN:
+            self._open()
+        elif (self.state == CLOSED and len(self._outcomes) >= self.min_calls
+              and self.failure_rate >= self.threshold):
+            self._open()
+
+    def _open(self):
+        self.state = OPEN
+        self.opened += 1
+        self._probing = False
+        self._opened_at = time.monotonic()
+        logger.warning(f"Circuit {self.name} open for {self.cooldown:.0f}s "
+                       f"(failure rate {self.failure_rate:.0%} over {len(self._outcomes)} calls)")
+
+    def stats(self) -> Dict:
+        return {
+            'state': self.state,
+            'failure_rate': round(self.failure_rate, 2),
+            'calls': len(self._outcomes),
+            'opened': self.opened,
+            'rejected': self.rejected,
+            'retry_in_s': round(self.retry_in, 1)
+        }
@@ -0,0 +1,509 @@
+#!/usr/bin/env python3
+"""
+Multi-process mode: a front dispatcher and SHARDS worker processes.
+
+Each worker is `python main.py` with SHARD_INDEX set: a complete bot that
+owns the users with user_id % SHARDS == SHARD_INDEX, keeps them in its own
+data files (users.shard0.json, ...) and listens on a Unix socket in
+SHARD_SOCKET_DIR. The dispatcher serves the webhook and hands every
+Telegram update and Xendit callback to the worker owning its user, so a
+user's updates are always handled by the same process. Database calls
+about another shard's user, and the admin queries that span every user
+(totals, user lists, broadcast recipients), are answered by the owning
+workers; see ShardedDatabase.
+
+    SHARDS=4 WEBHOOK_URL=https://example.com/telegram/webhook python -m utils.sharding
+
+Existing single-process data can be split with `python -m storage.split_shards`.
+"""
+
+import asyncio
+import itertools
+import json
+import logging
+import os
+import signal
+import struct
+import sys
+from collections import Counter
+from collections.abc import Mapping
+from typing import Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telegram import Bot, Update  # noqa: E402
+from telegram.ext import Application  # noqa: E402
+
+from bot_config import BotConfig  # noqa: E402
+from storage.audience import Audience  # noqa: E402
+from utils.ingestion import REJECTED, UpdateDeduplicator, get_update_deduplicator, offer_update  # noqa: E402
+from utils.payments import user_id_from_external_id  # noqa: E402
+from utils.webhook import Request, Response, WebhookApp, _webhook_server, token_matches  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "main.py")
+
+# Broadcast cursors are a shard's own cursor (a JSON row position, or a SQLite user id of up
+# to 52 bits) with the shard number above it
+CURSOR_STRIDE = 1 << 64
+
+# Database methods about one user, and the position of the user_id among their arguments
+USER_METHODS = {
+    'add_user': 0, 'get_user': 0, 'update_wallet_balance': 0, 'settle_invoice': 1, 'get_wallet_balance': 0,
+    'get_wallet_transactions': 0, 'get_wallet_history_page': 0,
+}
+# Wallet changes the owning shard makes durable before answering, like the handlers do locally
+WALLET_WRITES = frozenset({'update_wallet_balance', 'settle_invoice'})
+
+
+def _sum_counts(results: List[Dict]) -> Dict:
+    total = Counter()
+    for result in results:
+        total.update(result)
+    return dict(total)
+
+
+def _concat(results: List[List]) -> List:
+    return [item for result in results for item in result]
+
+
+def _merge_wallet_stats(results: List[Dict]) -> Dict:
+    merged = {key: sum(result[key] for result in results) for key in results[0] if key != 'histogram'}
+    merged['histogram'] = [(label, sum(result['histogram'][i][1] for result in results))
+                           for i, (label, _) in enumerate(results[0]['histogram'])]
+    return merged
+
+
+# Database methods answered by every shard, and how their answers are combined
+GATHERED = {
+    'get_total_users': sum,
+    'get_total_wallet_balance': sum,
+    'count_audience': sum,
+    'get_reachability_stats': _sum_counts,
+    'get_all_users': _concat,
+    'get_user_ids': _concat,
+    'get_stale_unreachable': _concat,
+    'get_wallet_stats': _merge_wallet_stats,
+    'verify_aggregates': all,
+}
+# Everything a shard answers for the others
+SHARD_METHODS = set(USER_METHODS) | set(GATHERED) | {'get_user_id_page', 'set_reachability'}
+
+
+class ShardUnavailable(Exception):
+    """Another shard could not be reached or did not answer in time"""
+
+
+class ShardError(Exception):
+    """Another shard raised while handling a call"""
+
+
+def shard_for(user_id: int, shards: int) -> int:
+    """The shard that owns a user; fixed for a given number of shards"""
+    return user_id % shards
+
+
+def shard_socket(socket_dir: str, shard: int) -> str:
+    return os.path.join(socket_dir, f"shard{shard}.sock")
+
+
+def update_owner(data: Dict) -> Optional[int]:
+    """The user (or, failing that, chat) a raw update belongs to, read without parsing the update"""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        for field in ('from', 'user', 'chat'):
+            owner = value.get(field)
+            if isinstance(owner, dict) and isinstance(owner.get('id'), int):
+                return owner['id']
+    return None
+
+
+def _encode(value):
+    if isinstance(value, Audience):
+        return {'__audience__': value.as_dict()}
+    if isinstance(value, Mapping):
+        return dict(value)
+    raise TypeError(f"{type(value).__name__} cannot be sent to another shard")
+
+
+def _decode(data: Dict):
+    if '__audience__' in data:
+        return Audience.from_dict(data['__audience__'])
+    return data
+
+
+def write_frame(writer: asyncio.StreamWriter, message: Dict):
+    body = json.dumps(message, default=_encode).encode()
+    writer.write(struct.pack('>I', len(body)) + body)
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Dict:
+    size, = struct.unpack('>I', await reader.readexactly(4))
+    return json.loads(await reader.readexactly(size), object_hook=_decode)
+
+
+class ShardClient:
+    """One connection to a worker's shard socket; concurrent calls share it and are matched by id"""
+
+    def __init__(self, path: str, timeout: float = 10.0):
+        self.path = path
+        self.timeout = timeout
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.count(1)
+        self._connecting: Optional[asyncio.Lock] = None
+        self._reading: Optional[asyncio.Task] = None
+
+    async def _connect(self):
+        if self._connecting is None:
+            self._connecting = asyncio.Lock()
+        async with self._connecting:
+            if self._writer is not None:
+                return
+            try:
+                self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+            except OSError as e:
+                raise ShardUnavailable(f"{self.path}: {e}") from e
+            self._reading = asyncio.create_task(self._read_responses(self._reader))
+
+    async def _read_responses(self, reader: asyncio.StreamReader):
+        try:
+            while True:
+                response = await read_frame(reader)
+                future = self._pending.pop(response['id'], None)
+                if future is None or future.done():
+                    continue
+                if 'error' in response:
+                    future.set_exception(ShardError(response['error']))
+                else:
+                    future.set_result(response.get('result'))
+        except (asyncio.IncompleteReadError, OSError, ValueError) as e:
+            logger.warning(f"Lost connection to {self.path}: {e!r}")
+        finally:
+            self._writer, self._reading = None, None
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ShardUnavailable(f"{self.path}: connection lost"))
+            self._pending.clear()
+
+    async def call(self, op: str, **fields):
+        """Send one request and wait for its result"""
+        if self._writer is None:
+            await self._connect()
+        request_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[request_id] = future
+        try:
+            write_frame(self._writer, dict(fields, id=request_id, op=op))
+            await self._writer.drain()
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            raise ShardUnavailable(f"{self.path}: no answer to {op} within {self.timeout:g}s") from None
+        except (OSError, AttributeError) as e:
+            raise ShardUnavailable(f"{self.path}: {e}") from e
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._reading is not None:
+            await asyncio.gather(self._reading, return_exceptions=True)
+
+
+class ShardedDatabase:
+    """A worker's own user store, with calls about other shards' users answered by their owners.
+
+    Handlers keep calling `await db.run(db.method, ...)`: calls about one
+    user go to the shard that owns that user, totals and user lists are
+    gathered from every shard at once and combined, and everything else
+    (commit(), flush stats, ...) is this worker's own store. Broadcast
+    recipients are paged through shard after shard; the shard number is
+    folded into the cursor, so a checkpointed broadcast resumes in the
+    right shard.
+    """
+
+    def __init__(self, local, shard: int, shards: int, socket_dir: str, timeout: float = 10.0):
+        self.local = local
+        self.shard = shard
+        self.shards = shards
+        self.clients = {other: ShardClient(shard_socket(socket_dir, other), timeout)
+                        for other in range(shards) if other != shard}
+
+    def __getattr__(self, name):
+        return getattr(self.local, name)
+
+    async def stop(self):
+        await asyncio.gather(*(client.close() for client in self.clients.values()))
+        await self.local.stop()
+
+    async def call_shard(self, shard: int, method: str, *args, **kwargs):
+        if shard == self.shard:
+            return await self.local.run(getattr(self.local, method), *args, **kwargs)
+        return await self.clients[shard].call('db', method=method, args=list(args), kwargs=kwargs)
+
+    async def run(self, func, *args, **kwargs):
+        method = getattr(func, '__name__', None)
+        if method in USER_METHODS:
+            position = USER_METHODS[method]
+            user_id = args[position] if len(args) > position else kwargs['user_id']
+            return await self.call_shard(shard_for(user_id, self.shards), method, *args, **kwargs)
+        if method in GATHERED:
+            results = await asyncio.gather(*(self.call_shard(shard, method, *args, **kwargs)
+                                             for shard in range(self.shards)))
+            return GATHERED[method](results)
+        if method == 'get_user_id_page':
+            return await self._user_id_page(*args, **kwargs)
+        if method == 'set_reachability':
+            return await self._set_reachability(*args, **kwargs)
+        return await self.local.run(func, *args, **kwargs)
+
+    async def _user_id_page(self, after: int = 0, limit: int = 1000, reachable_only: bool = False,
+                            audience: Optional[Audience] = None):
+        shard, position = divmod(after, CURSOR_STRIDE)
+        while shard < self.shards:
+            page = await self.call_shard(shard, 'get_user_id_page', position, limit, reachable_only, audience)
+            if page:
+                return [(shard * CURSOR_STRIDE + cursor, user_id) for cursor, user_id in page]
+            shard, position = shard + 1, 0
+        return []
+
+    async def _set_reachability(self, updates):
+        by_shard: Dict[int, List] = {}
+        for item in updates:
+            by_shard.setdefault(shard_for(item[0], self.shards), []).append(item)
+        await asyncio.gather(*(self.call_shard(shard, 'set_reachability', items)
+                               for shard, items in by_shard.items()))
+
+
+class ShardServer:
+    """Answers the dispatcher and the other workers on this worker's socket.
+
+    Requests are `update` (offered to the update queue, answered with the
+    admission outcome), `callback` (a Xendit invoice callback for the
+    settler), `db` (a database call for one of this shard's users, or
+    this shard's part of a gathered query) and `ping`.
+    """
+
+    def __init__(self, application: Application, shard: int, path: str):
+        self.application = application
+        self.shard = shard
+        self.path = path
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections = set()
+        self._tasks = set()
+
+    async def start(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = await asyncio.start_unix_server(self._serve, self.path)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        for writer in list(self._connections):
+            writer.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._connections.add(writer)
+        try:
+            while True:
+                request = await read_frame(reader)
+                # Answered as they finish, so one slow call does not hold up the connection
+                task = asyncio.create_task(self._answer(request, writer))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        except (asyncio.IncompleteReadError, OSError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    async def _answer(self, request: Dict, writer: asyncio.StreamWriter):
+        try:
+            response = {'id': request['id'], 'result': await self.handle(request)}
+        except Exception as e:
+            logger.error(f"Shard {self.shard} failed {request.get('op')} {request.get('method', '')}: {e}")
+            response = {'id': request['id'], 'error': f"{type(e).__name__}: {e}"}
+        try:
+            write_frame(writer, response)
+            await writer.drain()
+        except OSError:
+            pass
+
+    async def handle(self, request: Dict):
+        op = request['op']
+        if op == 'update':
+            update = Update.de_json(request['update'], self.application.bot)
+            return await offer_update(self.application, update)
+        if op == 'callback':
+            return await self.application.bot_data['payments'].handle_invoice(request['payload'])
+        if op == 'db':
+            method = request['method']
+            if method not in SHARD_METHODS:
+                raise ValueError(f"{method} is not available to other shards")
+            db = self.application.bot_data['db']
+            local = getattr(db, 'local', db)
+            result = await local.run(getattr(local, method), *request.get('args', []), **request.get('kwargs', {}))
+            if method in WALLET_WRITES and BotConfig.DB_DURABLE_WALLET:
+                await local.commit()
+            return result
+        if op == 'ping':
+            return self.shard
+        raise ValueError(f"Unknown request {op}")
+
+
+async def serve_shard(application: Application, shard: int, socket_dir: str):
+    """Run one worker: the Application plus its shard socket, until SIGINT or SIGTERM.
+
+    Follows the same lifecycle as serve_webhook(), without registering a
+    webhook: updates arrive from the dispatcher instead.
+    """
+    server = ShardServer(application, shard, shard_socket(socket_dir, shard))
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopping.set)
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        try:
+            await server.start()
+            logger.info(f"Shard {shard} of {BotConfig.SHARDS} listening on {server.path}")
+            await stopping.wait()
+        finally:
+            await server.stop()
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    finally:
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+class DispatcherApp(WebhookApp):
+    """The dispatcher's webhook: Telegram updates and Xendit callbacks go to the worker owning their user.
+
+    Redeliveries are dropped here, before they reach a worker.
+    """
+
+    def __init__(self, clients: List[ShardClient], secret_token: str,
+                 deduplicator: Optional[UpdateDeduplicator] = None):
+        super().__init__(None, secret_token, deduplicator)
+        self.clients = clients
+
+    async def offer(self, data: Dict) -> str:
+        shard = shard_for(update_owner(data) or 0, len(self.clients))
+        try:
+            return await self.clients[shard].call('update', update=data)
+        except (ShardUnavailable, ShardError) as e:
+            logger.warning(f"Update {data.get('update_id')} not handed to shard {shard}: {e}")
+            return REJECTED
+
+    async def xendit_callback(self, request: Request) -> Response:
+        if not token_matches(request.headers.get('x-callback-token'), BotConfig.XENDIT_CALLBACK_TOKEN):
+            return 403, {'status': 'forbidden'}
+        payload = request.json()
+        if not isinstance(payload, dict) or 'id' not in payload:
+            return 400, {'status': 'invalid payload'}
+        # Invoices the bot did not issue carry no user; any shard ignores them the same way
+        shard = shard_for(user_id_from_external_id(payload.get('external_id')) or 0, len(self.clients))
+        try:
+            status = await self.clients[shard].call('callback', payload=payload)
+        except (ShardUnavailable, ShardError) as e:
+            logger.error(f"Settling invoice {payload.get('id')} on shard {shard} failed: {e}")
+            return 500, {'status': 'error'}
+        return 200, {'status': status}
+
+
+class Worker:
+    """One worker process, restarted if it exits while the dispatcher is running"""
+
+    def __init__(self, shard: int, shards: int, socket_dir: str):
+        self.shard = shard
+        self.env = dict(os.environ, SHARDS=str(shards), SHARD_INDEX=str(shard), SHARD_SOCKET_DIR=socket_dir)
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.stopping = False
+
+    async def supervise(self):
+        while not self.stopping:
+            self.process = await asyncio.create_subprocess_exec(sys.executable, MAIN_SCRIPT, env=self.env)
+            code = await self.process.wait()
+            if not self.stopping:
+                logger.error(f"Shard {self.shard} exited with {code}, restarting")
+                await asyncio.sleep(1)
+
+    async def stop(self, timeout: float = 30.0):
+        self.stopping = True
+        if self.process is None or self.process.returncode is not None:
+            return
+        try:
+            self.process.terminate()
+            await asyncio.wait_for(self.process.wait(), timeout)
+        except ProcessLookupError:
+            pass
+        except asyncio.TimeoutError:
+            logger.error(f"Shard {self.shard} did not stop within {timeout:g}s, killing it")
+            self.process.kill()
+            await self.process.wait()
+
+
+async def _wait_ready(client: ShardClient, timeout: float = 120.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while True:
+        try:
+            return await client.call('ping')
+        except ShardUnavailable:
+            if asyncio.get_running_loop().time() > deadline:
+                raise
+            await asyncio.sleep(0.2)
+
+
+async def serve_dispatcher(shards: int, webhook_url: str, host: str = "0.0.0.0", port: int = 8080,
+                           secret_token: Optional[str] = None, socket_dir: str = "shards"):
+    """Start the workers, register the webhook and route requests to the workers until stopped"""
+    import secrets
+    secret_token = secret_token or secrets.token_urlsafe(32)
+    workers = [Worker(shard, shards, socket_dir) for shard in range(shards)]
+    supervisors = [asyncio.create_task(worker.supervise()) for worker in workers]
+    clients = [ShardClient(shard_socket(socket_dir, shard), BotConfig.SHARD_CALL_TIMEOUT) for shard in range(shards)]
+    try:
+        await asyncio.gather(*(_wait_ready(client) for client in clients))
+        logger.info(f"{shards} shards ready")
+        async with Bot(BotConfig.BOT_TOKEN) as bot:
+            await bot.set_webhook(webhook_url, secret_token=secret_token, allowed_updates=Update.ALL_TYPES)
+        logger.info(f"Webhook set to {webhook_url}, dispatching on {host}:{port}")
+        deduplicator = get_update_deduplicator()
+        try:
+            await _webhook_server(DispatcherApp(clients, secret_token, deduplicator), host, port).serve()
+        finally:
+            deduplicator.save()
+    finally:
+        await asyncio.gather(*(client.close() for client in clients))
+        await asyncio.gather(*(worker.stop() for worker in workers))
+        await asyncio.gather(*supervisors, return_exceptions=True)
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=getattr(logging, BotConfig.LOG_LEVEL, logging.INFO))
+    if not BotConfig.WEBHOOK_URL:
+        sys.exit("Multi-process mode receives updates by webhook: set WEBHOOK_URL")
+    asyncio.run(serve_dispatcher(max(1, BotConfig.SHARDS), BotConfig.WEBHOOK_URL, BotConfig.WEBHOOK_HOST,
+                                 BotConfig.PORT, BotConfig.WEBHOOK_SECRET_TOKEN, BotConfig.SHARD_SOCKET_DIR))
+
+
+if __name__ == "__main__":
+    main()
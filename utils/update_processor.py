@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Dict, Hashable, Optional
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+
+def ordering_key(update: object) -> Optional[Hashable]:
+    """The user an update belongs to (or its chat when it has no user); None when it has neither"""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user is not None:
+        return update.effective_user.id
+    if update.effective_chat is not None:
+        return ('chat', update.effective_chat.id)
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates from different users concurrently and each user's updates one at a time, in order.
+
+    The handlers keep per-user conversation state in user_data (the
+    top-up and withdrawal flags) and read a user's balance before
+    changing it, so two updates from the same user must never overlap.
+    Each update waits for the one before it from the same user, then
+    for one of `max_running` slots; updates from other users are not held
+    up by either wait. The base class limit is only a ceiling on updates
+    held here: the Application's UpdateQueue already bounds how many
+    updates are in progress.
+    """
+
+    def __init__(self, max_running: int, max_held: int = 1000, window: int = 1024):
+        if max_running < 1:
+            raise ValueError("max_running must be a positive integer")
+        super().__init__(max(max_running, max_held))
+        self.max_running = max_running
+        self.running = 0
+        self.held = 0
+        self.processed = 0
+        self.waits = deque(maxlen=window)
+        # The completion of the last update handed in for each user
+        self._tails: Dict[Hashable, asyncio.Future] = {}
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    async def initialize(self):
+        self._slots = asyncio.Semaphore(self.max_running)
+
+    async def shutdown(self):
+        self._tails.clear()
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]):
+        key = ordering_key(update)
+        previous = self._tails.get(key) if key is not None else None
+        done = asyncio.get_running_loop().create_future()
+        if key is not None:
+            self._tails[key] = done
+        arrived = time.monotonic()
+        self.held += 1
+        try:
+            try:
+                if previous is not None:
+                    await previous
+                await self._slots.acquire()
+            except asyncio.CancelledError:
+                coroutine.close()
+                raise
+            self.waits.append(time.monotonic() - arrived)
+            self.running += 1
+            try:
+                await coroutine
+            finally:
+                self.running -= 1
+                self.processed += 1
+                self._slots.release()
+        finally:
+            self.held -= 1
+            done.set_result(None)
+            if key is not None and self._tails.get(key) is done:
+                del self._tails[key]
+
+    def stats(self) -> Dict:
+        waits = sorted(self.waits)
+
+        def percentile(fraction: float) -> float:
+            if not waits:
+                return 0.0
+            return round(waits[min(len(waits) - 1, int(len(waits) * fraction))] * 1000, 2)
+
+        return {
+            'running': self.running,
+            'max_running': self.max_running,
+            'held': self.held,
+            'users': len(self._tails),
+            'processed': self.processed,
+            'wait_p50_ms': percentile(0.5),
+            'wait_p99_ms': percentile(0.99),
+        }
@@ -0,0 +1,245 @@
+import asyncio
+import contextlib
+import hmac
+import json
+import logging
+import secrets
+import signal
+from typing import Awaitable, Callable, Dict, Optional, Tuple, Union
+
+from telegram import Update
+from telegram.ext import Application
+
+from bot_config import BotConfig
+from utils.metrics import get_metrics
+from utils.ingestion import (ADMITTED, DEFERRED, REJECTED, RETRY_AFTER, SHED, UpdateDeduplicator,
+                             get_update_deduplicator, offer_update)
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_PATH = "/telegram/webhook"
+CALLBACK_PATH = "/xendit/callback"
+
+# Telegram updates and Xendit callbacks are a few KB; anything this big is refused
+MAX_BODY_BYTES = 1 << 20
+
+# Status and body, optionally followed by extra response headers
+Response = Union[Tuple[int, Union[str, Dict]], Tuple[int, Union[str, Dict], Dict[str, str]]]
+
+
+class Request:
+    """The parts of an ASGI HTTP request the routes read"""
+
+    def __init__(self, scope: Dict, body: bytes):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                        for name, value in scope.get('headers', [])}
+        self.body = body
+
+    def json(self):
+        """The body as JSON, or None when it is not valid JSON"""
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+
+def admission_response(outcome: str) -> Response:
+    """What Telegram is told about an update the queue admitted, shed or refused"""
+    if outcome == ADMITTED:
+        return 200, {'status': 'received'}
+    if outcome == SHED:
+        return 200, {'status': 'shed'}
+    return 503, {'status': 'busy'}, {'Retry-After': str(RETRY_AFTER)}
+
+
+def token_matches(received: Optional[str], expected: Optional[str]) -> bool:
+    """Constant-time comparison of a secret header; False when no secret is configured"""
+    return bool(expected) and hmac.compare_digest((received or '').encode(), expected.encode())
+
+
+class WebhookApp:
+    """ASGI app for the bot's HTTP endpoints, served from the Application's event loop.
+
+    Telegram updates are offered to application.update_queue (admitted,
+    shed or refused when it is an UpdateQueue) and Xendit callbacks are
+    settled by awaiting bot_data['payments'] directly; both run on the
+    loop that owns the queue and the wallet, so no request crosses
+    threads. Telegram must echo `secret_token` in the
+    X-Telegram-Bot-Api-Secret-Token header (it is registered with
+    set_webhook), and Xendit must send XENDIT_CALLBACK_TOKEN in
+    X-CALLBACK-TOKEN. With a `deduplicator`, redeliveries of an update
+    already queued are acknowledged without being parsed.
+    """
+
+    def __init__(self, application: Application, secret_token: str,
+                 deduplicator: Optional[UpdateDeduplicator] = None):
+        self.application = application
+        self.secret_token = secret_token
+        self.deduplicator = deduplicator
+        self.routes: Dict[Tuple[str, str], Callable[[Request], Awaitable[Response]]] = {
+            ('GET', '/'): self.root_health,
+            ('GET', '/health'): self.health,
+            ('GET', '/metrics'): self.metrics,
+            ('POST', WEBHOOK_PATH): self.telegram_webhook,
+            ('POST', CALLBACK_PATH): self.xendit_callback,
+        }
+
+    async def __call__(self, scope: Dict, receive, send):
+        # The Application is started and stopped by serve_webhook(), so lifespan events are ignored
+        if scope['type'] != 'http':
+            return
+
+        route = self.routes.get((scope['method'], scope['path']))
+        if route is None:
+            known_path = any(path == scope['path'] for _, path in self.routes)
+            if known_path:
+                return await self._send(send, 405, {'status': 'method not allowed'})
+            return await self._send(send, 404, {'status': 'not found'})
+        body = await self._read_body(receive)
+        if body is None:
+            return await self._send(send, 413, {'status': 'payload too large'})
+        await self._send(send, *await route(Request(scope, body)))
+
+    @staticmethod
+    async def _read_body(receive) -> Optional[bytes]:
+        chunks, size = [], 0
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > MAX_BODY_BYTES:
+                return None
+            chunks.append(chunk)
+            if not message.get('more_body'):
+                break
+        return b''.join(chunks)
+
+    @staticmethod
+    async def _send(send, status: int, payload: Union[str, Dict], headers: Optional[Dict[str, str]] = None):
+        if isinstance(payload, str):
+            body, content_type = payload.encode(), b'text/plain; charset=utf-8'
+        else:
+            body, content_type = json.dumps(payload).encode(), b'application/json'
+        raw_headers = [(b'content-type', content_type), (b'content-length', str(len(body)).encode())]
+        raw_headers += [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in (headers or {}).items()]
+        await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def root_health(self, request: Request) -> Response:
+        return 200, 'OK'
+
+    async def health(self, request: Request) -> Response:
+        return 200, {'status': 'ok'}
+
+    async def metrics(self, request: Request) -> Response:
+        """Prometheus text format; with METRICS_TOKEN set, scrapers must send it as a bearer token"""
+        if BotConfig.METRICS_TOKEN and not token_matches(request.headers.get('authorization'),
+                                                         f"Bearer {BotConfig.METRICS_TOKEN}"):
+            return 403, {'status': 'forbidden'}
+        return 200, get_metrics().render(self.application)
+
+    async def telegram_webhook(self, request: Request) -> Response:
+        """Queue an update from Telegram; a non-2xx answer makes Telegram redeliver it.
+
+        When the queue is too full for the update's priority it is either
+        acknowledged and dropped, or refused with 503 and Retry-After so
+        Telegram delivers it again later. A redelivery of an update that
+        was already queued is acknowledged and dropped.
+        """
+        if not token_matches(request.headers.get('x-telegram-bot-api-secret-token'), self.secret_token):
+            return 403, {'status': 'forbidden'}
+        data = request.json()
+        if not isinstance(data, dict):
+            return 400, {'status': 'invalid payload'}
+        update_id = data.get('update_id')
+        if self.deduplicator is not None and not self.deduplicator.claim(update_id):
+            return 200, {'status': 'duplicate'}
+        try:
+            outcome = await self.offer(data)
+        except BaseException:
+            # Not queued: Telegram's redelivery of this update must not be taken for a duplicate
+            if self.deduplicator is not None:
+                self.deduplicator.finish(update_id, queued=False)
+            raise
+        if self.deduplicator is not None:
+            self.deduplicator.finish(update_id, queued=outcome not in (DEFERRED, REJECTED))
+        return admission_response(outcome)
+
+    async def offer(self, data: Dict) -> str:
+        """Hand a raw update to the Application; returns the admission outcome"""
+        return await offer_update(self.application, Update.de_json(data, self.application.bot))
+
+    async def xendit_callback(self, request: Request) -> Response:
+        """Settle a paid Xendit invoice; a non-2xx answer makes Xendit retry the callback"""
+        if not token_matches(request.headers.get('x-callback-token'), BotConfig.XENDIT_CALLBACK_TOKEN):
+            return 403, {'status': 'forbidden'}
+        payments = self.application.bot_data.get('payments')
+        if payments is None:
+            return 503, {'status': 'bot not initialized'}
+        payload = request.json()
+        if not isinstance(payload, dict) or 'id' not in payload:
+            return 400, {'status': 'invalid payload'}
+        try:
+            status = await payments.handle_invoice(payload)
+        except Exception as e:
+            logger.error(f"Settling invoice {payload.get('id')} failed: {e}")
+            return 500, {'status': 'error'}
+        return 200, {'status': status}
+
+
+def _webhook_server(app: WebhookApp, host: str, port: int):
+    import uvicorn
+
+    class WebhookServer(uvicorn.Server):
+        @contextlib.contextmanager
+        def capture_signals(self):
+            # uvicorn re-raises SIGINT/SIGTERM once it has stopped, which would cancel
+            # serve_webhook() before it stops the Application; only stop serving here
+            loop = asyncio.get_running_loop()
+            for sig in (signal.SIGINT, signal.SIGTERM):
+                loop.add_signal_handler(sig, self.handle_exit, sig, None)
+            try:
+                yield
+            finally:
+                for sig in (signal.SIGINT, signal.SIGTERM):
+                    loop.remove_signal_handler(sig)
+
+    return WebhookServer(uvicorn.Config(app, host=host, port=port, lifespan="off", log_level="warning"))
+
+
+async def serve_webhook(application: Application, webhook_url: str, host: str = "0.0.0.0", port: int = 8080,
+                        secret_token: Optional[str] = None):
+    """Run the Application and the webhook server together on the current event loop.
+
+    Follows the lifecycle of Application.run_webhook: initialize,
+    post_init, register the webhook, start, serve until the server is
+    stopped (SIGINT/SIGTERM), then stop, post_stop, shutdown and
+    post_shutdown. Without a configured secret token a random one is
+    registered, so unauthenticated POSTs are always refused.
+    """
+    secret_token = secret_token or secrets.token_urlsafe(32)
+    deduplicator = get_update_deduplicator()
+    server = _webhook_server(WebhookApp(application, secret_token, deduplicator), host, port)
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.bot.set_webhook(webhook_url, secret_token=secret_token,
+                                          allowed_updates=Update.ALL_TYPES)
+        logger.info(f"Webhook set to {webhook_url}, serving on {host}:{port}")
+        await application.start()
+        try:
+            await server.serve()
+        finally:
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    finally:
+        deduplicator.save()
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
@@ -1,50 +1,266 @@
+import asyncio
 import httpx
 import os
 import base64
+import logging
+import threading
+import time
+from typing import Dict, Optional
+
+from bot_config import BotConfig
+from utils.metrics import get_metrics
+from utils.resilience import CircuitBreaker, backoff_delay
+
+logger = logging.getLogger(__name__)
 
 BASE_URL = "https://api.xendit.co"
 
-def get_auth_header():
-    secret_key = os.getenv("XENDIT_SECRET_KEY")
-    if not secret_key:
-        raise Exception("XENDIT_SECRET_KEY environment variable not set.")
-    # Xendit requires Basic Auth with base64 encoded secret key
-    encoded = base64.b64encode(f"{secret_key}:".encode()).decode()
-    return {"Authorization": f"Basic {encoded}", "Content-Type": "application/json"}
-
-async def create_invoice(amount, user_id):
-    headers = get_auth_header()
-    data = {
-        "external_id": f"telegram_{user_id}_{amount}",
-        "amount": amount,
-        "description": f"Top up for Telegram user {user_id}"
-    }
-    async with httpx.AsyncClient() as client:
+_id_lock = threading.Lock()
+_last_stamp = 0
+
+
+def new_external_id(prefix: str, user_id: int) -> str:
+    """A unique external_id such as telegram_<user_id>_<stamp><rand>.
+
+    The stamp is wall-clock microseconds, bumped past the previous one so
+    ids issued by this process never repeat, and zero-padded so a user's
+    ids sort in the order they were issued. Four random hex digits keep ids
+    from separate processes apart.
+    """
+    global _last_stamp
+    with _id_lock:
+        _last_stamp = max(time.time_ns() // 1000, _last_stamp + 1)
+        stamp = _last_stamp
+    return f"{prefix}_{user_id}_{stamp:017d}{os.urandom(2).hex()}"
+
+
+# Shown to users instead of raw exception text
+UNAVAILABLE_MESSAGE = "Payments are temporarily unavailable. Please try again in a few minutes."
+TIMEOUT_MESSAGE = "The payment provider is taking too long to respond. Please try again shortly."
+BUSY_MESSAGE = "The payment service is busy right now. Please try again in a moment."
+
+# Transport errors raised before the request left the bot: a retry cannot repeat a payment
+NOT_SENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+
+class XenditClient:
+    """Long-lived Xendit API client.
+
+    One pooled httpx.AsyncClient is shared by every call, so connections
+    (DNS, TCP and TLS) are set up once and kept alive between deposits and
+    withdrawals. The auth header is encoded once, when the client is built.
+    start() and close() are called from the Application's post_init and
+    post_shutdown; a call made before start() opens the pool on demand.
+
+    Each endpoint has a latency budget that covers waiting for one of the
+    `max_in_flight` call slots, every attempt and the backoff between
+    them, so a slow Xendit never holds a handler longer than that. Calls
+    are retried with jittered backoff on timeouts, 429 and 5xx only when
+    repeating them is safe: disbursements carry an idempotency key,
+    invoices are only retried when the request never left the bot. A
+    CircuitBreaker around all calls fails fast while Xendit is down. Errors
+    come back as {"error": <message fit for users>}.
+    """
+
+    def __init__(self, secret_key: Optional[str] = None, base_url: str = BASE_URL, http2: bool = False,
+                 connect_timeout: float = 5.0, read_timeout: float = 20.0, max_connections: int = 20,
+                 keepalive_expiry: float = 60.0, verify=True, invoice_timeout: float = 10.0,
+                 disbursement_timeout: float = 20.0, max_retries: int = 2, max_in_flight: int = 10,
+                 breaker: Optional[CircuitBreaker] = None):
+        secret_key = secret_key if secret_key is not None else os.getenv("XENDIT_SECRET_KEY")
+        self.base_url = base_url
+        self.headers = {"Content-Type": "application/json"}
+        if secret_key:
+            # Xendit requires Basic Auth with base64 encoded secret key
+            encoded = base64.b64encode(f"{secret_key}:".encode()).decode()
+            self.headers["Authorization"] = f"Basic {encoded}"
+        self.http2 = http2
+        self.connect_timeout = connect_timeout
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections,
+                                   keepalive_expiry=keepalive_expiry)
+        self.verify = verify
+        # Latency budget (seconds) per endpoint and whether a call that reached Xendit may be repeated
+        self.endpoints = {
+            'invoice': {'budget': invoice_timeout, 'idempotent': False},
+            'disbursement': {'budget': disbursement_timeout, 'idempotent': True},
+        }
+        self.max_retries = max_retries
+        self.max_in_flight = max_in_flight
+        self.breaker = breaker or CircuitBreaker("xendit")
+        self.in_flight = 0
+        self.retries = 0
+        self.busy_rejections = 0
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def start(self):
+        """Open the connection pool"""
+        if self._client is not None:
+            return
+        http2 = self.http2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("XENDIT_HTTP2 is set but the h2 package is not installed, using HTTP/1.1")
+                http2 = False
+        self._client = httpx.AsyncClient(base_url=self.base_url, headers=self.headers, timeout=self.timeout,
+                                         limits=self.limits, http2=http2, verify=self.verify)
+
+    async def close(self):
+        """Close every pooled connection"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _post(self, endpoint: str, path: str, data: Dict, headers: Optional[Dict] = None) -> Dict:
+        if "Authorization" not in self.headers:
+            return {"error": "XENDIT_SECRET_KEY environment variable not set."}
+        if self.breaker.rejecting:
+            self.breaker.rejected += 1
+            return {"error": UNAVAILABLE_MESSAGE, "circuit_open": True}
+        if self._client is None:
+            await self.start()
+
+        policy = self.endpoints[endpoint]
+        latency = get_metrics().xendit_latency
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + policy['budget']
+        try:
+            await asyncio.wait_for(self._slots.acquire(), policy['budget'])
+        except asyncio.TimeoutError:
+            self.busy_rejections += 1
+            return {"error": BUSY_MESSAGE}
+        self.in_flight += 1
         try:
-            response = await client.post(f"{BASE_URL}/v2/invoices", json=data, headers=headers)
-            response.raise_for_status()
-            return response.json()
-        except httpx.HTTPStatusError as e:
-            return {"error": str(e), "status_code": e.response.status_code, "details": e.response.text}
-        except Exception as e:
-            return {"error": str(e)}
+            attempt = 0
+            while True:
+                if not self.breaker.allow():
+                    return {"error": UNAVAILABLE_MESSAGE, "circuit_open": True}
+                remaining = deadline - loop.time()
+                timeout = httpx.Timeout(remaining, connect=min(self.connect_timeout, remaining))
+                retry_after = 0.0
+                started = time.perf_counter()
+                try:
+                    response = await self._client.post(path, json=data, headers=headers, timeout=timeout)
+                except httpx.TransportError as e:
+                    latency.labels(endpoint, "timeout" if isinstance(e, httpx.TimeoutException) else "error").observe(
+                        time.perf_counter() - started)
+                    self.breaker.record_failure()
+                    logger.warning(f"Xendit {path} attempt {attempt + 1} failed: {e!r}")
+                    sent = not isinstance(e, NOT_SENT_ERRORS)
+                    result = {"error": TIMEOUT_MESSAGE if isinstance(e, httpx.TimeoutException) else UNAVAILABLE_MESSAGE}
+                except asyncio.CancelledError:
+                    # Says nothing about Xendit, but a half-open breaker must not wait on this probe
+                    self.breaker.abandon()
+                    raise
+                except BaseException:
+                    self.breaker.record_failure()
+                    raise
+                else:
+                    latency.labels(endpoint, str(response.status_code)).observe(time.perf_counter() - started)
+                    if response.status_code < 500 and response.status_code != 429:
+                        # Xendit answered; a 4xx is about the request, not Xendit's health
+                        self.breaker.record_success()
+                        return self._result(response)
+                    self.breaker.record_failure()
+                    logger.warning(f"Xendit {path} attempt {attempt + 1} failed: HTTP {response.status_code}")
+                    sent = True
+                    retry_after = self._retry_after(response)
+                    result = {"error": UNAVAILABLE_MESSAGE, "status_code": response.status_code}
 
-async def create_withdrawal(amount, user_id, bank_code, account_number, account_holder_name):
-    headers = get_auth_header()
-    data = {
-        "external_id": f"withdraw_{user_id}_{amount}",
-        "amount": amount,
-        "bank_code": bank_code,
-        "account_holder_name": account_holder_name,
-        "account_number": account_number,
-        "description": f"Withdrawal for Telegram user {user_id}"
-    }
-    async with httpx.AsyncClient() as client:
+                attempt += 1
+                if attempt > self.max_retries or (sent and not policy['idempotent']):
+                    return result
+                delay = max(backoff_delay(attempt), retry_after)
+                if loop.time() + delay >= deadline:
+                    return result
+                self.retries += 1
+                await asyncio.sleep(delay)
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+
+    @staticmethod
+    def _result(response: httpx.Response) -> Dict:
         try:
-            response = await client.post(f"{BASE_URL}/disbursements", json=data, headers=headers)
-            response.raise_for_status()
-            return response.json()
-        except httpx.HTTPStatusError as e:
-            return {"error": str(e), "status_code": e.response.status_code, "details": e.response.text}
-        except Exception as e:
-            return {"error": str(e)}
\ No newline at end of file
+            body = response.json()
+        except ValueError:
+            body = {"message": response.text[:200]}
+        if response.is_success:
+            return body
+        message = body.get("message") if isinstance(body, dict) else None
+        logger.warning(f"Xendit rejected {response.request.url.path}: HTTP {response.status_code} {body}")
+        return {"error": f"Payment request rejected: {message or 'HTTP ' + str(response.status_code)}",
+                "status_code": response.status_code, "details": response.text}
+
+    @staticmethod
+    def _retry_after(response: httpx.Response) -> float:
+        try:
+            return float(response.headers.get("Retry-After", 0))
+        except ValueError:
+            return 0.0
+
+    def stats(self) -> Dict:
+        return {
+            'breaker': self.breaker.stats(),
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'retries': self.retries,
+            'busy_rejections': self.busy_rejections
+        }
+
+    async def create_invoice(self, amount, user_id, external_id: Optional[str] = None,
+                             duration: Optional[int] = None) -> Dict:
+        data = {
+            "external_id": external_id or new_external_id("telegram", user_id),
+            "amount": amount,
+            "description": f"Top up for Telegram user {user_id}"
+        }
+        if duration:
+            # Seconds until Xendit expires the invoice
+            data["invoice_duration"] = duration
+        return await self._post('invoice', "/v2/invoices", data)
+
+    async def create_withdrawal(self, amount, user_id, bank_code, account_number, account_holder_name) -> Dict:
+        data = {
+            "external_id": new_external_id("withdraw", user_id),
+            "amount": amount,
+            "bank_code": bank_code,
+            "account_holder_name": account_holder_name,
+            "account_number": account_number,
+            "description": f"Withdrawal for Telegram user {user_id}"
+        }
+        # Xendit creates at most one disbursement per idempotency key, which makes retries safe
+        return await self._post('disbursement', "/disbursements", data,
+                                headers={"X-IDEMPOTENCY-KEY": data["external_id"]})
+
+
+_shared_client: Optional[XenditClient] = None
+
+def get_xendit_client() -> XenditClient:
+    """Return the process-wide Xendit client shared by all handlers"""
+    global _shared_client
+    if _shared_client is None:
+        _shared_client = XenditClient(
+            base_url=BotConfig.XENDIT_BASE_URL,
+            http2=BotConfig.XENDIT_HTTP2,
+            connect_timeout=BotConfig.XENDIT_CONNECT_TIMEOUT,
+            read_timeout=BotConfig.XENDIT_READ_TIMEOUT,
+            max_connections=BotConfig.XENDIT_MAX_CONNECTIONS,
+            invoice_timeout=BotConfig.XENDIT_INVOICE_TIMEOUT,
+            disbursement_timeout=BotConfig.XENDIT_DISBURSEMENT_TIMEOUT,
+            max_retries=BotConfig.XENDIT_MAX_RETRIES,
+            max_in_flight=BotConfig.XENDIT_MAX_IN_FLIGHT,
+            breaker=CircuitBreaker("xendit", threshold=BotConfig.XENDIT_BREAKER_THRESHOLD,
+                                   cooldown=BotConfig.XENDIT_BREAKER_COOLDOWN)
+        )
+    return _shared_client
+
+async def create_invoice(amount, user_id, external_id=None, duration=None):
+    return await get_xendit_client().create_invoice(amount, user_id, external_id, duration)
+
+async def create_withdrawal(amount, user_id, bank_code, account_number, account_holder_name):
+    return await get_xendit_client().create_withdrawal(amount, user_id, bank_code, account_number,
+                                                       account_holder_name)